@@ -0,0 +1,88 @@
+# Author: Alec Creasy
+# File Name: bench_index.py
+# Description: Compares the recall, latency and memory of the float16 and int8 exact indexes and the approximate
+# cluster index against float32 exact search on synthetic FAQ embeddings. Run from the repository root with
+# "python -m benchmarks.bench_index".
+
+import argparse
+import json
+import time
+import numpy as np
+from utils.vector_index import ExactIndex, ClusterIndex, normalize
+
+# Helper function to create clustered unit vectors that look roughly like sentence embeddings of related questions,
+# along with queries that are noisy copies of random rows.
+def make_data(size, dim, queries, rng):
+    topics = normalize(rng.standard_normal((max(1, size // 20), dim)))
+    rows = normalize(topics[rng.integers(len(topics), size=size)] + rng.standard_normal((size, dim)) * 1.6 / np.sqrt(dim))
+    query_rows = normalize(rows[rng.integers(size, size=queries)] + rng.standard_normal((queries, dim)) * 1.2 / np.sqrt(dim))
+    return rows, query_rows
+
+# Helper function that returns the fraction of the exact top k results an index also returned, averaged over queries.
+def recall(truth, results):
+    return float(np.mean([len(expected & {index for index, _ in result}) / len(expected)
+                          for expected, result in zip(truth, results)]))
+
+# Helper function that returns the fraction of queries whose best result matches the exact best result, which is what
+# decides the FAQ auto-reply.
+def recall_at_1(exact, results):
+    return float(np.mean([bool(result) and result[0][0] == expected[0][0] for expected, result in zip(exact, results)]))
+
+# Helper function that returns the largest difference between the scores an index gives the exact top k results and
+# their float32 scores, over all queries.
+def score_error(index, queries, exact):
+    return float(max(np.abs(index.score(query, [i for i, _ in result]) - [score for _, score in result]).max()
+                     for query, result in zip(queries, exact)))
+
+# Helper function to time every query against an index, returning the results along with the p50 and p99 latency
+# in milliseconds.
+def run_queries(index, queries, k):
+    results, timings = [], []
+    for query in queries:
+        start = time.perf_counter()
+        results.append(index.search(query, k=k))
+        timings.append((time.perf_counter() - start) * 1000)
+    return results, float(np.percentile(timings, 50)), float(np.percentile(timings, 99))
+
+def main():
+    parser = argparse.ArgumentParser(description="Recall vs latency of the FAQ index backends.")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 50000])
+    parser.add_argument("--dim", type=int, default=384)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--k", type=int, default=5)
+    parser.add_argument("--probe-fractions", type=float, nargs="+", default=[0.02, 0.05, 0.1])
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    report = []
+    for size in args.sizes:
+        rows, queries = make_data(size, args.dim, args.queries, rng)
+        baseline = ExactIndex(rows)
+        exact, p50, p99 = run_queries(baseline, queries, args.k)
+        truth = [{index for index, _ in result} for result in exact]
+        report.append({"size": size, "backend": "exact-float32", "recall": 1.0, "recall_at_1": 1.0, "p50_ms": p50,
+                       "p99_ms": p99, "kib": baseline.nbytes() / 1024, "max_score_error": 0.0})
+
+        for dtype in ("float16", "int8"):
+            index = ExactIndex(rows, dtype=dtype)
+            results, p50, p99 = run_queries(index, queries, args.k)
+            report.append({"size": size, "backend": f"exact-{dtype}", "recall": recall(truth, results),
+                           "recall_at_1": recall_at_1(exact, results), "p50_ms": p50, "p99_ms": p99, "kib": index.nbytes() / 1024,
+                           "max_score_error": score_error(index, queries, exact)})
+
+        start = time.perf_counter()
+        cluster = ClusterIndex(rows)
+        build_ms = (time.perf_counter() - start) * 1000
+        for fraction in args.probe_fractions:
+            cluster.N_PROBE, cluster.PROBE_FRACTION = 1, fraction
+            approx, p50, p99 = run_queries(cluster, queries, args.k)
+            report.append({"size": size, "backend": f"cluster-probe{fraction:.0%}", "recall": recall(truth, approx),
+                           "recall_at_1": recall_at_1(exact, approx), "p50_ms": p50, "p99_ms": p99,
+                           "build_ms": build_ms, "kib": cluster.nbytes() / 1024})
+
+    for row in report:
+        print(json.dumps(row))
+
+if __name__ == "__main__":
+    main()
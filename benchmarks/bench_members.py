@@ -0,0 +1,130 @@
+# Author: Alec Creasy
+# File Name: bench_members.py
+# Description: Compares the bot's "full" and "minimal" member cache modes (see MEMBER_CACHE in config.ini) on large
+# synthetic servers. The first part feeds discord.py's own gateway state the events it processes for a server at
+# start up, measuring the memory the cached members take and the time spent parsing them. The second part runs a bulk
+# role job both ways, counting the requests made to list and fetch members. Run from the repository root with
+# "python -m benchmarks.bench_members".
+
+import argparse
+import asyncio
+import gc
+import json
+import math
+import os
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+import discord
+from discord.ext import commands
+from discord.state import ChunkRequest
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+
+from benchmarks.fakes import FakeBot, FakeGuild
+from utils.role_jobs import RoleJobEngine, members_with_role
+
+GUILD_ID = 1000000000000000000
+ROLE_ID = 1000000000000000001
+BOT_ID = 1000000000000000002
+CHUNK_SIZE = 1000
+
+# Helper function to create the gateway payload for one member, as sent in GUILD_CREATE and GUILD_MEMBERS_CHUNK events.
+def member_payload(member_id, with_role):
+    return {"user": {"id": str(member_id), "username": f"student{member_id % 100000}", "discriminator": "0",
+                     "global_name": None, "avatar": None, "bot": member_id == BOT_ID},
+            "roles": [str(ROLE_ID)] if with_role else [], "joined_at": "2024-08-20T12:00:00+00:00",
+            "deaf": False, "mute": False, "flags": 0}
+
+# Helper function to create a GUILD_CREATE payload for a large server. Like Discord, it only includes the bot's own
+# member; the rest arrive in GUILD_MEMBERS_CHUNK events if the bot asks for them.
+def guild_payload(size):
+    everyone = {"id": str(GUILD_ID), "name": "@everyone", "permissions": "0", "position": 0, "color": 0,
+                "hoist": False, "managed": False, "mentionable": False}
+    course = dict(everyone, id=str(ROLE_ID), name="CSCI 1170", position=1)
+    return {"id": str(GUILD_ID), "name": "Course Server", "owner_id": str(BOT_ID), "member_count": size, "large": True,
+            "roles": [everyone, course], "emojis": [], "stickers": [], "features": [], "channels": [], "threads": [],
+            "members": [member_payload(BOT_ID, False)], "voice_states": [], "presences": [],
+            "premium_tier": 0, "verification_level": 0, "default_message_notifications": 0,
+            "explicit_content_filter": 0, "mfa_level": 0, "nsfw_level": 0, "preferred_locale": "en-US"}
+
+# Processes the start up events for a server of "size" members with the options the bot would use in the given mode,
+# and returns the memory held afterwards and the time taken. The time is measured with tracemalloc running, so it is
+# higher than without it, and it leaves out the network round trips for the chunk events.
+async def connect(size, mode):
+    intents = discord.Intents.default()
+    intents.members = True
+    options = {} if mode == "full" else {"chunk_guilds_at_startup": False, "member_cache_flags": discord.MemberCacheFlags.none()}
+    bot = commands.Bot(command_prefix="/", intents=intents, **options)
+    state = bot._connection
+    payload = guild_payload(size)
+    chunks = [[member_payload(BOT_ID + 1 + index, index % 10 == 0) for index in range(start, min(start + CHUNK_SIZE, size))]
+              for start in range(0, size, CHUNK_SIZE)] if mode == "full" else []
+
+    gc.collect()
+    tracemalloc.start()
+    start = time.perf_counter()
+    guild = state._add_guild_from_data(payload)
+
+    # In full mode discord.py requests every member and caches each chunk as it arrives.
+    if state._guild_needs_chunking(guild):
+        request = ChunkRequest(guild.id, asyncio.get_running_loop(), state._get_guild, cache=True)
+        state._chunk_requests[request.nonce] = request
+        for index, members in enumerate(chunks):
+            state.parse_guild_members_chunk({"guild_id": str(GUILD_ID), "members": members, "nonce": request.nonce,
+                                             "chunk_index": index, "chunk_count": len(chunks)})
+    elapsed = time.perf_counter() - start
+    del chunks
+    gc.collect()
+    memory, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {"cached_members": len(guild.members), "chunk_events": math.ceil(size / CHUNK_SIZE) if mode == "full" else 0,
+            "parse_s": elapsed, "memory_mib": memory / 1024 / 1024}
+
+# Runs a job moving every member with a role (one in ten members) to the visitor role, and counts the requests made to
+# list and fetch members.
+async def role_job(size, mode):
+    previous = os.getcwd()
+    workspace = tempfile.mkdtemp(prefix="sainjubot-bench-")
+    os.chdir(workspace)
+    try:
+        guild = FakeGuild(role_names=["CSCI 1170", "Visitor"], chunked=(mode == "full"))
+        role, visitor = guild.roles[1], guild.roles[2]
+        for index in range(size):
+            guild.add_member(f"student{index}", roles=[role] if index % 10 == 0 else [])
+
+        start = time.perf_counter()
+        members = await members_with_role(guild, role)
+        listed = time.perf_counter() - start
+        engine = RoleJobEngine(FakeBot([guild]), "jobs.db", concurrency=4, progress_interval=60)
+        job = await engine.start(guild, role, visitor, members)
+        await engine.tasks[job.id]
+        engine.close()
+        return {"members_with_role": len(members), "list_s": listed, "job_s": time.perf_counter() - start,
+                "member_requests": guild.fetch_requests, "updated": job.done}
+    finally:
+        os.chdir(previous)
+        shutil.rmtree(workspace, ignore_errors=True)
+
+async def run(args):
+    report = []
+    for size in args.sizes:
+        for mode in ("full", "minimal"):
+            row = {"size": size, "mode": mode}
+            row.update(await connect(size, mode))
+            row.update({f"job_{key}": value for key, value in (await role_job(size, mode)).items()})
+            report.append(row)
+    return report
+
+def main():
+    parser = argparse.ArgumentParser(description="Memory and start up cost of the member cache modes.")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10000, 100000])
+    args = parser.parse_args()
+    for row in asyncio.run(run(args)):
+        print(json.dumps(row))
+
+if __name__ == "__main__":
+    main()
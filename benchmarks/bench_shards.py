@@ -0,0 +1,185 @@
+# Author: Alec Creasy
+# File Name: bench_shards.py
+# Description: Runs the bot's sharded mode locally with stand-in gateways. An inference service process serves the
+# hashing stand-in model, and each shard process loads the FAQ and Role Bot cogs for the fake servers its shards
+# would receive (by Discord's sharding formula), then answers a flood of questions in those servers. Every process
+# then tries to redeem the same single-use tokens from the shared token database, which were generated after the
+# processes started, to check each token is redeemed exactly once. The same workload is also run in a single process
+# with its own model for comparison. Run from the repository root with "python -m benchmarks.bench_shards".
+
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import random
+import sys
+import time
+from configparser import ConfigParser
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+
+from benchmarks.fakes import FakeBot, FakeGuild, FakeMessage
+from benchmarks.run import Workspace, install_model, make_faqs, paraphrase, summarize
+from utils.sharding import SHARD_IDS_VARIABLE, SHARD_COUNT_VARIABLE, INFERENCE_ADDRESS_VARIABLE, shard_for, shard_ranges
+
+# Runs the inference service in its own process, serving the hashing stand-in model, until it is terminated.
+def service_process(path, address, args):
+    os.chdir(path)
+    install_model(args)
+    from utils.inference_service import serve
+    config = ConfigParser()
+    config.read("./config.ini")
+    asyncio.run(serve(config, address))
+
+# Runs one shard process: creates the fake servers its shards receive, loads the cogs, reports that it is ready, and
+# once every process is ready answers its share of the questions and tries to redeem every token.
+def shard_process(path, address, shard_ids, shard_count, args, start_event, results):
+    os.chdir(path)
+    install_model(args)
+    if shard_ids is not None:
+        os.environ[SHARD_IDS_VARIABLE] = ",".join(str(shard_id) for shard_id in shard_ids)
+        os.environ[SHARD_COUNT_VARIABLE] = str(shard_count)
+    if address:
+        os.environ[INFERENCE_ADDRESS_VARIABLE] = address
+    results.put(asyncio.run(run_shard(shard_ids, shard_count, args, start_event, results)))
+
+async def run_shard(shard_ids, shard_count, args, start_event, results):
+    from cogs.faq import Faq
+    from cogs.rolebot import Rolebot
+    rng = random.Random(shard_ids[0] if shard_ids else 0)
+
+    # Guild IDs are chosen so guild i is received by shard i % shard_count, as a real guild's ID decides its shard.
+    guilds = []
+    for index in range(args.guilds):
+        guild_id = (index + 1) << 22
+        if shard_ids is None or shard_for(guild_id, shard_count) in shard_ids:
+            guild = FakeGuild(channel_names=["general"])
+            guild.id = guild_id
+            guilds.append(guild)
+    bot = FakeBot(guilds, shard_ids=shard_ids, shard_count=shard_count)
+
+    faq = Faq(bot)
+    await faq.cog_load()
+    await faq.warm_up()
+    faq.coalescer.WINDOW = faq.user_cooldown.WINDOW = faq.reply_cooldown.WINDOW = 0
+    faq.channel_replies.LIMIT = args.messages * 3
+    for guild in guilds:
+        await faq.namespace(guild)
+    rolebot = Rolebot(bot)
+
+    with open("data/faq.json") as file:
+        faqs = json.load(file)
+    messages = [FakeMessage(paraphrase(rng.choice(faqs), rng), guild.add_member(f"student{index}"),
+                            guild.text_channels[0], guild)
+                for guild in guilds for index in range(args.messages // args.guilds)]
+
+    results.put("ready")
+    await asyncio.to_thread(start_event.wait)
+
+    async def timed(message):
+        start = time.perf_counter()
+        await faq.on_message(message)
+        return time.perf_counter() - start
+
+    start = time.perf_counter()
+    latencies = []
+    for offset in range(0, len(messages), args.concurrency):
+        latencies.extend(await asyncio.gather(*(timed(message) for message in messages[offset:offset + args.concurrency])))
+    elapsed = time.perf_counter() - start
+
+    with open("data/bench_tokens.json") as file:
+        tokens = json.load(file)
+    claimed = await asyncio.gather(*(rolebot.tokens.claim(token) for token in tokens))
+
+    await faq.cog_unload()
+    await rolebot.cog_unload()
+    return {"guilds": len(guilds), "messages": len(messages), "elapsed_s": elapsed, "latencies": latencies,
+            "replies": sum(len(message.replies) for message in messages), "shed": faq.worker.shed_count,
+            "tokens_redeemed": sum(claimed)}
+
+# Helper function to add the single-use tokens every process tries to redeem to the token database, and write them to
+# a file for the processes to read.
+async def generate_tokens(args):
+    from utils.token_store import TokenStore
+    store = TokenStore("./data/tokens.db")
+    tokens = [f"token{index}" for index in range(args.tokens)]
+    await store.add("CSCI 1170", tokens, single_use=True)
+    store.close()
+    with open("data/bench_tokens.json", "w") as file:
+        json.dump(tokens, file)
+
+# Runs the workload over "processes" shard processes sharing an inference service, or in a single process with its
+# own model if "processes" is 0, and combines their results.
+async def run_mode(args, processes):
+    context = multiprocessing.get_context("spawn")
+    with Workspace() as workspace:
+        workspace.write_faqs(make_faqs(args.faq_size, random.Random(0)))
+        address = f"unix:{os.path.join(workspace.path, 'data', 'inference.sock')}" if processes else ""
+        service = None
+        if processes:
+            service = context.Process(target=service_process, args=(workspace.path, address, args))
+            service.start()
+
+        ranges = shard_ranges(args.shards, processes) if processes else [None]
+        start_event = context.Event()
+        results = context.Queue()
+        workers = [context.Process(target=shard_process, args=(workspace.path, address, shard_ids, args.shards,
+                                                               args, start_event, results))
+                   for shard_ids in ranges]
+
+        # With shard processes, the tokens are generated once every process has loaded the token database, so they
+        # can only see them through the shared database. A single process has them from the start, as it would if it
+        # had generated them itself.
+        if not processes:
+            await generate_tokens(args)
+        for worker in workers:
+            worker.start()
+        for _ in workers:
+            await asyncio.to_thread(results.get, True, 120)
+        if processes:
+            await generate_tokens(args)
+
+        start = time.perf_counter()
+        start_event.set()
+        reports = [await asyncio.to_thread(results.get, True, 300) for _ in workers]
+        elapsed = time.perf_counter() - start
+        for worker in workers:
+            worker.join()
+        if service is not None:
+            service.terminate()
+            service.join()
+
+    messages = sum(report["messages"] for report in reports)
+    return {"processes": len(workers), "shared_inference": bool(processes), "messages": messages,
+            "messages_per_sec": messages / max(report["elapsed_s"] for report in reports),
+            "latency": summarize([latency for report in reports for latency in report["latencies"]]),
+            "replies": sum(report["replies"] for report in reports), "shed": sum(report["shed"] for report in reports),
+            "guilds_per_process": [report["guilds"] for report in reports],
+            "tokens": args.tokens, "tokens_redeemed": sum(report["tokens_redeemed"] for report in reports),
+            "wall_s": elapsed}
+
+async def run(args):
+    report = [await run_mode(args, 0)]
+    for processes in args.processes:
+        report.append(await run_mode(args, processes))
+    return report
+
+def main():
+    parser = argparse.ArgumentParser(description="Throughput and shared state of the sharded multi-process mode.")
+    parser.add_argument("--processes", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--shards", type=int, default=4)
+    parser.add_argument("--guilds", type=int, default=32)
+    parser.add_argument("--faq-size", type=int, default=200)
+    parser.add_argument("--messages", type=int, default=4000)
+    parser.add_argument("--concurrency", type=int, default=64)
+    parser.add_argument("--tokens", type=int, default=500)
+    parser.add_argument("--model", default="hashing")
+    parser.add_argument("--model-latency-ms", type=float, default=2.0)
+    args = parser.parse_args()
+    for row in asyncio.run(run(args)):
+        print(json.dumps(row))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,208 @@
+# Author: Alec Creasy
+# File Name: fakes.py
+# Description: Stand-ins for the discord.py objects and the sentence transformer used by the cogs, so their hot paths
+# can be benchmarked without a network connection or a real model.
+
+import itertools
+import re
+import time
+import zlib
+import numpy as np
+
+ids = itertools.count(1000)
+WORD_PATTERN = re.compile(r"\w+")
+
+# A deterministic replacement for SentenceTransformer. Each text is embedded as a hashed bag of its words and word
+# pairs, so texts sharing most of their words get a high cosine similarity. "latency_ms" adds a fixed delay per encode
+# call plus a smaller delay per text, to roughly imitate the cost of a real forward pass.
+class HashingModel:
+    def __init__(self, name="hashing", dim=384, latency_ms=0.0):
+        self.name = name
+        self.dim = dim
+        self.latency_ms = latency_ms
+        self.calls = 0
+        self.texts = 0
+
+    def _embed(self, text):
+        words = WORD_PATTERN.findall(text.lower())
+        vector = np.zeros(self.dim, dtype=np.float32)
+        for feature in words + [a + " " + b for a, b in zip(words, words[1:])]:
+            code = zlib.crc32(feature.encode("utf-8"))
+            vector[code % self.dim] += 1.0 if code & 0x80000000 else -1.0
+        return vector
+
+    def encode(self, texts, batch_size=32, convert_to_numpy=True, normalize_embeddings=False, show_progress_bar=False,
+               convert_to_tensor=False):
+        single = isinstance(texts, str)
+        texts = [texts] if single else list(texts)
+        self.calls += 1
+        self.texts += len(texts)
+        if self.latency_ms:
+            time.sleep((self.latency_ms + 0.1 * self.latency_ms * len(texts)) / 1000)
+        vectors = np.stack([self._embed(text) for text in texts]) if texts else np.zeros((0, self.dim), np.float32)
+        if normalize_embeddings:
+            norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+            norms[norms == 0] = 1
+            vectors = vectors / norms
+        return vectors[0] if single else vectors
+
+class FakePermissions:
+    def __init__(self, administrator=False):
+        self.administrator = administrator
+
+class FakeRole:
+    def __init__(self, name, managed=False, guild=None):
+        self.id = next(ids)
+        self.name = name
+        self.managed = managed
+        self.guild = guild
+
+    # Like discord.py, the members of a role come from the guild's member cache.
+    @property
+    def members(self):
+        return [member for member in self.guild.members if self in member.roles] if self.guild else []
+
+    def is_default(self):
+        return self.name == "@everyone"
+
+class FakeMember:
+    def __init__(self, name, roles=(), bot=False, administrator=False):
+        self.id = next(ids)
+        self.name = name
+        self.bot = bot
+        self.roles = list(roles)
+        self.guild_permissions = FakePermissions(administrator)
+
+    def __str__(self):
+        return self.name
+
+    async def add_roles(self, *roles, reason=None):
+        self.roles.extend(role for role in roles if role not in self.roles)
+
+    async def remove_roles(self, *roles, reason=None):
+        self.roles = [role for role in self.roles if role not in roles]
+
+    async def edit(self, roles=None, reason=None):
+        if roles is not None:
+            self.roles = [self.roles[0]] + list(roles)
+
+class FakeChannel:
+    def __init__(self, name):
+        self.id = next(ids)
+        self.name = name
+        self.mention = f"<#{self.id}>"
+        self.sent = []
+
+    async def send(self, content=None, **kwargs):
+        self.sent.append((content, kwargs))
+
+# A guild whose members are all "cached". With chunked=False it behaves like a guild in the bot's minimal member cache
+# mode: "members" is empty, and the members can only be listed through fetch_members().
+class FakeGuild:
+    def __init__(self, role_names=(), channel_names=(), chunked=True):
+        self.id = next(ids)
+        self.default_role = FakeRole("@everyone", guild=self)
+        self.roles = [self.default_role] + [FakeRole(name, guild=self) for name in role_names]
+        self.text_channels = [FakeChannel(name) for name in channel_names]
+        self.chunked = chunked
+        self.all_members = []
+        self.fetch_requests = 0
+
+    @property
+    def members(self):
+        return self.all_members if self.chunked else []
+
+    def add_member(self, name, roles=(), **kwargs):
+        member = FakeMember(name, [self.default_role] + list(roles), **kwargs)
+        self.all_members.append(member)
+        return member
+
+    def get_member(self, member_id):
+        return next((member for member in self.members if member.id == member_id), None)
+
+    async def fetch_member(self, member_id):
+        self.fetch_requests += 1
+        return next(member for member in self.all_members if member.id == member_id)
+
+    # Yields every member a page of 1000 at a time, counting each page as one request.
+    async def fetch_members(self, limit=1000):
+        for start in range(0, len(self.all_members) if limit is None else min(limit, len(self.all_members)), 1000):
+            self.fetch_requests += 1
+            for member in self.all_members[start:start + 1000]:
+                yield member
+
+    def get_role(self, role_id):
+        return next((role for role in self.roles if role.id == role_id), None)
+
+class FakeMessage:
+    def __init__(self, content, author, channel, guild=None):
+        self.id = next(ids)
+        self.content = content
+        self.author = author
+        self.channel = channel
+        self.guild = guild
+        self.attachments = []
+        self.replies = []
+
+    async def reply(self, content=None, **kwargs):
+        self.replies.append(content)
+
+class FakeAttachment:
+    def __init__(self, filename, data):
+        self.filename = filename
+        self.data = data
+        self.size = len(data)
+
+    async def read(self):
+        return self.data
+
+# Records what a command sends back instead of sending it to Discord.
+class FakeResponse:
+    def __init__(self):
+        self.sent = []
+        self.deferred = False
+
+    def is_done(self):
+        return self.deferred or bool(self.sent)
+
+    async def send_message(self, content=None, **kwargs):
+        self.sent.append((content, kwargs))
+
+    async def defer(self, **kwargs):
+        self.deferred = True
+
+    async def edit_message(self, **kwargs):
+        self.sent.append((kwargs.get("content"), kwargs))
+
+class FakeFollowup:
+    def __init__(self):
+        self.sent = []
+
+    async def send(self, content=None, **kwargs):
+        self.sent.append((content, kwargs))
+
+class FakeInteraction:
+    def __init__(self, user, guild, channel, command_name="command"):
+        self.id = next(ids)
+        self.user = user
+        self.guild = guild
+        self.channel = channel
+        self.response = FakeResponse()
+        self.followup = FakeFollowup()
+        self.extras = {}
+        self.command = type("FakeCommand", (), {"name": command_name, "qualified_name": command_name})()
+
+    async def edit_original_response(self, **kwargs):
+        self.response.sent.append((kwargs.get("content"), kwargs))
+
+# The parts of the bot the cogs use directly.
+class FakeBot:
+    def __init__(self, guilds=(), shard_ids=None, shard_count=None):
+        self.user = FakeMember("SainjuBot", bot=True)
+        self.guilds = list(guilds)
+        self.latency = 0.05
+        self.shard_ids = shard_ids
+        self.shard_count = shard_count
+
+    def get_guild(self, guild_id):
+        return next((guild for guild in self.guilds if guild.id == guild_id), None)
@@ -0,0 +1,485 @@
+# Author: Alec Creasy
+# File Name: run.py
+# Description: Offline benchmarks for the bot's hot paths: FAQ matching (steady, in bursts, and across servers), token
+# redemption, adding and importing FAQs, FAQ search, logging, and start up.
+# Every benchmark runs in a temporary directory with its own copy of config.ini and data, using the fake Discord
+# objects in fakes.py. Run from the repository root with "python -m benchmarks.run"; results are printed (or written
+# with --output) as JSON, and --compare prints the change from an earlier results file.
+
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import types
+import numpy as np
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+
+from benchmarks.fakes import HashingModel, FakeAttachment, FakeBot, FakeGuild, FakeMessage, FakeInteraction
+
+TOPICS = ["lab", "exam", "homework", "project", "office hours", "syllabus", "grade", "research", "server", "deadline"]
+ACTIONS = ["submit", "find", "join", "access", "check", "request", "schedule", "reset", "drop", "change"]
+CHATTER = ["lol", "ok", "thanks!", "same", "https://example.com", "brb", "nice", ":)", "gg", "yes"]
+
+# Helper function to make "count" distinct FAQ entries.
+def make_faqs(count, rng):
+    faqs = []
+    for index in range(count):
+        action, topic = rng.choice(ACTIONS), rng.choice(TOPICS)
+        faqs.append({"question": f"How do I {action} the {topic} for section {index}?",
+                     "answer": f"You can {action} the {topic} for section {index} on the course page."})
+    return faqs
+
+# Helper function to make a question that is close to one of the FAQs, as a student might phrase it.
+def paraphrase(faq, rng):
+    question = faq["question"].replace("How do I", rng.choice(["how do i", "How can I", "Where do I"]))
+    return question.rstrip("?") + rng.choice(["?", " ?", "??"])
+
+# Helper function to summarize a list of latencies in seconds as milliseconds.
+def summarize(latencies):
+    latencies = np.asarray(latencies) * 1000
+    return {"count": len(latencies), "p50_ms": float(np.percentile(latencies, 50)),
+            "p99_ms": float(np.percentile(latencies, 99)), "mean_ms": float(latencies.mean())}
+
+# Creates a temporary working directory holding a copy of config.ini, and makes it the current directory so the cogs
+# read and write their data there.
+class Workspace:
+    def __enter__(self):
+        self.previous = os.getcwd()
+        self.path = tempfile.mkdtemp(prefix="sainjubot-bench-")
+        shutil.copy(os.path.join(REPO_ROOT, "config.ini"), self.path)
+        os.makedirs(os.path.join(self.path, "data"))
+        os.chdir(self.path)
+        return self
+
+    def write_faqs(self, faqs):
+        with open(os.path.join(self.path, "data", "faq.json"), "w") as file:
+            json.dump(faqs, file)
+
+    def __exit__(self, *exc):
+        os.chdir(self.previous)
+        shutil.rmtree(self.path, ignore_errors=True)
+
+# Replaces the sentence_transformers module with one whose SentenceTransformer is the hashing stand-in, unless a real
+# model name was given. Must be called before the FAQ cog is imported.
+def install_model(args):
+    if args.model != "hashing":
+        return
+    module = types.ModuleType("sentence_transformers")
+    module.SentenceTransformer = lambda name: HashingModel(name, latency_ms=args.model_latency_ms)
+    sys.modules["sentence_transformers"] = module
+
+# Helper function to create and load an FAQ cog the way the bot would, wait for its model to warm up, and load the
+# FAQ of the bot's first server.
+async def load_faq_cog(bot):
+    from cogs.faq import Faq
+    cog = Faq(bot)
+    await cog.cog_load()
+    await cog.warm_up()
+    await cog.namespace(bot.guilds[0] if bot.guilds else None)
+    return cog
+
+# Measures how quickly the FAQ cog handles messages, both one at a time and with many arriving at once.
+async def bench_faq(args, rng):
+    faqs = make_faqs(args.faq_size, rng)
+    with Workspace() as workspace:
+        workspace.write_faqs(faqs)
+        guild = FakeGuild(channel_names=["general"])
+        bot = FakeBot([guild])
+        cog = await load_faq_cog(bot)
+        channel = guild.text_channels[0]
+
+        # These phases measure matching latency, so turn off the channel window and the cooldowns (see bench_burst).
+        cog.coalescer.WINDOW = 0
+        cog.user_cooldown.WINDOW = cog.reply_cooldown.WINDOW = 0
+        cog.channel_replies.LIMIT = args.messages * 3
+
+        def message(i):
+            if i % 3 == 0:
+                text = rng.choice(CHATTER)
+            else:
+                text = paraphrase(rng.choice(faqs), rng) + f" (try {i})"
+            return FakeMessage(text, guild.add_member(f"student{i}"), channel, guild)
+
+        async def timed(msg):
+            start = time.perf_counter()
+            await cog.on_message(msg)
+            return time.perf_counter() - start
+
+        results = {}
+        sequential = [await timed(message(i)) for i in range(args.messages)]
+        results["sequential"] = summarize(sequential)
+
+        calls_before = cog.model.calls
+        start = time.perf_counter()
+        concurrent = []
+        for offset in range(0, args.messages, args.concurrency):
+            burst = [message(i) for i in range(offset, min(offset + args.concurrency, args.messages))]
+            concurrent.extend(await asyncio.gather(*(timed(msg) for msg in burst)))
+        elapsed = time.perf_counter() - start
+        results["concurrent"] = summarize(concurrent)
+        results["concurrent"]["messages_per_sec"] = args.messages / elapsed
+        results["concurrent"]["model_calls"] = cog.model.calls - calls_before
+
+        repeated = [FakeMessage(paraphrase(faqs[0], rng), guild.add_member("student"), channel, guild)
+                    for _ in range(args.messages)]
+        results["repeated"] = summarize([await timed(msg) for msg in repeated])
+        results["filtered"] = cog.filtered_count
+        results["cache_hits"] = cog.cache.hits
+        await cog.cog_unload()
+    return results
+
+# Floods a few channels with questions from many users at once, as after an announcement, using the channel window,
+# cooldowns and reply limit from config.ini. Reports how many model calls and replies the flood cost.
+async def bench_burst(args, rng):
+    faqs = make_faqs(args.faq_size, rng)
+    with Workspace() as workspace:
+        workspace.write_faqs(faqs)
+        guild = FakeGuild(channel_names=[f"section-{i}" for i in range(args.burst_channels)])
+        cog = await load_faq_cog(FakeBot([guild]))
+        popular = [rng.choice(faqs) for _ in range(5)]
+
+        messages = []
+        for i in range(args.messages):
+            channel = guild.text_channels[i % len(guild.text_channels)]
+            author = guild.add_member(f"student{i % (args.messages // 2 or 1)}")
+            messages.append(FakeMessage(paraphrase(rng.choice(popular), rng), author, channel, guild))
+
+        calls_before, texts_before = cog.model.calls, cog.model.texts
+        start = time.perf_counter()
+        await asyncio.gather(*(cog.on_message(msg) for msg in messages))
+        elapsed = time.perf_counter() - start
+        results = {"messages": len(messages), "elapsed_s": elapsed,
+                   "model_calls": cog.model.calls - calls_before, "texts_encoded": cog.model.texts - texts_before,
+                   "replies": sum(len(msg.replies) for msg in messages), "suppressed": cog.suppressed_count,
+                   "dropped": cog.coalescer.dropped_count}
+        await cog.cog_unload()
+    return results
+
+# Sends questions from many servers, each with its own FAQ, to measure the cost of loading a server's FAQ on its
+# first message and the memory the loaded FAQs take with each storage type. Finally every namespace is left idle
+# long enough to be evicted.
+async def bench_guilds(args, rng):
+    results = {}
+    for dtype in ("float32", "float16", "int8"):
+        with Workspace() as workspace:
+            workspace.write_faqs(make_faqs(args.faq_size, rng))
+            guilds = [FakeGuild(channel_names=["general"]) for _ in range(args.guilds)]
+            cog = await load_faq_cog(FakeBot(guilds))
+            cog.INDEX_DTYPE = dtype
+            cog.namespaces.clear()
+            cog.coalescer.WINDOW = cog.user_cooldown.WINDOW = 0
+
+            async def ask(guild):
+                message = FakeMessage("How do I submit the lab for section 3?", guild.add_member("student"),
+                                      guild.text_channels[0], guild)
+                start = time.perf_counter()
+                await cog.on_message(message)
+                return time.perf_counter() - start
+
+            first = [await ask(guild) for guild in guilds]
+            warm = [await ask(guild) for guild in guilds]
+            memory = sum(namespace.index.nbytes() for namespace in cog.namespaces.values())
+
+            cog.NAMESPACE_IDLE = 0
+            await cog.evict_namespaces()
+            results[dtype] = {"first_message": summarize(first), "warm_message": summarize(warm),
+                              "index_kib": memory / 1024, "loaded_after_eviction": len(cog.namespaces)}
+            await cog.cog_unload()
+    return results
+
+# Measures how long redeeming a token takes as the number of stored tokens grows.
+async def bench_redeem(args, rng):
+    from cogs.rolebot import Rolebot
+    results = {}
+    for size in args.token_sizes:
+        with Workspace():
+            guild = FakeGuild(role_names=["CSCI 1170", "Lab"], channel_names=["rolebot"])
+            cog = Rolebot(FakeBot([guild]))
+            tokens = await cog.generate_unique_tokens(size)
+            await cog.tokens.add("CSCI 1170", tokens)
+            channel = guild.text_channels[0]
+
+            async def redeem(token):
+                interaction = FakeInteraction(guild.add_member("student"), guild, channel, "redeem_token")
+                start = time.perf_counter()
+                await cog.redeem_token.callback(cog, interaction, token)
+                return time.perf_counter() - start
+
+            valid = [await redeem(rng.choice(tokens)) for _ in range(args.redeems)]
+            invalid = [await redeem(f"missing{i}") for i in range(args.redeems)]
+            results[str(size)] = {"valid": summarize(valid), "invalid": summarize(invalid)}
+            cog.tokens.close()
+    return results
+
+# Measures the cost of loading the FAQ (cold and with a warm embedding cache) and of adding an entry, as the number
+# of FAQs grows.
+async def bench_add_faq(args, rng):
+    results = {}
+    for size in args.faq_sizes:
+        faqs = make_faqs(size, rng)
+        with Workspace() as workspace:
+            workspace.write_faqs(faqs)
+            guild = FakeGuild(channel_names=["general"])
+            admin = guild.add_member("admin", administrator=True)
+
+            start = time.perf_counter()
+            cog = await load_faq_cog(FakeBot([guild]))
+            cold = time.perf_counter() - start
+            await cog.cog_unload()
+
+            start = time.perf_counter()
+            cog = await load_faq_cog(FakeBot([guild]))
+            warm = time.perf_counter() - start
+
+            latencies = []
+            for i in range(args.adds):
+                interaction = FakeInteraction(admin, guild, guild.text_channels[0], "add_faq")
+                start = time.perf_counter()
+                await cog.add_faq.callback(cog, interaction, f"What is new question {i}?", f"Answer {i}.")
+                latencies.append(time.perf_counter() - start)
+            await cog.cog_unload()
+            results[str(size)] = {"cold_load_s": cold, "warm_load_s": warm, "add": summarize(latencies)}
+    return results
+
+# Compares seeding a course's FAQ one /add_faq at a time with a single /import_faq of the same entries, counting the
+# model calls each takes. A few near-duplicates of existing questions are included in the file.
+async def bench_import(args, rng):
+    existing = make_faqs(args.faq_size, rng)
+    entries = [{"question": f"Where is the {topic} room for week {week}?", "answer": f"Room {week}{index}."}
+               for index, topic in enumerate(TOPICS) for week in range(args.import_size // len(TOPICS) + 1)][:args.import_size]
+    entries[:5] = [{"question": paraphrase(faq, rng), "answer": faq["answer"]} for faq in existing[:5]]
+
+    results = {}
+    for mode in ("add_faq", "import_faq"):
+        with Workspace() as workspace:
+            workspace.write_faqs(existing)
+            guild = FakeGuild(channel_names=["general"])
+            admin = guild.add_member("admin", administrator=True)
+            cog = await load_faq_cog(FakeBot([guild]))
+            calls_before = cog.model.calls
+            start = time.perf_counter()
+            if mode == "add_faq":
+                for entry in entries:
+                    interaction = FakeInteraction(admin, guild, guild.text_channels[0], "add_faq")
+                    await cog.add_faq.callback(cog, interaction, entry["question"], entry["answer"])
+                flagged = None
+            else:
+                interaction = FakeInteraction(admin, guild, guild.text_channels[0], "import_faq")
+                attachment = FakeAttachment("faq.json", json.dumps(entries).encode("utf-8"))
+                await cog.import_faq.callback(cog, interaction, attachment)
+                view = interaction.followup.sent[-1][1]["view"]
+                flagged = len(view.children) == 3
+                button = next(child for child in view.children if getattr(child, "mode", None) == "unique")
+                await button.callback(FakeInteraction(admin, guild, guild.text_channels[0], "import_faq"))
+            elapsed = time.perf_counter() - start
+            namespace = await cog.namespace(guild)
+            results[mode] = {"entries": len(entries), "seconds": elapsed, "model_calls": cog.model.calls - calls_before,
+                             "faq_size_after": len(namespace.faqs), "duplicates_flagged": flagged}
+            await cog.cog_unload()
+    return results
+
+# Measures /faq_search autocomplete latency (one suggestion list per keystroke) and full search latency as the
+# number of FAQs grows.
+async def bench_search(args, rng):
+    results = {}
+    for size in args.faq_sizes:
+        faqs = make_faqs(size, rng)
+        with Workspace() as workspace:
+            workspace.write_faqs(faqs)
+            guild = FakeGuild(channel_names=["general"])
+            cog = await load_faq_cog(FakeBot([guild]))
+            namespace = await cog.namespace(guild)
+            interaction = FakeInteraction(guild.add_member("student"), guild, guild.text_channels[0], "faq_search")
+
+            keystrokes = []
+            searches = []
+            for _ in range(args.searches):
+                question = paraphrase(rng.choice(faqs), rng)
+                for end in range(1, len(question) + 1):
+                    start = time.perf_counter()
+                    await cog.faq_search_autocomplete(interaction, question[:end])
+                    keystrokes.append(time.perf_counter() - start)
+                start = time.perf_counter()
+                await cog.search(namespace, question)
+                searches.append(time.perf_counter() - start)
+            await cog.cog_unload()
+            results[str(size)] = {"autocomplete": summarize(keystrokes), "search": summarize(searches)}
+    return results
+
+# Measures how long a log call blocks the caller with a plain file handler, as the bot used to log, and with the
+# queue handler used now.
+def bench_logging(args):
+    import logging
+    from configparser import ConfigParser
+    from utils.logging_setup import setup_logging, FORMAT, DATE_FORMAT
+
+    results = {}
+    with Workspace():
+        root = logging.getLogger()
+        previous = (root.handlers[:], root.level)
+        logger = logging.getLogger("bench")
+        logger.propagate = False
+        logger.setLevel(logging.INFO)
+
+        def timed(handler):
+            logger.handlers = [handler]
+            latencies = []
+            for i in range(args.log_records):
+                start = time.perf_counter()
+                logger.info("Message %d from %s in #%s", i, "student", "general")
+                latencies.append(time.perf_counter() - start)
+            return summarize(latencies)
+
+        os.makedirs("logs", exist_ok=True)
+        direct = logging.FileHandler("logs/direct.log")
+        direct.setFormatter(logging.Formatter(FORMAT, datefmt=DATE_FORMAT, style="{"))
+        results["file_handler"] = timed(direct)
+        direct.close()
+
+        config = ConfigParser()
+        config.read_dict({"Logging": {"LOG_FILE": "logs/bot.log", "QUEUE_SIZE": str(args.log_records * 2)}})
+        listener = setup_logging(config)
+        queue_handler = root.handlers[0]
+        # Compare writing the file only, so the console does not skew the result.
+        listener.handlers = tuple(handler for handler in listener.handlers if isinstance(handler, logging.FileHandler))
+        results["queue_handler"] = timed(queue_handler)
+        listener.stop()
+        results["queue_handler"]["dropped"] = queue_handler.dropped
+
+        logger.handlers = []
+        root.handlers, root.level = previous
+    return results
+
+# Runs in a fresh interpreter (see bench_startup): imports bot.py and runs its setup_hook with the command tree sync
+# replaced by a no-op, then times the FAQ model warming up in the background, and prints the timings as JSON.
+async def startup_child(args):
+    install_model(args)
+    with Workspace():
+        start = time.perf_counter()
+        import bot
+        imported = time.perf_counter() - start
+
+        async def sync(*_, **__):
+            return []
+        bot.bot.tree.sync = sync
+
+        start = time.perf_counter()
+        await bot.bot.setup_hook()
+        setup = time.perf_counter() - start
+
+        start = time.perf_counter()
+        await bot.bot.get_cog("Faq").warm_up()
+        warm_up = time.perf_counter() - start
+        print(json.dumps({"import_s": imported, "setup_hook_s": setup, "total_s": imported + setup,
+                          "faq_warm_up_s": warm_up}))
+        for cog in list(bot.bot.cogs.values()):
+            await cog.cog_unload()
+
+# Measures cold start up time, which has to run in a new interpreter so nothing is already imported.
+def bench_startup(args):
+    runs = []
+    for _ in range(args.startup_runs):
+        output = subprocess.run([sys.executable, "-m", "benchmarks.run", "--startup-child", "--model", args.model,
+                                 "--model-latency-ms", str(args.model_latency_ms)],
+                                cwd=REPO_ROOT, capture_output=True, text=True, check=True).stdout
+        runs.append(json.loads(output.strip().splitlines()[-1]))
+    return {key: float(np.median([run[key] for run in runs])) for key in runs[0]}
+
+# Helper function to flatten nested results into {"a.b.c": value} so two runs can be compared metric by metric.
+def flatten(results, prefix=""):
+    flat = {}
+    for key, value in results.items():
+        if isinstance(value, dict):
+            flat.update(flatten(value, f"{prefix}{key}."))
+        elif isinstance(value, (int, float)):
+            flat[f"{prefix}{key}"] = value
+    return flat
+
+# Prints how every metric changed relative to an earlier results file.
+def compare(baseline_path, results):
+    with open(baseline_path) as file:
+        baseline = flatten(json.load(file)["results"])
+    for key, value in flatten(results).items():
+        if key in baseline and baseline[key]:
+            print(f"{key:60} {baseline[key]:>12.4f} -> {value:>12.4f} ({value / baseline[key] - 1:+.1%})")
+
+async def run(args):
+    rng = random.Random(args.seed)
+    install_model(args)
+    results = {}
+    if "faq" in args.only:
+        results["faq"] = await bench_faq(args, rng)
+    if "burst" in args.only:
+        results["burst"] = await bench_burst(args, rng)
+    if "guilds" in args.only:
+        results["guilds"] = await bench_guilds(args, rng)
+    if "redeem" in args.only:
+        results["redeem"] = await bench_redeem(args, rng)
+    if "add_faq" in args.only:
+        results["add_faq"] = await bench_add_faq(args, rng)
+    if "import" in args.only:
+        results["import"] = await bench_import(args, rng)
+    if "search" in args.only:
+        results["search"] = await bench_search(args, rng)
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline benchmarks for SainjuBot.")
+    parser.add_argument("--model", default="hashing", help="'hashing' for the stand-in, or a sentence transformer name.")
+    parser.add_argument("--model-latency-ms", type=float, default=5.0)
+    parser.add_argument("--only", nargs="+", default=["faq", "burst", "guilds", "redeem", "add_faq", "import", "search",
+                                                         "logging", "startup"],
+                        choices=["faq", "burst", "guilds", "redeem", "add_faq", "import", "search", "logging",
+                                 "startup"])
+    parser.add_argument("--faq-size", type=int, default=200)
+    parser.add_argument("--messages", type=int, default=300)
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--burst-channels", type=int, default=3)
+    parser.add_argument("--guilds", type=int, default=10)
+    parser.add_argument("--token-sizes", type=int, nargs="+", default=[100, 10000, 100000])
+    parser.add_argument("--redeems", type=int, default=200)
+    parser.add_argument("--faq-sizes", type=int, nargs="+", default=[10, 100, 1000])
+    parser.add_argument("--adds", type=int, default=20)
+    parser.add_argument("--import-size", type=int, default=200)
+    parser.add_argument("--searches", type=int, default=20)
+    parser.add_argument("--log-records", type=int, default=20000)
+    parser.add_argument("--startup-runs", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="Write the results to this JSON file.")
+    parser.add_argument("--compare", help="An earlier results file to compare against.")
+    parser.add_argument("--startup-child", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.startup_child:
+        asyncio.run(startup_child(args))
+        return
+
+    results = asyncio.run(run(args))
+    if "logging" in args.only:
+        results["logging"] = bench_logging(args)
+    if "startup" in args.only:
+        results["startup"] = bench_startup(args)
+
+    report = {"meta": {"time": time.strftime("%Y-%m-%dT%H:%M:%S"), "python": platform.python_version(),
+                       "platform": platform.platform(), "args": {key: value for key, value in vars(args).items()
+                                                                 if key not in ("output", "compare", "startup_child")}},
+              "results": results}
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(report, file, indent=4)
+    else:
+        print(json.dumps(report, indent=4))
+    if args.compare:
+        compare(args.compare, results)
+
+if __name__ == "__main__":
+    main()
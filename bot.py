@@ -3,26 +3,40 @@
 # Description: Creates a discord bot to be used in Dr. Sainju's Discord Server(s).
 import sys
 
-from discord import Intents, Game, app_commands
+from discord import Intents, Game, MemberCacheFlags, app_commands
 import discord.ext.commands as commands
 import dotenv
 from typing import Final
+from configparser import ConfigParser
+import asyncio
+import hashlib
+import json
 import os
 import logging
+import time
+from utils import metrics
+from utils.metrics import registry
+from utils.logging_setup import setup_logging
+from utils.sharding import shards_from_environment, process_label, labelled_path, is_primary
 
-# Create the logs directory if it doesn't exist.
-os.makedirs("logs", exist_ok=True)
+# Record when the process started, so the time taken to come online can be logged.
+STARTED = time.perf_counter()
 
-# Configure logging.
-logging.basicConfig(level=logging.INFO,
-                    format='[{asctime}] - [{levelname}] {name}: {message}',
-                    style="{",
-                    datefmt="%Y-%m-%d %H:%M:%S",
-                    handlers=[logging.StreamHandler(),
-                              logging.FileHandler("logs/bot.log")])
+# Read the settings from config.ini.
+config = ConfigParser()
+config.read("./config.ini")
 
-# Silence noisy logs from discord.py
-logging.getLogger("discord")
+# When started by launcher.py, this process only connects the shards the launcher gave it. Otherwise it connects
+# every shard if SHARD_COUNT is set, or a single unsharded gateway connection if SHARD_COUNT is 0.
+SHARD_IDS, SHARD_COUNT = shards_from_environment()
+if SHARD_IDS is None:
+    SHARD_COUNT = int(config.get("Bot", "SHARD_COUNT", fallback=0)) or None
+PROCESS_LABEL: Final[str] = process_label(SHARD_IDS)
+
+# Configure logging. Log records are handed to a background thread, which writes them to the console and to a
+# rotating log file, so logging never blocks the event loop. The levels of noisy loggers (such as discord.py's)
+# are set in the [Logging] section of config.ini. Each shard process writes its own log file.
+log_listener = setup_logging(config, label=PROCESS_LABEL)
 
 # Create the logger.
 logger = logging.getLogger("bot")
@@ -37,11 +51,56 @@ intents = Intents.default()
 intents.members = True
 intents.message_content = True
 
-class SainjuBot(commands.Bot):
+# Read the metrics settings from config.ini.
+METRICS_FILE: Final[str] = labelled_path(config.get("Metrics", "METRICS_FILE", fallback="logs/metrics.prom"), PROCESS_LABEL)
+METRICS_INTERVAL: Final[float] = float(config.get("Metrics", "METRICS_INTERVAL", fallback=60))
+LAG_INTERVAL: Final[float] = float(config.get("Metrics", "LAG_INTERVAL", fallback=0.5))
+COMMAND_HASH_FILE: Final[str] = config.get("Bot", "COMMAND_HASH_FILE", fallback="./data/command_hash")
+FORCE_SYNC: Final[bool] = config.getboolean("Bot", "FORCE_SYNC", fallback=False)
+MEMBER_CACHE: Final[str] = config.get("Bot", "MEMBER_CACHE", fallback="full")
+
+# Helper function that returns the member caching options for the bot. "full" is discord.py's default: every member of
+# every server is requested (chunked) at start up and kept in memory. "minimal" skips chunking and only caches the bot's
+# own member, which keeps memory and connect time flat on large servers. Features that need every member of a role
+# then fetch them from Discord when needed (see utils/role_jobs.py).
+def member_cache_options():
+    if MEMBER_CACHE == "full":
+        return {}
+    if MEMBER_CACHE == "minimal":
+        return {"chunk_guilds_at_startup": False, "member_cache_flags": MemberCacheFlags.none()}
+    raise ValueError(f"Unknown MEMBER_CACHE mode: {MEMBER_CACHE}")
+
+# Command tree that records when each application command starts, so its latency can be measured once it completes.
+class InstrumentedTree(app_commands.CommandTree):
+    async def interaction_check(self, interaction):
+        interaction.extras["started"] = time.perf_counter()
+        return True
+
+# Helper function to record how long an application command took, labelled with its name and whether it succeeded.
+def record_command(interaction, status):
+    started = interaction.extras.get("started")
+    if started is not None and interaction.command is not None:
+        registry.observe("command_seconds", time.perf_counter() - started,
+                         command=interaction.command.qualified_name, status=status)
+
+# The bot is only sharded when the launcher gave this process its shards or SHARD_COUNT is set, so a single process
+# can connect more servers than one gateway connection allows and the launcher can spread the shards over several
+# processes (see launcher.py). Otherwise it is a plain Bot with a single gateway connection.
+SHARDED: Final[bool] = SHARD_IDS is not None or SHARD_COUNT is not None
+
+class SainjuBot(commands.AutoShardedBot if SHARDED else commands.Bot):
     def __init__(self):
-        super().__init__(command_prefix='/', intents=intents)
+        sharding = {"shard_ids": SHARD_IDS, "shard_count": SHARD_COUNT} if SHARDED else {}
+        super().__init__(command_prefix='/', intents=intents, tree_cls=InstrumentedTree, **sharding,
+                         **member_cache_options())
+        self.background_tasks = []
+        self.started = False
 
     async def setup_hook(self):
+        # Start measuring event loop lag and periodically exporting metrics.
+        self.background_tasks.append(asyncio.create_task(metrics.monitor_loop_lag(LAG_INTERVAL)))
+        self.background_tasks.append(asyncio.create_task(metrics.export_periodically(METRICS_FILE, METRICS_INTERVAL)))
+
         # Load cogs
         extensions = [
             "cogs.utility",
@@ -53,22 +112,75 @@ class SainjuBot(commands.Bot):
             await self.load_extension(ext)
             logger.info(f"Loaded extension: {ext}")
 
-        # Sync application commands (slash commands)
-        await self.tree.sync()
-        logger.info("Commands synced!")
+        # Sync application commands (slash commands), but only if they changed since the last sync. Syncing is a
+        # rate limited global API call, so there is no point repeating it on every start up, and when running as
+        # several shard processes only the one with shard 0 does it.
+        if not is_primary(self):
+            return
+        command_hash = self.command_hash()
+        if FORCE_SYNC or self.read_command_hash() != command_hash:
+            await self.tree.sync()
+            self.write_command_hash(command_hash)
+            logger.info("Commands synced!")
+        else:
+            logger.info("Commands unchanged since the last sync, skipping sync.")
 
-    # Log bot in and set activity to "playing /help"
+    # Hashes the signature of every application command (names, descriptions, parameters, permissions) along with the
+    # application it belongs to, so any change to the commands produces a different hash.
+    def command_hash(self):
+        commands = sorted((command.to_dict() for command in self.tree.get_commands()), key=lambda command: command["name"])
+        payload = json.dumps({"application_id": self.application_id, "commands": commands}, sort_keys=True, default=str)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    # Helper function to read the hash of the commands as they were last synced. Returns None if there isn't one.
+    def read_command_hash(self):
+        try:
+            with open(COMMAND_HASH_FILE, "r") as file:
+                return file.read().strip()
+        except FileNotFoundError:
+            return None
+
+    # Helper function to save the hash of the commands that were just synced.
+    def write_command_hash(self, command_hash):
+        os.makedirs(os.path.dirname(COMMAND_HASH_FILE) or ".", exist_ok=True)
+        with open(COMMAND_HASH_FILE, "w") as file:
+            file.write(command_hash)
+
+    # Log bot in and set activity to "playing /help". The first time, also record how long it took to come online,
+    # which includes chunking every server when the member cache is on.
     async def on_ready(self):
         logger.info(f"Logged in as {self.user}")
+        if not self.started:
+            self.started = True
+            startup = time.perf_counter() - STARTED
+            registry.set("startup_seconds", startup)
+            shards = f"on shards {sorted(self.shards)} of {self.shard_count}" if SHARDED else "unsharded"
+            logger.info(f"Ready {startup:.1f}s after start with {len(self.guilds)} servers {shards} and "
+                        f"{sum(len(guild.members) for guild in self.guilds)} cached members (member cache: {MEMBER_CACHE}).")
         activity = Game("/help")
         await self.change_presence(activity=activity)
 
+    # Count gateway connections, disconnections and resumed sessions, so reconnect storms show up in /stats.
+    async def on_connect(self):
+        registry.increment("gateway_events_total", event="connect")
+
+    async def on_disconnect(self):
+        registry.increment("gateway_events_total", event="disconnect")
+
+    async def on_resumed(self):
+        registry.increment("gateway_events_total", event="resume")
+
+    # Record the latency of every application command that completes successfully.
+    async def on_app_command_completion(self, interaction, command):
+        record_command(interaction, "success")
+
 # Create bot
 bot = SainjuBot()
 
 # Create error handling for when a user tries to access a command they do not have permission to use.
 @bot.tree.error
 async def on_app_command_error(interaction, error):
+    record_command(interaction, "error")
     if isinstance(error, app_commands.MissingPermissions):
         await interaction.response.send_message("You don't have permissions to use this command.", ephemeral=True)
         logger.warning(f"{interaction.user} tried to use '{interaction.command.name}' but they don't have permissions to use this command.")
@@ -77,5 +189,10 @@ async def on_app_command_error(interaction, error):
         logger.error(f"Unexpected error in command '{interaction.command.name}' with error: {error}", exc_info=True)
         raise error
 
-# Run the bot using the token in .env.
-bot.run(token=TOKEN)
\ No newline at end of file
+# Run the bot using the token in .env. discord.py's own log handler is turned off since logging is already set up,
+# and the log listener is stopped on exit so the last records are written.
+if __name__ == "__main__":
+    try:
+        bot.run(token=TOKEN, log_handler=None)
+    finally:
+        log_listener.stop()
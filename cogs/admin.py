@@ -2,29 +2,173 @@
 # File Name: admin.py
 # Description: Creates a few commands for the server Administrators.
 
+import logging
 import discord
 from discord import app_commands
 from discord.ext import commands
+from configparser import ConfigParser
+from utils import channel_reset
+from utils.metrics import registry
+
+logger = logging.getLogger("admin")
 
 # Create a cog for the administrator commands that are separate from the rolebot and faq commands.
+# A ConfigParser reads the channel reset settings from the config.ini file.
 class Admin(commands.Cog):
     def __init__(self, bot):
         self.bot = bot
+        self.config = ConfigParser()
+        self.config.read("./config.ini")
+        self.SCAN_LIMIT = int(self.config.get("Admin", "SCAN_LIMIT", fallback=1000))
+        self.DELETE_CONCURRENCY = int(self.config.get("Admin", "DELETE_CONCURRENCY", fallback=3))
+        self.PROGRESS_INTERVAL = float(self.config.get("Admin", "PROGRESS_INTERVAL", fallback=5))
+
+    # Helper function to format a number of seconds as a short duration, such as "45s", "12m" or "3h 20m".
+    @staticmethod
+    def format_duration(seconds):
+        seconds = int(round(seconds))
+        if seconds < 60:
+            return f"{seconds}s"
+        if seconds < 3600:
+            return f"{seconds // 60}m"
+        return f"{seconds // 3600}h {seconds % 3600 // 60}m"
+
+    # Helper function to format a histogram in seconds as "p50 / p99 (count)" in milliseconds.
+    @staticmethod
+    def format_timing(histogram):
+        return f"{histogram.percentile(50) * 1000:.1f} / {histogram.percentile(99) * 1000:.1f} ms ({histogram.count})"
+
+    # Creates a command to show the bot's runtime statistics: command latency, event loop lag, FAQ inference,
+    # token store timings and gateway reconnects. The same data is exported periodically to logs/metrics.prom.
+    @app_commands.command(name="stats", description="Shows the bot's performance statistics. (ADMINISTRATOR ONLY)")
+    @app_commands.checks.has_permissions(administrator=True)
+    async def stats(self, interaction: discord.Interaction):
+        embed = discord.Embed(title="Bot Statistics", description="Timings are shown as p50 / p99 (count).", color=discord.Color.green())
+
+        # Show the slowest commands first, by p99 latency.
+        commands_timings = sorted(registry.histograms_named("command_seconds"), key=lambda item: -item[1].percentile(99))
+        lines = [f"/{labels['command']} ({labels['status']}): {self.format_timing(histogram)}" for labels, histogram in commands_timings[:10]]
+        embed.add_field(name="Commands", value="\n".join(lines) or "No commands yet.", inline=False)
+
+        lag = registry.histograms_named("event_loop_lag_seconds")
+        value = f"{self.format_timing(lag[0][1])}, max {lag[0][1].max * 1000:.1f} ms" if lag else "Not measured yet."
+        embed.add_field(name="Event Loop Lag", value=value, inline=False)
+
+        lines = []
+        for name, label in (("faq_match_seconds", "Match"), ("inference_batch_seconds", "Batch")):
+            for _, histogram in registry.histograms_named(name):
+                lines.append(f"{label}: {self.format_timing(histogram)}")
+        for _, histogram in registry.histograms_named("inference_batch_size"):
+            lines.append(f"Average batch size: {histogram.sum / histogram.count:.1f}" if histogram.count else "")
+        lines.append(f"Queue depth: {registry.value('inference_queue_depth')}, shed: {registry.value('inference_shed_total')}")
+        embed.add_field(name="FAQ Inference", value="\n".join(line for line in lines if line), inline=False)
+
+        lines = [f"{labels['operation']}: {self.format_timing(histogram)}" for labels, histogram in registry.histograms_named("token_store_seconds")]
+        embed.add_field(name="Token Store", value="\n".join(lines) or "No operations yet.", inline=False)
 
-    # Creates a command to clear all messages from the current channel.
+        # The bot only has shards when it was started by the launcher or SHARD_COUNT is set.
+        shards = getattr(self.bot, "shards", None)
+        shard_line = f"{', '.join(str(shard) for shard in sorted(shards))} of {self.bot.shard_count}" if shards else "not sharded"
+        embed.add_field(name="Gateway", value=(f"Latency: {round(self.bot.latency * 1000)} ms\n"
+                                               f"Shards in this process: {shard_line}\n"
+                                               f"Connects: {registry.value('gateway_events_total', event='connect')}, "
+                                               f"disconnects: {registry.value('gateway_events_total', event='disconnect')}, "
+                                               f"resumes: {registry.value('gateway_events_total', event='resume')}\n"
+                                               f"Start up: {registry.value('startup_seconds'):.1f}s, "
+                                               f"cached members: {sum(len(guild.members) for guild in self.bot.guilds)}"), inline=False)
+        await interaction.response.send_message(embed=embed, ephemeral=True)
+
+    # Creates a command to clear all messages from the current channel. The channel's history is scanned first to
+    # estimate how long each way of clearing it will take, and the administrator then chooses to either purge the
+    # messages or replace the channel with an empty copy of itself.
     @app_commands.command(name="clear_chat", description="Clears all messages from the current channel.")
     @app_commands.checks.has_permissions(administrator=True)
     async def clear_chat(self, interaction: discord.Interaction):
 
-        # Defers the response until after all messages are removed.
+        # Defers the response while the channel history is scanned.
         await interaction.response.defer(ephemeral=True)
+        channel = interaction.channel
+        recent, old, complete = await channel_reset.scan_history(channel, limit=self.SCAN_LIMIT)
+        purge_estimate = self.format_duration(channel_reset.estimate_purge(recent, old))
+        clone_estimate = self.format_duration(channel_reset.CLONE_SECONDS)
+        prefix = "" if complete else "at least "
+
+        # Create the buttons for the two ways of clearing the channel, and one to cancel.
+        class ResetButton(discord.ui.Button):
+            def __init__(self, label, style, mode):
+                super().__init__(label=label, style=style)
+                self.mode = mode
+
+            # The callback method clears the channel using the chosen mode and reports the result.
+            async def callback(self, button_interaction: discord.Interaction):
+                self.view.stop()
+                if self.mode is None:
+                    await button_interaction.response.edit_message(content="The channel has not been cleared.", view=None)
+                    return
+
+                if self.mode == "clone":
+                    await button_interaction.response.edit_message(content=f"Replacing #{channel.name}...", view=None)
+                    try:
+                        new_channel, _ = await channel_reset.clone_and_replace(channel, reason=f"/clear_chat by {button_interaction.user}")
+                    except discord.HTTPException as error:
+                        logger.error(f"Could not replace #{channel.name}: {error}", exc_info=True)
+                        try:
+                            await button_interaction.edit_original_response(content=f"#{channel.name} could not be replaced: {error}")
+                        except discord.HTTPException:
+                            pass
+                        return
+                    # The original channel (and this message with it) is gone, so report back in a new followup.
+                    try:
+                        await button_interaction.followup.send(f"{new_channel.mention} has been replaced with an empty copy.", ephemeral=True)
+                    except discord.HTTPException:
+                        pass
+                    return
+
+                await button_interaction.response.edit_message(content=f"Clearing #{channel.name}...", view=None)
+
+                # Report the progress of the purge by editing the message.
+                async def on_progress(deleted):
+                    try:
+                        await button_interaction.edit_original_response(content=f"Clearing #{channel.name}... {deleted} messages deleted so far.")
+                    except discord.HTTPException:
+                        pass
+
+                cog = self.view.cog
+                try:
+                    deleted = await channel_reset.purge(channel, concurrency=cog.DELETE_CONCURRENCY, on_progress=on_progress,
+                                                        progress_interval=cog.PROGRESS_INTERVAL)
+                except discord.HTTPException as error:
+                    logger.error(f"Could not clear #{channel.name}: {error}", exc_info=True)
+                    try:
+                        await button_interaction.edit_original_response(content=f"Clearing #{channel.name} failed: {error}")
+                    except discord.HTTPException:
+                        pass
+                    return
+
+                # Reports that the operation was successful. The interaction may have expired if the purge took
+                # longer than 15 minutes.
+                try:
+                    await button_interaction.edit_original_response(content=f"All messages in {channel.mention} have been cleared. ({deleted} messages deleted)")
+                except discord.HTTPException:
+                    pass
 
-        # Purges the channel of all content
-        await interaction.channel.purge()
+        # Creates a view for the buttons.
+        class ResetView(discord.ui.View):
+            def __init__(self, cog):
+                super().__init__(timeout=None)
+                self.cog = cog
+                self.add_item(ResetButton(f"Purge messages (~{purge_estimate})", discord.ButtonStyle.danger, "purge"))
+                self.add_item(ResetButton(f"Replace channel (~{clone_estimate})", discord.ButtonStyle.danger, "clone"))
+                self.add_item(ResetButton("Cancel", discord.ButtonStyle.secondary, None))
 
-        # Reports that the operation was successful.
-        await interaction.followup.send(f"All messages in #{interaction.channel.mention} have been cleared.", ephemeral=True)
+        # Prompt the administrator to choose how to clear the channel, showing the estimated duration of each.
+        await interaction.followup.send(
+            f"{channel.mention} has {prefix}{recent + old} messages ({prefix}{old} older than 14 days, which must be deleted one at a time).\n\n"
+            f"**Purge messages** deletes every message and keeps the channel. Estimated time: {prefix}{purge_estimate}.\n"
+            f"**Replace channel** creates an empty copy of the channel with the same settings, permissions and position, "
+            f"then deletes the original. Estimated time: {clone_estimate}.",
+            view=ResetView(self), ephemeral=True)
 
 # Set up the cog to be used for the bot.
 async def setup(bot):
-    await bot.add_cog(Admin(bot))
\ No newline at end of file
+    await bot.add_cog(Admin(bot))
@@ -1,77 +1,473 @@
 # Author: Alec Creasy
-# File Name: bot.py
+# File Name: faq.py
 # Description: Creates the FAQ command to display the frequently asked questions, as well as detect
 # when a question is similar to a previously asked question using Cosine Similarity.
 
+import asyncio
+import logging
+import time
+import os
 import discord
 from discord import app_commands
-from discord.ext import commands
-import os
-import json
-from sentence_transformers import SentenceTransformer, util
+from discord.ext import commands, tasks
 from configparser import ConfigParser
+from utils.inference import InferenceWorker
+from utils.inference_service import InferenceClient
+from utils.faq_namespace import FaqNamespace
+from utils.metrics import registry
+from utils.sharding import INFERENCE_ADDRESS_VARIABLE, is_primary
+from utils.vector_index import build_index
+from utils.burst_control import ChannelCoalescer, Cooldown, RateLimit
+from utils.faq_import import FaqImportError, parse_faq_file, find_duplicates
+from utils.match_cache import MatchCache, normalize_text
+
+logger = logging.getLogger("faq")
+
+# Words that usually start a question even when the asker leaves off the question mark.
+QUESTION_WORDS = {"who", "what", "when", "where", "why", "how", "which", "is", "are", "can", "could", "do", "does",
+                  "did", "should", "will", "would", "may", "am", "was", "were", "has", "have", "anyone", "any"}
 
 # Creates a cog for the FAQ portion of SainjuBot.
-# Creates the cog for the bot, a ConfigParser to read the config.ini file
-# which then reads in the questions and answers from the faq file and creates vectorized embeddings
-# to be used to detecting similar questions asked.
+# Creates the cog for the bot, and a ConfigParser to read the config.ini file. Every server has its own FAQ (see
+# namespace), which starts as a copy of the shared FAQ file and is loaded the first time it is needed. When the bot
+# runs as several shard processes, a server's events all arrive at the same process, so each server's FAQ file is
+# only ever read and written by one process. The sentence transformer used to detect similar questions is loaded in
+# the background once the bot is ready (see warm_up), so the bot can log in without waiting for the model.
 class Faq(commands.Cog):
     def __init__(self, bot):
         self.bot = bot
         self.config = ConfigParser()
         self.config.read("./config.ini")
-        self.model = SentenceTransformer("all-MiniLM-L6-v2")
+        self.MODEL_NAME = self.config.get("FAQ", "MODEL_NAME", fallback="all-MiniLM-L6-v2")
+        self.model = None
+        self.ready = False
+        self.warm_up_task = None
         self.FAQ_FILE = self.config.get("FAQ", "FAQ_FILE", fallback="./data/faq.json")
-        self.faqs = self.load_faq()
-        self.embeddings = self.embed_faqs()
-
-    # Helper function to load all FAQ's from the JSON file. If it does not exist, it will be created.
-    def load_faq(self):
-        if not os.path.exists(self.FAQ_FILE):
-            os.makedirs(os.path.dirname(self.FAQ_FILE), exist_ok=True)
-            with open(self.FAQ_FILE, "w") as file:
-                json.dump([], file)
-        with open(self.FAQ_FILE) as file:
-            return json.load(file)
-
-    # Helper function to save all FAQ's to the JSON file.
-    def save_faq(self):
-        with open(self.FAQ_FILE, 'w') as file:
-            json.dump(self.faqs, file, indent=4)
-
-    # Helper function to create vectorized embeddings for all questions.
-    def embed_faqs(self):
-        questions = [faq["question"] for faq in self.faqs]
-        return self.model.encode(questions, convert_to_tensor=True) if questions else []
-
-    # This command will allow an administrator to add a FAQ to the list of FAQs.
+        self.FAQ_DIR = self.config.get("FAQ", "FAQ_DIR", fallback="./data/faqs")
+        self.NAMESPACE_IDLE = float(self.config.get("FAQ", "NAMESPACE_IDLE", fallback=1800))
+        self.DUPLICATE_THRESHOLD = float(self.config.get("FAQ", "DUPLICATE_THRESHOLD", fallback=0.9))
+        self.MAX_IMPORT_ENTRIES = int(self.config.get("FAQ", "MAX_IMPORT_ENTRIES", fallback=1000))
+        self.MAX_IMPORT_BYTES = int(self.config.get("FAQ", "MAX_IMPORT_BYTES", fallback=1048576))
+        self.BATCH_WINDOW_MS = int(self.config.get("FAQ", "BATCH_WINDOW_MS", fallback=10))
+        self.MAX_BATCH_SIZE = int(self.config.get("FAQ", "MAX_BATCH_SIZE", fallback=32))
+        self.MAX_QUEUE_SIZE = int(self.config.get("FAQ", "MAX_QUEUE_SIZE", fallback=256))
+        # When the launcher runs the bot as several processes, they share one copy of the model through the
+        # inference service instead of each loading their own.
+        self.INFERENCE_ADDRESS = os.getenv(INFERENCE_ADDRESS_VARIABLE, "")
+        if self.INFERENCE_ADDRESS:
+            self.worker = InferenceClient(self.INFERENCE_ADDRESS, max_pending=self.MAX_QUEUE_SIZE)
+        else:
+            self.worker = InferenceWorker(self.model, batch_window=self.BATCH_WINDOW_MS / 1000,
+                                          max_batch_size=self.MAX_BATCH_SIZE, max_queue_size=self.MAX_QUEUE_SIZE)
+        self.SIMILARITY_THRESHOLD = float(self.config.get("FAQ", "SIMILARITY_THRESHOLD", fallback=0.75))
+        self.TOP_K = int(self.config.get("FAQ", "TOP_K", fallback=1))
+        self.INDEX_BACKEND = self.config.get("FAQ", "INDEX_BACKEND", fallback="exact")
+        self.INDEX_DTYPE = self.config.get("FAQ", "INDEX_DTYPE", fallback="float32")
+        self.INDEX_CLUSTERS = int(self.config.get("FAQ", "INDEX_CLUSTERS", fallback=0))
+        self.INDEX_PROBE = int(self.config.get("FAQ", "INDEX_PROBE", fallback=4))
+        self.INDEX_PROBE_FRACTION = float(self.config.get("FAQ", "INDEX_PROBE_FRACTION", fallback=0.05))
+        self.MIN_WORDS = int(self.config.get("FAQ", "MIN_WORDS", fallback=3))
+        self.MAX_LENGTH = int(self.config.get("FAQ", "MAX_LENGTH", fallback=500))
+        self.REQUIRE_QUESTION = self.config.getboolean("FAQ", "REQUIRE_QUESTION", fallback=True)
+        self.ALLOWED_CHANNELS = {name.strip() for name in self.config.get("FAQ", "ALLOWED_CHANNELS", fallback="").split(",")
+                                 if name.strip()}
+        self.CACHE_SIZE = int(self.config.get("FAQ", "CACHE_SIZE", fallback=1024))
+        self.CACHE_TTL = int(self.config.get("FAQ", "CACHE_TTL", fallback=3600))
+        self.SEARCH_CANDIDATES = min(int(self.config.get("FAQ", "SEARCH_CANDIDATES", fallback=25)), 25)
+        self.SEARCH_RESULTS = int(self.config.get("FAQ", "SEARCH_RESULTS", fallback=5))
+        self.PAGE_SIZE = min(int(self.config.get("FAQ", "PAGE_SIZE", fallback=10)), 25)
+        self.CHANNEL_WINDOW_MS = int(self.config.get("FAQ", "CHANNEL_WINDOW_MS", fallback=500))
+        self.CHANNEL_BATCH_SIZE = int(self.config.get("FAQ", "CHANNEL_BATCH_SIZE", fallback=16))
+        self.REPLY_COOLDOWN = float(self.config.get("FAQ", "REPLY_COOLDOWN", fallback=300))
+        self.USER_COOLDOWN = float(self.config.get("FAQ", "USER_COOLDOWN", fallback=10))
+        self.CHANNEL_REPLIES_PER_MINUTE = int(self.config.get("FAQ", "CHANNEL_REPLIES_PER_MINUTE", fallback=6))
+        self.coalescer = ChannelCoalescer(self.worker.encode, window=self.CHANNEL_WINDOW_MS / 1000,
+                                          max_batch_size=self.CHANNEL_BATCH_SIZE)
+        self.reply_cooldown = Cooldown(self.REPLY_COOLDOWN)
+        self.user_cooldown = Cooldown(self.USER_COOLDOWN)
+        self.channel_replies = RateLimit(self.CHANNEL_REPLIES_PER_MINUTE, period=60)
+        self.suppressed_count = 0
+        self.cache = MatchCache(max_size=self.CACHE_SIZE, ttl=self.CACHE_TTL)
+        self.filtered_count = 0
+        self.namespaces = {}
+
+    # Starts the inference worker and the task that drops idle FAQ namespaces once the cog is loaded into the
+    # running bot.
+    async def cog_load(self):
+        self.worker.start()
+        self.evict_namespaces.change_interval(seconds=min(60, self.NAMESPACE_IDLE))
+        self.evict_namespaces.start()
+
+    # Stops the inference worker and writes any unsaved FAQs when the cog is unloaded.
+    async def cog_unload(self):
+        if self.warm_up_task is not None:
+            self.warm_up_task.cancel()
+        self.evict_namespaces.cancel()
+        await self.worker.close()
+        for namespace in list(self.namespaces.values()):
+            await namespace.close()
+
+    # Starts loading the model in the background the first time the bot becomes ready.
+    @commands.Cog.listener()
+    async def on_ready(self):
+        if self.warm_up_task is None:
+            self.warm_up_task = asyncio.create_task(self.warm_up())
+
+    # Loads the sentence transformer on the inference worker's thread. sentence_transformers (and torch with it) is
+    # only imported here, so importing this cog stays fast. Until this finishes, the FAQ features that need the model
+    # report that they are warming up. When sharing the inference service, this instead waits for the connection to
+    # the service and checks it runs the same model, since the embedding caches on disk belong to one model. The
+    # shared FAQ is then indexed once, which writes the embedding cache that every new server's FAQ starts from. With
+    # several processes, only the one handling direct messages does this, so only one process writes the shared FAQ.
+    async def warm_up(self):
+        start = time.perf_counter()
+        loop = asyncio.get_running_loop()
+
+        def load():
+            from sentence_transformers import SentenceTransformer
+            self.model = self.worker.model = SentenceTransformer(self.MODEL_NAME)
+
+        if self.INFERENCE_ADDRESS:
+            model_name = await self.worker.connect()
+            if model_name != self.MODEL_NAME:
+                logger.error(f"The inference service runs {model_name}, but MODEL_NAME is {self.MODEL_NAME}. "
+                             f"FAQ matching is turned off until they match.")
+                return
+        else:
+            await loop.run_in_executor(self.worker.executor, load)
+        self.ready = True
+        logger.info(f"FAQ model loaded in {time.perf_counter() - start:.1f}s.")
+        if is_primary(self.bot):
+            await self.namespace(None)
+
+    # Returns the FAQ namespace for a server (or the shared FAQ file outside of a server), loading its entries if
+    # they are not in memory. Once the model is ready, the question embeddings are loaded and indexed too, unless
+    # "indexed" is False, as for search suggestions, which only need the entries.
+    async def namespace(self, guild, indexed=True):
+        key = guild.id if guild is not None else None
+        namespace = self.namespaces.get(key)
+        if namespace is None:
+            if key is None:
+                namespace = FaqNamespace(key, self.FAQ_FILE, self.MODEL_NAME, self.build_index)
+            else:
+                namespace = FaqNamespace(key, os.path.join(self.FAQ_DIR, f"{key}.json"), self.MODEL_NAME,
+                                         self.build_index, seed_file=self.FAQ_FILE)
+            self.namespaces[key] = namespace
+        namespace.touch()
+
+        if namespace.loaded and (namespace.indexed or not indexed or not self.ready):
+            return namespace
+        async with namespace.lock:
+            if not namespace.loaded:
+                await asyncio.to_thread(namespace.load)
+            if indexed and self.ready and not namespace.indexed:
+                start = time.perf_counter()
+                await self.worker.run_with_encoder(namespace.build)
+                logger.info(f"Indexed {len(namespace)} FAQs for {guild or 'the shared FAQ'} in {time.perf_counter() - start:.2f}s.")
+        return namespace
+
+    # Drops the FAQ namespaces that have not been used for NAMESPACE_IDLE seconds, so memory does not grow with the
+    # number of servers. A dropped namespace is loaded again from disk (using the embedding cache) when next needed.
+    @tasks.loop(seconds=60)
+    async def evict_namespaces(self):
+        for key, namespace in list(self.namespaces.items()):
+            if namespace.idle() >= self.NAMESPACE_IDLE and not namespace.lock.locked():
+                del self.namespaces[key]
+                await namespace.close()
+                logger.info(f"Evicted idle FAQ namespace {key}.")
+
+    # Helper function to build the index backend chosen in config.ini over the given embeddings.
+    def build_index(self, embeddings):
+        return build_index(embeddings, backend=self.INDEX_BACKEND, dtype=self.INDEX_DTYPE,
+                           n_clusters=self.INDEX_CLUSTERS, n_probe=self.INDEX_PROBE,
+                           probe_fraction=self.INDEX_PROBE_FRACTION)
+
+    # Helper function to tell the user the FAQ model is still loading. Returns True if it is, so commands that need
+    # the model can return early.
+    async def warming_up(self, interaction):
+        if self.ready:
+            return False
+        embed = discord.Embed(title="FAQ", description="The FAQ model is still warming up. Please try again in a moment.", color=discord.Color.orange())
+        await interaction.response.send_message(embed=embed, ephemeral=True)
+        return True
+
+    # Helper function that cheaply decides whether a message could be a question worth running through the model.
+    # Messages from bots, outside the allowed channels, with no text (such as attachment-only messages), that are too
+    # short or too long once links and mentions are removed, or that do not look like a question are skipped.
+    def should_check(self, message, text):
+        if message.author.bot:
+            return False
+        if self.ALLOWED_CHANNELS and getattr(message.channel, "name", None) not in self.ALLOWED_CHANNELS:
+            return False
+        if not text or len(message.content) > self.MAX_LENGTH:
+            return False
+        words = text.split()
+        if len(words) < self.MIN_WORDS:
+            return False
+        if self.REQUIRE_QUESTION and "?" not in message.content and words[0] not in QUESTION_WORDS:
+            return False
+        return True
+
+    # This command will allow an administrator to add a FAQ to the list of FAQs. If the question is a near-duplicate of
+    # an existing one, it is only added when "force" is set.
     @app_commands.command(name="add_faq", description="Add a new FAQ question/answer pair. (ADMINISTRATOR ONLY)")
-    @app_commands.describe(question="The question you wish to answer.", answer="The answer to the question.")
+    @app_commands.describe(question="The question you wish to answer.", answer="The answer to the question.",
+                           force="Add the question even if a very similar one already exists.")
     @app_commands.checks.has_permissions(administrator=True)
-    async def add_faq(self, interaction: discord.Interaction, question: str, answer: str):
-        # Adds the FAQ to the list of FAQs and saves it to the JSON file as well as creates an embedding for the
-        # question.
-        self.faqs.append({"question": question, "answer": answer})
-        self.save_faq()
-        self.embeddings = self.embed_faqs()
+    async def add_faq(self, interaction: discord.Interaction, question: str, answer: str, force: bool = False):
+        # The new question cannot be embedded until the model has loaded.
+        if await self.warming_up(interaction):
+            return
+
+        # Loading the server's FAQ and encoding the question can take longer than Discord waits for a response, so
+        # respond now and send the result as a follow up.
+        await interaction.response.defer(ephemeral=True, thinking=True)
+
+        # Creates an embedding for the question. Only the new question is encoded.
+        namespace = await self.namespace(interaction.guild)
+        vector = (await self.worker.encode_many([question]))[0]
+
+        # If a very similar question already exists, report it instead of splitting future matches between the two.
+        duplicates = namespace.index.search(vector, k=1, threshold=self.DUPLICATE_THRESHOLD)
+        if duplicates and not force:
+            existing = namespace.faqs[duplicates[0][0]]
+            embed = discord.Embed(title="Similar FAQ Exists", description=f"This question is {duplicates[0][1]:.0%} similar to an existing FAQ:\n\n"
+                                  f"Question: {existing['question']}\n\nAnswer: {existing['answer']}\n\n"
+                                  f"Run the command again with force set to True to add it anyway.", color=discord.Color.orange())
+            await interaction.followup.send(embed=embed, ephemeral=True)
+            return
+
+        # Adds the FAQ to this server's list of FAQs and saves it to the JSON file, and appends its embedding to the
+        # cache and the index.
+        await namespace.add(question, answer, vector)
+        self.cache.clear()
 
         # Reports success to the command administrator.
         embed = discord.Embed(title="FAQ Entry Added!", description=f"FAQ Entry Added!\n\nQuestion: {question}\n\nAnswer: {answer}", color=discord.Color.green())
-        await interaction.response.send_message(embed=embed, ephemeral=True)
+        await interaction.followup.send(embed=embed, ephemeral=True)
+
+    # This command will allow an administrator to add many FAQs at once from a JSON or CSV file. All the questions are
+    # encoded in one batch and checked for near-duplicates, and the administrator then chooses whether to import
+    # everything or leave the duplicates out. The entries are saved in a single update.
+    @app_commands.command(name="import_faq", description="Import FAQ question/answer pairs from a JSON or CSV file. (ADMINISTRATOR ONLY)")
+    @app_commands.describe(file="A .json list of {\"question\", \"answer\"} objects, or a .csv with question and answer columns.")
+    @app_commands.checks.has_permissions(administrator=True)
+    async def import_faq(self, interaction: discord.Interaction, file: discord.Attachment):
+        # The questions cannot be embedded until the model has loaded.
+        if await self.warming_up(interaction):
+            return
+
+        # Read the entries from the file, reporting any problem to the administrator.
+        await interaction.response.defer(ephemeral=True, thinking=True)
+        try:
+            if file.size > self.MAX_IMPORT_BYTES:
+                raise FaqImportError(f"The file is larger than {self.MAX_IMPORT_BYTES // 1024} KiB.")
+            entries, skipped = parse_faq_file(file.filename, await file.read())
+            if not entries:
+                raise FaqImportError("The file has no complete question/answer pairs.")
+            if len(entries) > self.MAX_IMPORT_ENTRIES:
+                raise FaqImportError(f"The file has {len(entries)} entries, but at most {self.MAX_IMPORT_ENTRIES} can be imported at once.")
+        except FaqImportError as error:
+            embed = discord.Embed(title="FAQ Import", description=str(error), color=discord.Color.red())
+            await interaction.followup.send(embed=embed, ephemeral=True)
+            return
+
+        # Encode every question in one batch, then find the ones that are near-duplicates of an existing FAQ or of
+        # an earlier question in the file.
+        namespace = await self.namespace(interaction.guild)
+        vectors = await self.worker.encode_many([entry["question"] for entry in entries])
+        duplicates = find_duplicates(vectors, namespace.index, self.DUPLICATE_THRESHOLD)
+        faqs = namespace.faqs
 
-    # This command will list all current FAQs.
+        # Create the buttons to import everything, import all but the duplicates, or cancel.
+        class ImportButton(discord.ui.Button):
+            def __init__(self, label, style, mode):
+                super().__init__(label=label, style=style)
+                self.mode = mode
+
+            # The callback method adds the chosen entries to the FAQ and reports how many were imported. The buttons are
+            # removed before the entries are added, since saving them can take longer than Discord waits for a
+            # response.
+            async def callback(self, button_interaction: discord.Interaction):
+                cog = self.view.cog
+                self.view.stop()
+                if self.mode is None:
+                    await button_interaction.response.edit_message(content="Nothing was imported.", embed=None, view=None)
+                    return
+
+                keep = [position for position in range(len(entries)) if self.mode == "all" or position not in duplicates]
+                await button_interaction.response.edit_message(content=f"Importing {len(keep)} FAQ entries...", embed=None, view=None)
+                await namespace.add_many([entries[position] for position in keep], vectors[keep])
+                cog.cache.clear()
+                await button_interaction.edit_original_response(content=f"Imported {len(keep)} FAQ entries.")
+
+        # Creates a view for the buttons.
+        class ImportView(discord.ui.View):
+            def __init__(self, cog):
+                super().__init__(timeout=600)
+                self.cog = cog
+                self.add_item(ImportButton(f"Import all {len(entries)}", discord.ButtonStyle.primary, "all"))
+                if duplicates:
+                    self.add_item(ImportButton(f"Skip {len(duplicates)} duplicates", discord.ButtonStyle.success, "unique"))
+                self.add_item(ImportButton("Cancel", discord.ButtonStyle.secondary, None))
+
+        # Show the administrator what was found, listing the first few near-duplicates.
+        lines = [f"Found {len(entries)} entries in {file.filename}" + (f" ({skipped} incomplete or repeated rows skipped)." if skipped else "."),
+                 f"{len(duplicates)} are near-duplicates (more than {self.DUPLICATE_THRESHOLD:.0%} similar)."]
+        for position, (kind, other, score) in list(duplicates.items())[:10]:
+            similar = faqs[other]["question"] if kind == "existing" else f"{entries[other]['question']} (in the file)"
+            lines.append(f"- {self.field_name(entries[position]['question'])} → {self.field_name(similar)} ({score:.0%})")
+        if len(duplicates) > 10:
+            lines.append(f"...and {len(duplicates) - 10} more.")
+        embed = discord.Embed(title="FAQ Import", description="\n".join(lines)[:4000], color=discord.Color.orange())
+        await interaction.followup.send(embed=embed, view=ImportView(self), ephemeral=True)
+
+    # This command will list all current FAQs, a page at a time.
     @app_commands.command(name="faq", description="Show the list of FAQ's")
     async def show_faq(self, interaction: discord.Interaction):
         # If there are no FAQs, report this to the user and return.
-        if not self.faqs:
+        namespace = await self.namespace(interaction.guild, indexed=False)
+        if not namespace.faqs:
             embed = discord.Embed(title="Frequently Asked Questions", description="No FAQ entries found.", color=discord.Color.red())
             await interaction.response.send_message(embed=embed, ephemeral=True)
             return
 
-        # Display all the FAQs to the user in an embedded message.
+        # An embed holds at most 25 fields and 6000 characters, so split the FAQs into pages.
+        pages = self.paginate(namespace.faqs)
+
+        # Create the buttons to move between pages.
+        class PageButton(discord.ui.Button):
+            def __init__(self, label, step):
+                super().__init__(label=label, style=discord.ButtonStyle.secondary)
+                self.step = step
+
+            # The callback method shows the previous or next page.
+            async def callback(self, button_interaction: discord.Interaction):
+                self.view.page = (self.view.page + self.step) % len(pages)
+                await button_interaction.response.edit_message(embed=self.view.cog.faq_page(pages, self.view.page), view=self.view)
+
+        # Creates a view for the buttons.
+        class PageView(discord.ui.View):
+            def __init__(self, cog):
+                super().__init__(timeout=300)
+                self.cog = cog
+                self.page = 0
+                self.add_item(PageButton("Previous", -1))
+                self.add_item(PageButton("Next", 1))
+
+        # Display the first page of FAQs to the user in an embedded message, with buttons if there is more than one.
+        if len(pages) == 1:
+            await interaction.response.send_message(embed=self.faq_page(pages, 0), ephemeral=True)
+        else:
+            await interaction.response.send_message(embed=self.faq_page(pages, 0), view=PageView(self), ephemeral=True)
+
+    # Helper function to split FAQs into pages of at most PAGE_SIZE entries that fit within an embed's limits.
+    def paginate(self, faqs):
+        pages = [[]]
+        length = 0
+        for faq in faqs:
+            size = len(self.field_name(faq["question"])) + len(self.field_value(faq["answer"]))
+            if len(pages[-1]) >= self.PAGE_SIZE or (pages[-1] and length + size > 5000):
+                pages.append([])
+                length = 0
+            pages[-1].append(faq)
+            length += size
+        return pages
+
+    # Helper function to build the embed showing one page of FAQs.
+    def faq_page(self, pages, page):
         embed = discord.Embed(title="Frequently Asked Questions", color=discord.Color.green())
-        for faq in self.faqs:
-            embed.add_field(name=faq["question"], value=faq["answer"], inline=False)
+        for faq in pages[page]:
+            embed.add_field(name=self.field_name(faq["question"]), value=self.field_value(faq["answer"]), inline=False)
+        if len(pages) > 1:
+            embed.set_footer(text=f"Page {page + 1} of {len(pages)}")
+        return embed
+
+    # Helper functions to shorten text to fit an embed field's name (256 characters) or value (1024 characters).
+    @staticmethod
+    def field_name(text):
+        return text if len(text) <= 256 else text[:255] + "…"
+
+    @staticmethod
+    def field_value(text):
+        return text if len(text) <= 1024 else text[:1023] + "…"
+
+    # This command searches the FAQ. While the user types, suggestions come from the word index (see
+    # faq_search_autocomplete). The results are then reranked by the cosine similarity of their cached embeddings.
+    @app_commands.command(name="faq_search", description="Search the FAQ's")
+    @app_commands.describe(query="What you are looking for. Pick a suggestion or type your own question.")
+    async def faq_search(self, interaction: discord.Interaction, query: str):
+        await interaction.response.defer(ephemeral=True)
+        namespace = await self.namespace(interaction.guild)
+        results = await self.search(namespace, query)
+
+        # If nothing matched, report this to the user and return.
+        if not results:
+            embed = discord.Embed(title="FAQ Search", description=f"No FAQ entries found for \"{query}\".", color=discord.Color.red())
+            await interaction.followup.send(embed=embed, ephemeral=True)
+            return
+
+        # Display the results to the user in an embedded message, best match first.
+        embed = discord.Embed(title="FAQ Search", color=discord.Color.green())
+        for index in results:
+            faq = namespace.faqs[index]
+            embed.add_field(name=self.field_name(faq["question"]), value=self.field_value(faq["answer"]), inline=False)
+        await interaction.followup.send(embed=embed, ephemeral=True)
+
+    # Suggests FAQ questions matching what the user has typed so far. Discord gives autocomplete 3 seconds to respond,
+    # so this only uses the word index and never waits for the model. The value of each suggestion is "faq:<index>",
+    # which lets faq_search tell a picked suggestion apart from typed text.
+    @faq_search.autocomplete("query")
+    async def faq_search_autocomplete(self, interaction: discord.Interaction, current: str):
+        with registry.time("faq_autocomplete_seconds"):
+            namespace = await self.namespace(interaction.guild, indexed=False)
+            return [app_commands.Choice(name=namespace.faqs[index]["question"][:100], value=f"faq:{index}")
+                    for index in namespace.lexicon.search(current, limit=self.SEARCH_CANDIDATES)]
+
+    # Helper function that returns the positions of the FAQs best matching a search, best first. If a suggestion was
+    # picked, it comes first and is followed by the FAQs closest to it, using its cached embedding. Otherwise the
+    # query is embedded and the FAQs sharing words with it are reranked by similarity, along with any FAQ that is
+    # similar enough without sharing words. Before the model has loaded (or if the worker is overloaded), the
+    # results stay in word index order.
+    async def search(self, namespace, query):
+        if query.startswith("faq:") and query[4:].isdigit() and int(query[4:]) < len(namespace.faqs):
+            selected = int(query[4:])
+            candidates = [index for index in namespace.lexicon.search(namespace.faqs[selected]["question"] + " ",
+                                                                      limit=self.SEARCH_CANDIDATES) if index != selected]
+            if namespace.indexed and selected < len(namespace.index):
+                scores = namespace.index.score(namespace.index.vector(selected), candidates)
+                candidates = [candidates[position] for position in (-scores).argsort(kind="stable")]
+            return [selected] + candidates[:self.SEARCH_RESULTS - 1]
+
+        candidates = namespace.lexicon.search(query, limit=self.SEARCH_CANDIDATES)
+        if not namespace.indexed or len(namespace.index) == 0:
+            return candidates[:self.SEARCH_RESULTS]
+        query_embedding = await self.worker.encode(query)
+        if query_embedding is None:
+            return candidates[:self.SEARCH_RESULTS]
+
+        scores = dict(zip(candidates, namespace.index.score(query_embedding, candidates).tolist()))
+        for index, score in namespace.index.search(query_embedding, k=self.SEARCH_RESULTS, threshold=self.SIMILARITY_THRESHOLD):
+            scores[index] = score
+        return sorted(scores, key=lambda index: -scores[index])[:self.SEARCH_RESULTS]
+
+    # This command shows how many messages were filtered out or answered from the cache, to help tune the filter
+    # and cache settings in config.ini.
+    @app_commands.command(name="faq_stats", description="Show FAQ filter and cache statistics. (ADMINISTRATOR ONLY)")
+    @app_commands.checks.has_permissions(administrator=True)
+    async def faq_stats(self, interaction: discord.Interaction):
+        description = (f"Model: {self.MODEL_NAME} ({'ready' if self.ready else 'warming up'})\n"
+                       f"Messages filtered: {self.filtered_count}\n"
+                       f"Cache hits: {self.cache.hits}\n"
+                       f"Cache misses: {self.cache.misses}\n"
+                       f"Cache hit rate: {self.cache.hit_rate():.1%}\n"
+                       f"Cache entries: {len(self.cache)}/{self.cache.MAX_SIZE}\n"
+                       f"Messages shed: {self.worker.shed_count}\n"
+                       f"Messages dropped in bursts: {self.coalescer.dropped_count}\n"
+                       f"Replies suppressed: {self.suppressed_count}\n"
+                       f"FAQ namespaces loaded: {len(self.namespaces)} "
+                       f"({sum(namespace.index.nbytes() for namespace in self.namespaces.values()) / 1024:.0f} KiB of {self.INDEX_DTYPE} embeddings)")
+        embed = discord.Embed(title="FAQ Statistics", description=description, color=discord.Color.green())
         await interaction.response.send_message(embed=embed, ephemeral=True)
 
     # This function sets up a listener for messages. It will be used to detect similar questions to the FAQ if one is
@@ -82,27 +478,73 @@ class Faq(commands.Cog):
         if message.author == self.bot.user:
             return
 
-        # If there are no embeddings (that is, there are no FAQs), return.
-        if self.embeddings is None or len(self.embeddings) == 0:
+        # If the model is still warming up, return.
+        if not self.ready:
             return
 
-        # Get the message itself
+        # Get the message itself, and skip it if it does not look like a question.
         question = message.content
+        text = normalize_text(question)
+        if not self.should_check(message, text):
+            self.filtered_count += 1
+            return
+
+        # Load this server's FAQ if needed. If its index is empty (that is, there are no FAQs), return.
+        namespace = await self.namespace(message.guild)
+        if len(namespace.index) == 0:
+            return
+
+        # Only check one message per user every USER_COOLDOWN seconds, so a single user cannot keep the model busy.
+        if not self.user_cooldown.take(message.author.id):
+            self.suppress("user")
+            return
+
+        # If the same question was asked recently, reuse its result instead of running the model again. The cache's
+        # generation is noted first, so if an FAQ is added while the message is being encoded, the result (which may
+        # have been found in the old index) is not cached.
+        matches = self.cache.get((namespace.key, text))
+        if matches is None:
+            generation = self.cache.generation
+            # Hand the message to the channel's coalescer, which encodes every message sent to the channel within a
+            # short window in one batch, and wait for its vectorized embedding. Then search the index for the FAQs
+            # with the highest cosine similarity to the message. If the channel's window is full or the worker is
+            # overloaded, the message is skipped.
+            with registry.time("faq_match_seconds"):
+                query_embedding = await self.coalescer.submit(message.channel.id, question)
+                if query_embedding is None:
+                    return
+                matches = namespace.index.search(query_embedding, k=self.TOP_K, threshold=self.SIMILARITY_THRESHOLD)
+            self.cache.put((namespace.key, text), matches, generation=generation)
+
+        # Leave out any FAQ that was already given in this channel within the last REPLY_COOLDOWN seconds.
+        channel_id = message.channel.id
+        matches = [match for match in matches if self.reply_cooldown.ready((channel_id, match[0]))]
+
+        # If any FAQ scored above the similarity threshold, report to the user that this question
+        # could be related to those FAQs, unless the channel has used up its replies for the last minute.
+        if matches:
+            if not self.channel_replies.take(channel_id):
+                self.suppress("channel_rate")
+                return
+            for index, _ in matches:
+                self.reply_cooldown.trigger((channel_id, index))
+            await message.reply(self.format_matches(namespace, matches))
+
+    # Helper function to count an auto-reply that was held back, labelled with the reason.
+    def suppress(self, reason):
+        self.suppressed_count += 1
+        registry.increment("faq_suppressed_total", reason=reason)
 
-        # Create a vectorized embedding of the message and get the cosine similarity of each FAQ and current
-        # message. After this, get the highest cosine similarity score.
-        query_embedding = self.model.encode(question, convert_to_tensor=True)
-        scores = util.cos_sim(query_embedding, self.embeddings)[0]
-        best_index = scores.argmax().item()
-        best_score = scores[best_index].item()
-
-        # If the best cosine similarity score is greater than 75%, report to the user that this question
-        # could be related to a FAQ.
-        if best_score > 0.75:
-            match = self.faqs[best_index]
-            await message.reply(
-                f"That sounds similar to an FAQ:\n**Q:** {match['question']}\n**A:** {match['answer']}"
-            )
+    # Helper function to build the reply listing the FAQs a message matched, best match first.
+    def format_matches(self, namespace, matches):
+        faqs = namespace.faqs
+        if len(matches) == 1:
+            match = faqs[matches[0][0]]
+            return f"That sounds similar to an FAQ:\n**Q:** {match['question']}\n**A:** {match['answer']}"
+        lines = ["That sounds similar to these FAQs:"]
+        for index, _ in matches:
+            lines.append(f"**Q:** {faqs[index]['question']}\n**A:** {faqs[index]['answer']}")
+        return "\n\n".join(lines)
 
 # Set up the cog to be used for the bot.
 async def setup(bot):
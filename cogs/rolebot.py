@@ -4,46 +4,104 @@
 
 import discord
 from discord import app_commands
-from discord.ext import commands
-import os
-import json
+from discord.ext import commands, tasks
+import csv
+import io
 import secrets
+from typing import Optional
 from configparser import ConfigParser
+from utils.token_store import TokenStore
+from utils.role_jobs import RoleJobEngine, members_with_role
+from utils.sharding import is_multiprocess
 
 # Creates a cog for the Role Bot portion of SainjuBot.
 # Creates the cog for the bot, a ConfigParser to read the config.ini file
-# which then reads in the tokens file, the channel name the rolebot portion
+# which then reads in the tokens database, the channel name the rolebot portion
 # will redeem tokens in, and the number of bytes for the tokens to be.
-# The tokens are then loaded in and saved to the instance's "tokens" variable.
+# The tokens are then loaded into the instance's token store. If the database does not exist yet,
+# any tokens in the old tokens JSON file are migrated into it. When the bot runs as several shard processes, they all
+# share the token and job databases, so a token generated in one server can be redeemed through any shard.
 class Rolebot(commands.Cog):
     def __init__(self, bot):
         self.bot = bot
         self.config = ConfigParser()
         self.config.read("./config.ini")
         self.TOKENS_FILE = self.config.get("Rolebot", "TOKENS_FILE", fallback="./data/tokens.json")
+        self.TOKENS_DB = self.config.get("Rolebot", "TOKENS_DB", fallback="./data/tokens.db")
         self.ROLE_CHANNEL_NAME = self.config.get("Rolebot", "ROLE_CHANNEL_NAME", fallback="rolebot")
         self.NUM_BYTES = int(self.config.get("Rolebot", "NUM_BYTES", fallback=16))
         self.VISITOR_NAME = self.config.get("Rolebot", "VISITOR_NAME", fallback="Visitor")
-        self.tokens = self.load_tokens()
-
-    # Helper function to load the tokens from the tokens JSON file.
-    # If the file does not exist, create one in the directory specified in config.ini.
-    def load_tokens(self):
-        if not os.path.exists(self.TOKENS_FILE):
-            os.makedirs(os.path.dirname(self.TOKENS_FILE), exist_ok=True)
-            with open(self.TOKENS_FILE, "w") as file:
-                json.dump({}, file)
-        with open(self.TOKENS_FILE, "r") as file:
-            return json.load(file)
-
-    # Helper function to save the tokens to memory. Dumps the current tokens to the tokens JSON file.
-    def save_tokens(self):
-        with open(self.TOKENS_FILE, "w") as file:
-            json.dump(self.tokens, file)
-
-    # Creates a list of unique hexadecimal tokens for the number specified. Used when generating tokens.
-    def generate_unique_tokens(self, count):
-        return [secrets.token_hex(self.NUM_BYTES) for _ in range(count)]
+        self.MAX_TOKENS = int(self.config.get("Rolebot", "MAX_TOKENS", fallback=10000))
+        self.COMPACT_HOURS = float(self.config.get("Rolebot", "COMPACT_HOURS", fallback=6))
+        self.JOBS_FILE = self.config.get("Rolebot", "JOBS_FILE", fallback="./data/role_jobs.json")
+        self.JOBS_DB = self.config.get("Rolebot", "JOBS_DB", fallback="./data/role_jobs.db")
+        self.JOB_CONCURRENCY = int(self.config.get("Rolebot", "JOB_CONCURRENCY", fallback=4))
+        self.PROGRESS_INTERVAL = float(self.config.get("Rolebot", "PROGRESS_INTERVAL", fallback=5))
+        self.tokens = TokenStore(self.TOKENS_DB, legacy_file=self.TOKENS_FILE, shared=is_multiprocess())
+        self.jobs = RoleJobEngine(bot, self.JOBS_DB, concurrency=self.JOB_CONCURRENCY,
+                                  progress_interval=self.PROGRESS_INTERVAL, legacy_file=self.JOBS_FILE)
+
+    # Starts the periodic compaction of the token database once the cog is loaded.
+    async def cog_load(self):
+        self.compact_tokens.change_interval(hours=self.COMPACT_HOURS)
+        self.compact_tokens.start()
+
+    # Stops the compaction task and closes the token and job databases when the cog is unloaded.
+    async def cog_unload(self):
+        self.compact_tokens.cancel()
+        self.tokens.close()
+        self.jobs.close()
+
+    # Resumes any bulk role jobs that were interrupted when the bot last stopped. Runs every time the bot becomes
+    # ready, but jobs that are already running are not started twice.
+    @commands.Cog.listener()
+    async def on_ready(self):
+        await self.jobs.resume_all()
+
+    # Helper function to build the embed reporting the progress of a role job.
+    @staticmethod
+    def job_embed(job, role_name):
+        processed = job.done + job.failed
+        if job.error:
+            description = f"Removing {role_name} stopped after {processed}/{job.total} users because of an error. See the bot log for details."
+            color = discord.Color.red()
+        elif job.pending:
+            description = f"Removing {role_name} from all users... {processed}/{job.total} processed."
+            color = discord.Color.orange()
+        else:
+            description = f"{role_name} removed from all users! {job.done}/{job.total} updated."
+            color = discord.Color.green()
+        if job.failed:
+            description += f"\n{job.failed} could not be updated. See the bot log for details."
+            if not job.pending:
+                color = discord.Color.red()
+        return discord.Embed(title="Role Bot", description=description, color=color)
+
+    # Periodically folds the token database's write-ahead log back into the database file so it does not grow
+    # without bound.
+    @tasks.loop(hours=6)
+    async def compact_tokens(self):
+        await self.tokens.compact()
+
+    # Creates a list of unique hexadecimal tokens for the number specified. Used when generating tokens. The token
+    # store is refreshed once beforehand, so tokens generated by another shard process are also avoided.
+    async def generate_unique_tokens(self, count):
+        await self.tokens.refresh()
+        tokens = set()
+        while len(tokens) < count:
+            token = secrets.token_hex(self.NUM_BYTES)
+            if token not in self.tokens:
+                tokens.add(token)
+        return list(tokens)
+
+    # Helper function to write tokens to a CSV file held in memory, ready to be attached to a message.
+    @staticmethod
+    def tokens_file(role_name, tokens):
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow(["token", "role"])
+        writer.writerows([token, role_name] for token in tokens)
+        return discord.File(io.BytesIO(buffer.getvalue().encode("utf-8")), filename=f"{role_name}_tokens.csv")
 
     # Helper function that will return the roles of the server aside from any managed roles (typically reserved
     # for bots) and the @everyone role.
@@ -57,19 +115,23 @@ class Rolebot(commands.Cog):
         return roles
 
     # This command will allow any administrator to generate the specified number of unique tokens to be used
-    # to claim a role in the server. By default, only one token will be generated but support for multiple one-use tokens can be added by uncommenting
-    # the sections specified in this method as well as the redeem_tokens method.
-    @app_commands.command(name="generate_tokens", description="Generate a token to be redeemed for roles. (ADMINISTATOR ONLY)")
-    # @app_commands.describe(number="The token to be redeemed form a role.") UNCOMMENT THIS TO SUPPORT MULTIPLE TOKENS THAT CAN BE REDEEMED ONLY ONCE
+    # to claim a role in the server. By default, one reusable token is generated. When more than one token is
+    # generated, the tokens are single-use unless specified otherwise, and are sent as a CSV attachment.
+    @app_commands.command(name="generate_tokens", description="Generate tokens to be redeemed for roles. (ADMINISTATOR ONLY)")
+    @app_commands.describe(number="The number of tokens to generate.",
+                           single_use="Whether each token can only be redeemed once. Defaults to yes when generating more than one token.")
     @app_commands.checks.has_permissions(administrator=True)
-    async def generate_tokens(self, interaction: discord.Interaction): #, number: int): UNCOMMENT THIS AND REMOVE THE ): AFTER discord.Interaction TO SUPPORT MULTIPLE TOKENS THAT CAN BE REDEEMED ONLY ONCE
-        # Ensure the user has entered a valid number of tokens to generate (greater than 0). UNCOMMENT THIS  SECTION TO SUPPORT MULTIPLE TOKENS THAT CAN BE REDEEMED ONLY ONCE
-        # if number <= 0:
-        #     embed = discord.Embed(title="Role Bot", description="Invalid number of tokens to generate",
-        #                           color=discord.Color.red())
-        #     await interaction.response.send_message(embed=embed, ephemeral=True)
+    async def generate_tokens(self, interaction: discord.Interaction, number: int = 1, single_use: Optional[bool] = None):
+        # Ensure the user has entered a valid number of tokens to generate (greater than 0 and no more than the
+        # maximum set in config.ini).
+        if number <= 0 or number > self.MAX_TOKENS:
+            embed = discord.Embed(title="Role Bot", description=f"Invalid number of tokens to generate. Please choose between 1 and {self.MAX_TOKENS}.",
+                                  color=discord.Color.red())
+            await interaction.response.send_message(embed=embed, ephemeral=True)
+            return
 
-        number = 1 # IF USING MULTIPLE TOKENS, REMOVE THIS LINE.
+        if single_use is None:
+            single_use = number > 1
 
         # Get the list of roles.
         roles = self.get_roles(interaction.guild.roles)
@@ -84,15 +146,19 @@ class Rolebot(commands.Cog):
 
             # Callback method will trigger when the administrator clicks on a role button. In this case,
             # a list of tokens are generated using the helper function generate_unique_tokens and the tokens
-            # in the instance of the cog are either added to the current list of tokens for that role or, if none
-            # exist yet, are created and added to the dictionary. The tokens are then saved to the tokens JSON file
-            # and a message with the tokens is sent to the administrator that used the command.
+            # are added to the token store for that role, which saves them all to the tokens database at once.
+            # A single token is sent to the administrator in an embed, and any more are sent as a CSV attachment.
             async def callback(self, button_interaction: discord.Interaction):
-                tokens = self.view.cog.generate_unique_tokens(number)
-                self.view.cog.tokens.setdefault(self.role.name, []).extend(tokens)
-                self.view.cog.save_tokens()
-                embed_button = discord.Embed(title="Role Bot", description=f"Token for {self.role.name}:\n" + "\n".join(tokens), color=discord.Color.green())
-                await button_interaction.response.send_message(embed=embed_button, ephemeral=True)
+                await button_interaction.response.defer(ephemeral=True, thinking=True)
+                tokens = await self.view.cog.generate_unique_tokens(number)
+                await self.view.cog.tokens.add(self.role.name, tokens, single_use=single_use)
+                kind = "single-use" if single_use else "reusable"
+                if number == 1:
+                    embed_button = discord.Embed(title="Role Bot", description=f"Token for {self.role.name} ({kind}):\n" + "\n".join(tokens), color=discord.Color.green())
+                    await button_interaction.followup.send(embed=embed_button, ephemeral=True)
+                else:
+                    embed_button = discord.Embed(title="Role Bot", description=f"Generated {number} {kind} tokens for {self.role.name}.", color=discord.Color.green())
+                    await button_interaction.followup.send(embed=embed_button, file=self.view.cog.tokens_file(self.role.name, tokens), ephemeral=True)
                 self.view.stop()
 
         # Creates a view for the buttons to appear.
@@ -126,20 +192,26 @@ class Rolebot(commands.Cog):
             await interaction.response.send_message(embed=embed, ephemeral=True)
             return
 
-        # Get the role associated with the redeemed token. If the user already has the role, report this to them
-        # and return. Otherwise, add the role to them, notify them, and return.
-        for role_name, token_list in self.tokens.items():
-            if token in token_list:
-                role = discord.utils.get(interaction.guild.roles, name=role_name)
-                if role:
-                    if role in interaction.user.roles:
-                        embed = discord.Embed(title="Role Bot", description=f"You already have the **{role_name}** role! The token has not been redeemed.", color=discord.Color.red())
-                        await interaction.response.send_message(embed=embed, ephemeral=True)
-                        return
-
-                    await interaction.user.add_roles(role)
-                    # self.tokens[role_name].remove(token) UNCOMMENT THESE 2 LINES TO SUPPORT MULTIPLE TOKENS THAT CAN BE REDEEMED ONLY ONCE
-                    # self.save_tokens()
+        # Look up the role associated with the redeemed token. If the user already has the role, report this to them
+        # and return. Otherwise, claim the token (removing it if it is single-use), add the role to them, notify them,
+        # and return. If another redemption claimed the same single-use token first, it is treated as invalid.
+        role_name = await self.tokens.role_for(token)
+        if role_name is not None:
+            role = discord.utils.get(interaction.guild.roles, name=role_name)
+            if role:
+                if role in interaction.user.roles:
+                    embed = discord.Embed(title="Role Bot", description=f"You already have the **{role_name}** role! The token has not been redeemed.", color=discord.Color.red())
+                    await interaction.response.send_message(embed=embed, ephemeral=True)
+                    return
+
+                single_use = token in self.tokens.single_use
+                if await self.tokens.claim(token):
+                    try:
+                        await interaction.user.add_roles(role)
+                    except discord.HTTPException:
+                        if single_use:
+                            await self.tokens.restore(token, role_name)
+                        raise
                     embed = discord.Embed(title= "Role Bot", description=f"Token redeemed! I've assigned you to the **{role_name}** role!", color=discord.Color.green())
                     await interaction.response.send_message(embed=embed, ephemeral=True)
                     return
@@ -148,7 +220,7 @@ class Rolebot(commands.Cog):
         embed = discord.Embed(title="Role Bot", description=f"I'm sorry, but that token is invalid. Please ensure you have entered it correctly. If the issue persists, please see a server administrator.", color=discord.Color.red())
         await interaction.response.send_message(embed=embed, ephemeral=True)
 
-    # This command clears all token from the tokens JSON file and the tokens dictionary in the instance.
+    # This command clears all tokens from the tokens database and the token store in the instance.
     @app_commands.command(name="clear_tokens", description="Clears all tokens from the database.")
     @app_commands.checks.has_permissions(administrator=True)
     async def clear_tokens(self, interaction: discord.Interaction):
@@ -162,8 +234,7 @@ class Rolebot(commands.Cog):
             # otherwise do not clear the tokens.
             async def callback(self, button_interaction: discord.Interaction):
                 if self.confirmed:
-                    self.view.cog.tokens.clear()
-                    self.view.cog.save_tokens()
+                    await self.view.cog.tokens.clear()
                     embed = discord.Embed(title="Role Bot", description=f"All tokens have been removed!", color=discord.Color.green())
                 else:
                     embed = discord.Embed(title="Role Bot", description=f"Tokens have not been cleared.", color=discord.Color.red())
@@ -196,19 +267,29 @@ class Rolebot(commands.Cog):
                 super().__init__(label=role.name, style=discord.ButtonStyle.danger)
                 self.role = role
 
-            # The callback method will iterate through all the server members and remove the role if they
-            # have the role specified.
+            # The callback method will start a role job that moves every server member with the specified role
+            # to the visitor role. The response is deferred and then edited as the job makes progress.
             async def callback(self, button_interaction: discord.Interaction):
-                visitor_role = discord.utils.get(button_interaction.guild.roles, name=self.view.cog.VISITOR_NAME)
-                members = [member for member in button_interaction.guild.members if self.role in member.roles]
-                for member in members:
-                    await member.remove_roles(self.role)
-                    await member.add_roles(visitor_role)
-
-                # Report that the role has been removed from all users.
-                embed = discord.Embed(title="Role Bot", description=f"{self.role.name} removed from all users!", color=discord.Color.green())
-                await button_interaction.response.send_message(embed=embed, ephemeral=True)
+                cog = self.view.cog
+                role = self.role
                 self.view.stop()
+                await button_interaction.response.defer(ephemeral=True, thinking=True)
+
+                # Find the members with the role, either from the member cache or, if the bot runs without one,
+                # by streaming the member list from Discord.
+                visitor_role = discord.utils.get(button_interaction.guild.roles, name=cog.VISITOR_NAME)
+                members = await members_with_role(button_interaction.guild, role)
+
+                # Report the progress of the job by editing the deferred response. The interaction token expires
+                # after 15 minutes, after which progress is only written to the log.
+                async def on_progress(job):
+                    try:
+                        await button_interaction.edit_original_response(embed=cog.job_embed(job, role.name))
+                    except discord.HTTPException:
+                        pass
+
+                job = await cog.jobs.start(button_interaction.guild, role, visitor_role, members, on_progress=on_progress)
+                await on_progress(job)
 
         # Create a view for the buttons.
         class RemoveRoleView(discord.ui.View):
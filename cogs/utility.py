@@ -23,6 +23,7 @@ class Utility(commands.Cog):
                         "/help: Displays a list of commands.\n"
                         "/ping: Replies with latency to server.\n"
                         "/faq: Displays the FAQ.\n"
+                        "/faq_search: Searches the FAQ, with suggestions as you type.\n"
                         "/redeem_token: Redeems a token for a role.")
 
         # If the user is an administrator, display additional commands they can use.
@@ -30,10 +31,13 @@ class Utility(commands.Cog):
         if is_admin:
             help_message += (f"\n\nAdministrator Commands:\n\n"
                              "/add_faq: Adds a new FAQ question/answer pair.\n"
+                             "/import_faq: Imports FAQ question/answer pairs from a JSON or CSV file.\n"
+                             "/faq_stats: Shows FAQ filter and cache statistics.\n"
                              "/generate_tokens: Generates a given number of tokens to be used to assign roles.\n"
                              "/clear_tokens: Clears tokens from the database.\n"
                              "/remove_roles: Remove the given role from all users.\n"
-                             "/clear_chat: Removes all messages from the current channel.")
+                             "/stats: Shows the bot's performance statistics.\n"
+                             "/clear_chat: Removes all messages from the current channel, or replaces it with an empty copy.")
 
         embed = discord.Embed(title="Help", description=help_message, colour=discord.Colour.green())
         await interaction.response.send_message(embed=embed, ephemeral=True)
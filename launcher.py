@@ -0,0 +1,116 @@
+# Author: Alec Creasy
+# File Name: launcher.py
+# Description: Runs the bot as several processes so it can use every core on the host as it joins more servers. The
+# bot's gateway shards are split into PROCESSES ranges of consecutive shards, and each range is connected by its own
+# copy of bot.py. A single inference service process loads the sentence transformer for all of them (see
+# utils/inference_service.py), and the token and role job databases are shared, so every process sees the same
+# state. Any process that exits is restarted. Run with "python launcher.py" in place of "python bot.py".
+
+import asyncio
+import logging
+import os
+import signal
+import sys
+from configparser import ConfigParser
+from typing import Final
+import discord
+import dotenv
+from utils.logging_setup import setup_logging
+from utils.sharding import SHARD_IDS_VARIABLE, SHARD_COUNT_VARIABLE, INFERENCE_ADDRESS_VARIABLE, shard_ranges
+
+# Read the settings from config.ini and configure logging. The launcher writes its own log file, and each process it
+# starts writes another.
+config = ConfigParser()
+config.read("./config.ini")
+log_listener = setup_logging(config, label="launcher")
+logger = logging.getLogger("launcher")
+
+# Load environment with token and store it in a constant.
+dotenv.load_dotenv()
+TOKEN: Final[str] = os.getenv("TOKEN")
+
+# Read the sharding settings from config.ini. A SHARD_COUNT of 0 uses the number of shards Discord recommends, and
+# PROCESSES of 0 starts one process per core (never more than one per shard). If INFERENCE_ADDRESS is empty, each
+# process loads its own copy of the model instead of sharing the inference service. Processes are started
+# IDENTIFY_DELAY seconds per shard apart, since Discord only lets a bot identify one shard every 5 seconds.
+SHARD_COUNT: Final[int] = int(config.get("Bot", "SHARD_COUNT", fallback=0))
+PROCESSES: Final[int] = int(config.get("Shards", "PROCESSES", fallback=0)) or os.cpu_count() or 1
+INFERENCE_ADDRESS: Final[str] = config.get("Shards", "INFERENCE_ADDRESS", fallback="unix:./data/inference.sock")
+IDENTIFY_DELAY: Final[float] = float(config.get("Shards", "IDENTIFY_DELAY", fallback=5.5))
+RESTART_DELAY: Final[float] = float(config.get("Shards", "RESTART_DELAY", fallback=5))
+
+# Asks Discord how many shards it recommends for the bot.
+async def recommended_shard_count(token):
+    http = discord.http.HTTPClient(asyncio.get_running_loop())
+    try:
+        await http.static_login(token)
+        shards, _ = await http.get_bot_gateway()
+        return shards
+    finally:
+        await http.close()
+
+# Starts the inference service and one bot process per range of shards, and keeps them running until the launcher is
+# stopped.
+class Launcher:
+    def __init__(self):
+        self.processes = {}
+        self.stopping = False
+
+    # Runs a Python child process with the given arguments and extra environment variables after waiting "delay"
+    # seconds, and restarts it RESTART_DELAY seconds after it exits, until the launcher stops.
+    async def supervise(self, name, arguments, variables, delay=0):
+        await asyncio.sleep(delay)
+        environment = dict(os.environ, **variables)
+        while not self.stopping:
+            process = await asyncio.create_subprocess_exec(sys.executable, *arguments, env=environment)
+            self.processes[name] = process
+            logger.info(f"Started {name} (pid {process.pid}).")
+            code = await process.wait()
+            self.processes.pop(name, None)
+            if self.stopping:
+                break
+            logger.warning(f"{name} exited with code {code}, restarting in {RESTART_DELAY}s.")
+            await asyncio.sleep(RESTART_DELAY)
+
+    # Stops restarting processes and asks every running process to shut down.
+    def stop(self):
+        self.stopping = True
+        for process in self.processes.values():
+            if process.returncode is None:
+                process.terminate()
+
+    async def run(self):
+        shard_count = SHARD_COUNT or await recommended_shard_count(TOKEN)
+        ranges = shard_ranges(shard_count, PROCESSES)
+        logger.info(f"Running {shard_count} shards in {len(ranges)} processes.")
+
+        loop = asyncio.get_running_loop()
+        for signal_number in (signal.SIGINT, signal.SIGTERM):
+            try:
+                loop.add_signal_handler(signal_number, self.stop)
+            except NotImplementedError:
+                pass
+
+        tasks = []
+        variables = {}
+        if INFERENCE_ADDRESS:
+            variables[INFERENCE_ADDRESS_VARIABLE] = INFERENCE_ADDRESS
+            tasks.append(asyncio.create_task(self.supervise("inference service", ["-m", "utils.inference_service"], variables)))
+
+        delay = 0
+        for shard_ids in ranges:
+            shard_variables = dict(variables, **{SHARD_IDS_VARIABLE: ",".join(str(shard_id) for shard_id in shard_ids),
+                                                 SHARD_COUNT_VARIABLE: str(shard_count)})
+            tasks.append(asyncio.create_task(self.supervise(f"shards {shard_ids[0]}-{shard_ids[-1]}", ["bot.py"],
+                                                            shard_variables, delay)))
+            delay += IDENTIFY_DELAY * len(shard_ids)
+        await asyncio.gather(*tasks)
+
+if __name__ == "__main__":
+    launcher = Launcher()
+    try:
+        asyncio.run(launcher.run())
+    except KeyboardInterrupt:
+        launcher.stop()
+    finally:
+        log_listener.stop()
@@ -0,0 +1,115 @@
+# Author: Alec Creasy
+# File Name: burst_control.py
+# Description: Helpers that keep the FAQ auto-replies cheap when a channel floods: coalescing each channel's messages
+# so they reach the inference worker together, cooldowns for repeated replies and chatty users, and a cap on replies per channel.
+
+import asyncio
+import logging
+import time
+from collections import deque
+from utils.metrics import registry
+
+logger = logging.getLogger("burst_control")
+
+# Remembers when each key was last let through and refuses it again until WINDOW seconds have passed. Used both for
+# per-user throttling and for not repeating the same FAQ in a channel. Expired keys are dropped once there are more
+# than MAX_SIZE of them, so the dictionary does not grow forever.
+class Cooldown:
+    def __init__(self, window, max_size=10000):
+        self.WINDOW = window
+        self.MAX_SIZE = max_size
+        self.expires = {}
+
+    def __len__(self):
+        return len(self.expires)
+
+    # Returns True if the key is not cooling down. Does not start a new cooldown.
+    def ready(self, key, now=None):
+        now = time.monotonic() if now is None else now
+        return self.expires.get(key, 0) <= now
+
+    # Starts (or restarts) the cooldown for the key.
+    def trigger(self, key, now=None):
+        now = time.monotonic() if now is None else now
+        self.expires[key] = now + self.WINDOW
+        if len(self.expires) > self.MAX_SIZE:
+            self.expires = {key: expires for key, expires in self.expires.items() if expires > now}
+
+    # Returns True and starts the cooldown if the key is not already cooling down.
+    def take(self, key, now=None):
+        now = time.monotonic() if now is None else now
+        if not self.ready(key, now):
+            return False
+        self.trigger(key, now)
+        return True
+
+# Allows at most LIMIT events per key within any PERIOD seconds, such as replies per channel per minute.
+class RateLimit:
+    def __init__(self, limit, period=60.0):
+        self.LIMIT = limit
+        self.PERIOD = period
+        self.events = {}
+
+    # Returns True and records the event if the key is still under its limit.
+    def take(self, key, now=None):
+        now = time.monotonic() if now is None else now
+        events = self.events.setdefault(key, deque())
+        while events and events[0] <= now - self.PERIOD:
+            events.popleft()
+        if len(events) >= self.LIMIT:
+            return False
+        events.append(now)
+        return True
+
+# Collects the messages sent to each channel within WINDOW seconds of the first one and queues them on the inference
+# worker at the same moment. The worker batches everything queued within its own window, so a burst in a channel
+# normally lands in one encode batch (or a few, if it is larger than the worker's MAX_BATCH_SIZE) instead of one per
+# message, while still going through the worker's queue limit. Identical texts in a window are only encoded once, and
+# anything past MAX_BATCH_SIZE messages in a window is dropped (and counted), which bounds the model work a single
+# channel can cause per minute. "encode" is the inference worker's encode method.
+class ChannelCoalescer:
+    def __init__(self, encode, window=0.5, max_batch_size=16):
+        self.encode = encode
+        self.WINDOW = window
+        self.MAX_BATCH_SIZE = max_batch_size
+        self.pending = {}
+        self.tasks = set()
+        self.dropped_count = 0
+
+    # Adds a text to its channel's current window and waits for its embedding. Returns None if the text was dropped
+    # because the window was full, or shed by the inference worker.
+    async def submit(self, channel_id, text):
+        if self.WINDOW <= 0:
+            return await self.encode(text)
+
+        batch = self.pending.get(channel_id)
+        if batch is None:
+            batch = self.pending[channel_id] = {}
+            asyncio.get_running_loop().call_later(self.WINDOW, self._flush, channel_id)
+        if text not in batch:
+            if len(batch) >= self.MAX_BATCH_SIZE:
+                self.dropped_count += 1
+                registry.increment("faq_coalescer_dropped_total")
+                logger.debug(f"Channel {channel_id}'s window is full, dropping a message ({self.dropped_count} dropped so far).")
+                return None
+            batch[text] = asyncio.get_running_loop().create_future()
+        return await asyncio.shield(batch[text])
+
+    # Closes the channel's window and queues all of its texts on the inference worker at once. The task is kept until
+    # it finishes, so it cannot be garbage collected while the texts are being encoded.
+    def _flush(self, channel_id):
+        batch = self.pending.pop(channel_id, None)
+        if batch:
+            task = asyncio.create_task(self._encode(batch))
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+
+    async def _encode(self, batch):
+        results = await asyncio.gather(*(self.encode(text) for text in batch), return_exceptions=True)
+        for future, result in zip(batch.values(), results):
+            if future.done():
+                continue
+            if isinstance(result, BaseException):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
@@ -0,0 +1,135 @@
+# Author: Alec Creasy
+# File Name: channel_reset.py
+# Description: Clears the history of a text channel, either by deleting its messages as quickly as Discord allows or
+# by replacing the channel with a fresh copy of itself.
+
+import asyncio
+import datetime
+import logging
+import time
+import discord
+
+logger = logging.getLogger("channel_reset")
+
+# Discord only allows bulk deletion of messages newer than 14 days, at most 100 at a time. The cutoff is moved an hour
+# earlier so a message cannot age past the limit between the scan and the delete.
+BULK_DELETE_AGE = datetime.timedelta(days=14) - datetime.timedelta(hours=1)
+BULK_DELETE_SIZE = 100
+
+# Rough costs, in seconds, used to estimate how long a reset will take. Bulk deletes and old message deletes are both
+# rate limited to about one request per second per channel, and reading history returns 100 messages per request.
+BULK_DELETE_SECONDS = 1.0
+OLD_DELETE_SECONDS = 1.0
+HISTORY_PAGE_SECONDS = 0.3
+CLONE_SECONDS = 3.0
+
+# Helper function that returns the snowflake ID of the oldest message that can still be bulk deleted.
+def bulk_cutoff():
+    return discord.utils.time_snowflake(discord.utils.utcnow() - BULK_DELETE_AGE)
+
+# Counts up to "limit" messages in the channel, split into those that can be bulk deleted and those that must be
+# deleted one by one. Returns (recent, old, complete), where complete is False if the channel has more messages than
+# were counted.
+async def scan_history(channel, limit=1000):
+    cutoff = bulk_cutoff()
+    recent = old = 0
+    async for message in channel.history(limit=limit + 1):
+        if recent + old == limit:
+            return recent, old, False
+        if message.id >= cutoff:
+            recent += 1
+        else:
+            old += 1
+    return recent, old, True
+
+# Estimates how many seconds purging a channel with the given message counts will take.
+def estimate_purge(recent, old):
+    pages = -(-(recent + old) // BULK_DELETE_SIZE)
+    batches = -(-recent // BULK_DELETE_SIZE)
+    return pages * HISTORY_PAGE_SECONDS + batches * BULK_DELETE_SECONDS + old * OLD_DELETE_SECONDS
+
+# Deletes every message in the channel. Messages newer than 14 days are deleted in bulk batches of 100 as the
+# history is read, and older messages are handed to "concurrency" workers that delete them one by one while the
+# history is still being read. on_progress (if given) is called with the number of messages deleted so far every
+# "progress_interval" seconds. If a bulk delete fails (for example because one of its messages was already deleted),
+# its messages are handed to the workers to delete one by one instead. Returns the number of messages deleted. Errors
+# reading the history (such as missing permissions), and any unexpected error that stops a worker, are raised to the
+# caller.
+async def purge(channel, concurrency=3, on_progress=None, progress_interval=5):
+    cutoff = bulk_cutoff()
+    old_queue = asyncio.Queue(maxsize=concurrency * BULK_DELETE_SIZE)
+    deleted = 0
+
+    # Helper function to wait on the queue of old messages. If a worker stops on an error while waiting, nothing is
+    # left draining the queue, so the error is raised instead of waiting forever.
+    async def wait_for(awaitable):
+        task = asyncio.ensure_future(awaitable)
+        done, _ = await asyncio.wait([task, *workers], return_when=asyncio.FIRST_COMPLETED)
+        if task not in done:
+            task.cancel()
+            for worker in done:
+                worker.result()
+        return task.result()
+
+    async def delete_batch(batch):
+        nonlocal deleted
+        try:
+            await channel.delete_messages(batch)
+            deleted += len(batch)
+        except discord.HTTPException as error:
+            logger.warning(f"Bulk delete of {len(batch)} messages in #{channel.name} failed, deleting them one by one: {error}")
+            for message in batch:
+                await wait_for(old_queue.put(message))
+
+    async def delete_old():
+        nonlocal deleted
+        while True:
+            message = await old_queue.get()
+            try:
+                await message.delete()
+                deleted += 1
+            except discord.NotFound:
+                pass
+            except discord.HTTPException as error:
+                logger.warning(f"Could not delete message {message.id} in #{channel.name}: {error}")
+            finally:
+                old_queue.task_done()
+
+    async def report():
+        while True:
+            await asyncio.sleep(progress_interval)
+            await on_progress(deleted)
+
+    workers = [asyncio.create_task(delete_old()) for _ in range(concurrency)]
+    reporter = asyncio.create_task(report()) if on_progress is not None else None
+    try:
+        batch = []
+        async for message in channel.history(limit=None):
+            if message.id >= cutoff:
+                batch.append(message)
+                if len(batch) == BULK_DELETE_SIZE:
+                    await delete_batch(batch)
+                    batch = []
+            else:
+                await wait_for(old_queue.put(message))
+        if batch:
+            await delete_batch(batch)
+        await wait_for(old_queue.join())
+    finally:
+        for worker in workers:
+            worker.cancel()
+        if reporter is not None:
+            reporter.cancel()
+
+    return deleted
+
+# Replaces the channel with an empty copy that has the same name, category, permissions, topic, position and
+# settings, then deletes the original. This takes the same few requests however long the history is. Returns the
+# new channel along with how many seconds the replacement took.
+async def clone_and_replace(channel, reason=None):
+    start = time.perf_counter()
+    # clone() copies the name, category, permission overwrites, topic, NSFW flag and slowmode, but not the position.
+    new_channel = await channel.clone(reason=reason)
+    await new_channel.edit(position=channel.position, reason=reason)
+    await channel.delete(reason=reason)
+    return new_channel, time.perf_counter() - start
@@ -0,0 +1,141 @@
+# Author: Alec Creasy
+# File Name: embedding_store.py
+# Description: Persists FAQ embeddings next to the FAQ file so the bot only has to encode questions that are new or
+# have changed since the last run.
+
+import hashlib
+import json
+import logging
+import os
+import numpy as np
+
+logger = logging.getLogger("embedding_store")
+
+# Creates a store made of two files next to the FAQ file: a raw float32 matrix ("<faq>.embeddings.f32") that can be
+# memory-mapped without copying, and a JSON manifest ("<faq>.embeddings.json") recording the model name, the
+# embedding dimension, and a hash of the question text for every row. The matrix is only ever appended to, and the
+# manifest is replaced atomically afterwards, so a crash mid-write leaves at most a few unreferenced rows at the end
+# of the matrix which are ignored on the next load. A matrix shorter than its manifest says is rebuilt.
+class EmbeddingStore:
+    def __init__(self, faq_file, model_name):
+        base, _ = os.path.splitext(faq_file)
+        self.DATA_FILE = base + ".embeddings.f32"
+        self.MANIFEST_FILE = base + ".embeddings.json"
+        self.model_name = model_name
+        self.dim = None
+        self.hashes = []
+
+    # Helper function that returns a stable hash of a question's text.
+    @staticmethod
+    def hash_question(question):
+        return hashlib.sha256(question.encode("utf-8")).hexdigest()
+
+    # Helper function to read the manifest. Returns None if it does not exist, is unreadable, or was written by a
+    # different model.
+    def _read_manifest(self):
+        if not os.path.exists(self.MANIFEST_FILE) or not os.path.exists(self.DATA_FILE):
+            return None
+        try:
+            with open(self.MANIFEST_FILE) as file:
+                manifest = json.load(file)
+        except (OSError, ValueError):
+            logger.warning(f"Embedding manifest {self.MANIFEST_FILE} is unreadable, rebuilding the cache.")
+            return None
+        if manifest.get("model") != self.model_name:
+            logger.info(f"Embedding cache was built with {manifest.get('model')}, rebuilding for {self.model_name}.")
+            return None
+        if manifest["hashes"] and os.path.getsize(self.DATA_FILE) < len(manifest["hashes"]) * self._row_bytes(manifest["dim"]):
+            logger.warning(f"Embedding matrix {self.DATA_FILE} is shorter than its manifest, rebuilding the cache.")
+            return None
+        return manifest
+
+    # Helper function that returns the size of one row of the matrix in bytes.
+    @staticmethod
+    def _row_bytes(dim):
+        return dim * np.dtype(np.float32).itemsize
+
+    # Helper function to atomically replace the manifest with the current state of the store.
+    def _write_manifest(self):
+        temp_file = self.MANIFEST_FILE + ".tmp"
+        with open(temp_file, "w") as file:
+            json.dump({"model": self.model_name, "dim": self.dim, "hashes": self.hashes}, file)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temp_file, self.MANIFEST_FILE)
+
+    # Helper function to memory-map the first "rows" rows of the matrix.
+    def _map(self, rows):
+        if rows == 0:
+            return np.zeros((0, self.dim), dtype=np.float32)
+        return np.memmap(self.DATA_FILE, dtype=np.float32, mode="r", shape=(rows, self.dim))
+
+    # Loads the embeddings for the given questions. Rows whose question hash is already in the cache are reused and
+    # only the remaining questions are passed to encode(), a function taking a list of texts and returning a 2D
+    # array. The memory-mapped matrix is returned without copying, so an index that quantizes it can read it a chunk
+    # at a time. Only when the cache has to be rebuilt is the whole float32 matrix briefly held in memory.
+    def load(self, questions, encode):
+        wanted = [self.hash_question(question) for question in questions]
+        manifest = self._read_manifest()
+
+        cached = {}
+        if manifest is not None:
+            self.dim = manifest["dim"]
+            self.hashes = manifest["hashes"]
+            matrix = self._map(len(self.hashes))
+            if self.hashes == wanted:
+                return matrix
+            for row, question_hash in enumerate(self.hashes):
+                cached.setdefault(question_hash, row)
+
+        missing = [index for index, question_hash in enumerate(wanted) if question_hash not in cached]
+        logger.info(f"Embedding cache hit for {len(wanted) - len(missing)} of {len(wanted)} FAQ questions.")
+
+        new_vectors = None
+        if missing:
+            new_vectors = np.asarray(encode([questions[index] for index in missing]), dtype=np.float32)
+            self.dim = new_vectors.shape[1]
+        if self.dim is None:
+            self.hashes = []
+            return np.zeros((0, 0), dtype=np.float32)
+
+        embeddings = np.empty((len(wanted), self.dim), dtype=np.float32)
+        if cached:
+            old_matrix = self._map(len(self.hashes))
+            for index, question_hash in enumerate(wanted):
+                if question_hash in cached:
+                    embeddings[index] = old_matrix[cached[question_hash]]
+            del old_matrix
+        if missing:
+            embeddings[missing] = new_vectors
+            del new_vectors
+
+        self.rewrite(wanted, embeddings)
+        del embeddings
+        return self._map(len(self.hashes))
+
+    # Replaces the whole cache with the given hashes and matrix. Used when rows are reordered or removed.
+    def rewrite(self, hashes, embeddings):
+        temp_file = self.DATA_FILE + ".tmp"
+        with open(temp_file, "wb") as file:
+            file.write(np.ascontiguousarray(embeddings, dtype=np.float32).data)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temp_file, self.DATA_FILE)
+        self.hashes = list(hashes)
+        self._write_manifest()
+
+    # Appends embeddings for the given questions to the end of the cache without touching the existing rows.
+    def append(self, questions, vectors):
+        vectors = np.atleast_2d(np.asarray(vectors, dtype=np.float32))
+        if self.dim is None:
+            self.dim = vectors.shape[1]
+
+        # Drop any rows left over from an interrupted append before writing new ones.
+        with open(self.DATA_FILE, "ab") as file:
+            file.truncate(len(self.hashes) * self._row_bytes(self.dim))
+            file.write(np.ascontiguousarray(vectors).tobytes())
+            file.flush()
+            os.fsync(file.fileno())
+
+        self.hashes.extend(self.hash_question(question) for question in questions)
+        self._write_manifest()
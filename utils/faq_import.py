@@ -0,0 +1,86 @@
+# Author: Alec Creasy
+# File Name: faq_import.py
+# Description: Reads FAQ entries from an uploaded JSON or CSV file for the /import_faq command, and finds questions
+# that are near-duplicates of existing ones or of each other.
+
+import csv
+import io
+import json
+import numpy as np
+from utils.vector_index import normalize
+
+# Raised when an uploaded file cannot be read as FAQ entries. The message is shown to the administrator.
+class FaqImportError(ValueError):
+    pass
+
+# Helper function to pull the question and answer out of one entry, returning None if either is missing.
+def clean_entry(entry):
+    if not isinstance(entry, dict):
+        return None
+    fields = {str(key).strip().lower(): value for key, value in entry.items()}
+    question = str(fields.get("question") or "").strip()
+    answer = str(fields.get("answer") or "").strip()
+    if not question or not answer:
+        return None
+    return {"question": question, "answer": answer}
+
+# Parses the uploaded file into a list of {"question", "answer"} entries, along with the number of rows that were
+# skipped because they were incomplete or repeated a question earlier in the file. JSON files hold a list of objects
+# with "question" and "answer" keys; CSV files have a header row with "question" and "answer" columns, or just two
+# columns in that order.
+def parse_faq_file(filename, data):
+    try:
+        text = data.decode("utf-8-sig")
+    except UnicodeDecodeError:
+        raise FaqImportError("The file is not UTF-8 text.")
+
+    if filename.lower().endswith(".json"):
+        try:
+            rows = json.loads(text)
+        except ValueError as error:
+            raise FaqImportError(f"The file is not valid JSON: {error}")
+        if not isinstance(rows, list):
+            raise FaqImportError("The JSON file must hold a list of entries.")
+    elif filename.lower().endswith(".csv"):
+        lines = list(csv.reader(io.StringIO(text)))
+        if lines and {"question", "answer"} <= {cell.strip().lower() for cell in lines[0]}:
+            header = [cell.strip().lower() for cell in lines[0]]
+            rows = [dict(zip(header, line)) for line in lines[1:]]
+        else:
+            rows = [{"question": line[0], "answer": line[1]} for line in lines if len(line) >= 2]
+    else:
+        raise FaqImportError("Only .json and .csv files can be imported.")
+
+    entries = []
+    seen = set()
+    skipped = 0
+    for row in rows:
+        entry = clean_entry(row)
+        if entry is None or entry["question"].lower() in seen:
+            skipped += 1
+            continue
+        seen.add(entry["question"].lower())
+        entries.append(entry)
+    return entries, skipped
+
+# Finds the new questions that are near-duplicates, returning {position: (kind, other, score)}. "kind" is "existing"
+# if the closest match above the threshold is an existing FAQ (with "other" its position in the FAQ), or "file"
+# if it is an earlier question in the same file.
+def find_duplicates(vectors, index, threshold):
+    vectors = normalize(np.atleast_2d(vectors))
+    duplicates = {}
+    for position, vector in enumerate(vectors):
+        matches = index.search(vector, k=1, threshold=threshold)
+        if matches:
+            duplicates[position] = ("existing", matches[0][0], matches[0][1])
+
+    # Compare the new questions with each other, all at once. Only earlier questions count, so the first of a group
+    # of near-duplicates is kept.
+    similarity = np.tril(vectors @ vectors.T, k=-1)
+    for position in range(len(vectors)):
+        if position in duplicates or position == 0:
+            continue
+        earlier = int(np.argmax(similarity[position, :position]))
+        if similarity[position, earlier] > threshold:
+            duplicates[position] = ("file", earlier, float(similarity[position, earlier]))
+    return duplicates
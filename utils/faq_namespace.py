@@ -0,0 +1,101 @@
+# Author: Alec Creasy
+# File Name: faq_namespace.py
+# Description: One server's FAQ: its entries, the word index used for search suggestions, and the vector index of its
+# question embeddings. The FAQ cog keeps a namespace per server, loading each one when it is first needed and
+# dropping it again when the server goes quiet.
+
+import asyncio
+import os
+import shutil
+import time
+import numpy as np
+from utils.embedding_store import EmbeddingStore
+from utils.json_store import JsonStore, read_json
+from utils.lexical_index import LexicalIndex
+
+# Creates the namespace for the FAQ stored in "faq_file". If that file does not exist yet, it starts as a copy of
+# "seed_file" (the shared FAQ file), along with its embedding cache, so every server begins with the shared FAQ
+# without encoding it again. "make_index" builds the configured index backend over a matrix of embeddings.
+class FaqNamespace:
+    def __init__(self, key, faq_file, model_name, make_index, seed_file=None):
+        self.key = key
+        self.FAQ_FILE = faq_file
+        self.SEED_FILE = seed_file
+        self.make_index = make_index
+        self.faq_store = JsonStore(faq_file, default=[], indent=4)
+        self.store = EmbeddingStore(faq_file, model_name)
+        self.faqs = []
+        self.lexicon = LexicalIndex()
+        self.index = make_index([])
+        self.loaded = False
+        self.indexed = False
+        self.lock = asyncio.Lock()
+        self.last_used = time.monotonic()
+
+    def __len__(self):
+        return len(self.faqs)
+
+    # Records that the namespace was just used, so it is not evicted.
+    def touch(self):
+        self.last_used = time.monotonic()
+
+    # Returns how many seconds have passed since the namespace was last used.
+    def idle(self):
+        return time.monotonic() - self.last_used
+
+    # Reads the FAQ file and builds the word index. Runs on a worker thread.
+    def load(self):
+        if self.SEED_FILE is not None and not os.path.exists(self.FAQ_FILE):
+            os.makedirs(os.path.dirname(self.FAQ_FILE) or ".", exist_ok=True)
+            self.faq_store.default = read_json(self.SEED_FILE, [])
+            seed_store = EmbeddingStore(self.SEED_FILE, self.store.model_name)
+            if os.path.exists(seed_store.MANIFEST_FILE) and os.path.exists(seed_store.DATA_FILE):
+                self._copy(seed_store.DATA_FILE, self.store.DATA_FILE)
+                self._copy(seed_store.MANIFEST_FILE, self.store.MANIFEST_FILE)
+        self.faqs = self.faq_store.load()
+        self.lexicon = LexicalIndex(faq["question"] for faq in self.faqs)
+        self.loaded = True
+
+    # Helper function to copy a file through a temporary file, so a crash mid-copy never leaves a partial file behind.
+    # The matrix is copied before the manifest, so a crash between the two leaves no manifest and the questions are
+    # encoded again.
+    @staticmethod
+    def _copy(source, destination):
+        temp_file = destination + ".tmp"
+        shutil.copyfile(source, temp_file)
+        os.replace(temp_file, destination)
+
+    # Loads the question embeddings (encoding only the questions missing from the on-disk cache) and builds the
+    # vector index over them. Runs on the inference worker's thread, since "encode" calls the model.
+    def build(self, encode):
+        questions = [faq["question"] for faq in self.faqs]
+        self.index = self.make_index(self.store.load(questions, encode))
+        self.indexed = True
+
+    # Adds an entry whose question has already been encoded, saving it and updating both indexes.
+    async def add(self, question, answer, vector):
+        await self.add_many([{"question": question, "answer": answer}], np.atleast_2d(vector))
+
+    # Adds several entries whose questions have already been encoded (one row of "vectors" each). The FAQ file and
+    # the embedding cache are each written once for the whole batch. The embedding cache is written on a worker
+    # thread, holding the namespace's lock so it cannot overlap another write or a build, and the entries only join
+    # the FAQ and the indexes once it has been written. If the vector index has grown enough to need rebuilding, the
+    # rebuild also runs on a worker thread, and the new index replaces the old one once it is ready.
+    async def add_many(self, entries, vectors):
+        if not entries:
+            return
+        async with self.lock:
+            await asyncio.to_thread(self.store.append, [entry["question"] for entry in entries], vectors)
+            self.faqs.extend(entries)
+            self.faq_store.save()
+            self.index.add(vectors)
+            for entry in entries:
+                self.lexicon.add(entry["question"])
+            index = await asyncio.to_thread(self.index.rebuild)
+            if index is not None:
+                self.index = index
+
+    # Writes any unsaved entries. Called before the namespace is dropped.
+    async def close(self):
+        if self.faq_store.dirty or (self.faq_store.flush_task is not None and not self.faq_store.flush_task.done()):
+            await self.faq_store.flush()
@@ -0,0 +1,136 @@
+# Author: Alec Creasy
+# File Name: inference.py
+# Description: Runs the sentence transformer on a dedicated worker thread so the discord.py event loop never blocks
+# on a forward pass. Messages that arrive within a short window are batched into a single encode call.
+
+import asyncio
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+from utils.metrics import registry, SIZE_BUCKETS
+
+logger = logging.getLogger("inference")
+
+# Creates a worker that owns the model and a queue of pending texts. Callers hand text to encode() and await the
+# resulting embedding. The worker collects everything queued within BATCH_WINDOW seconds (up to MAX_BATCH_SIZE texts)
+# and encodes it in one call on a background thread. If more than MAX_QUEUE_SIZE texts are waiting, new ones are
+# shed instead of queued so a burst of messages cannot grow the backlog without bound.
+class InferenceWorker:
+    def __init__(self, model, batch_window=0.01, max_batch_size=32, max_queue_size=256):
+        self.model = model
+        self.BATCH_WINDOW = batch_window
+        self.MAX_BATCH_SIZE = max_batch_size
+        self.MAX_QUEUE_SIZE = max_queue_size
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="inference")
+        self.queue = None
+        self.task = None
+        self.shed_count = 0
+
+    # Starts the batching loop. This must be called from within the running event loop.
+    def start(self):
+        if self.task is not None:
+            return
+        self.queue = asyncio.Queue(maxsize=self.MAX_QUEUE_SIZE)
+        self.task = asyncio.create_task(self._run(), name="inference-worker")
+
+    # Stops the batching loop, cancels every text still waiting (including the batch being encoded) and any bulk work
+    # that has not started, and shuts down the worker thread, so no caller is left waiting forever.
+    async def close(self):
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+
+        while self.queue is not None and not self.queue.empty():
+            _, future = self.queue.get_nowait()
+            if not future.done():
+                future.cancel()
+
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+    # Returns the number of texts currently waiting to be encoded.
+    def depth(self):
+        return self.queue.qsize() if self.queue is not None else 0
+
+    # Queues a text to be encoded and waits for its normalized embedding. Returns None if the queue is full and the
+    # text was shed.
+    async def encode(self, text):
+        if self.queue is None:
+            self.start()
+
+        future = asyncio.get_running_loop().create_future()
+        try:
+            self.queue.put_nowait((text, future))
+        except asyncio.QueueFull:
+            self.shed_count += 1
+            registry.increment("inference_shed_total")
+            if self.shed_count % 100 == 1:
+                logger.warning(f"Inference queue is full, shedding messages ({self.shed_count} shed so far).")
+            return None
+
+        return await future
+
+    # Encodes a list of texts on the worker thread without going through the message queue. Used for one-off bulk
+    # work (such as embedding a new FAQ) that should still run off the event loop.
+    async def encode_many(self, texts):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, self._encode_batch, texts)
+
+    # Runs function(encode) on the worker thread, where "encode" encodes a list of texts in one call. Used for work
+    # such as indexing an FAQ, which encodes whatever its embedding cache is missing as it goes.
+    async def run_with_encoder(self, function):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, function, self._encode_batch)
+
+    # Runs on the worker thread. Embeddings are normalized so cosine similarity is a plain dot product.
+    def _encode_batch(self, texts):
+        return self.model.encode(texts, batch_size=max(len(texts), 1), convert_to_numpy=True,
+                                 normalize_embeddings=True, show_progress_bar=False)
+
+    # Waits for the first text in the queue, then gathers whatever else arrives within the batch window and encodes
+    # the whole batch in one call on the worker thread. If the loop is cancelled, any texts it already took from the
+    # queue are cancelled too.
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        batch = []
+        try:
+            while True:
+                batch = [await self.queue.get()]
+                deadline = loop.time() + self.BATCH_WINDOW
+                while len(batch) < self.MAX_BATCH_SIZE:
+                    remaining = deadline - loop.time()
+                    if remaining <= 0:
+                        break
+                    try:
+                        batch.append(await asyncio.wait_for(self.queue.get(), remaining))
+                    except asyncio.TimeoutError:
+                        break
+
+                # Skip any texts whose callers have already given up waiting.
+                batch = [(text, future) for text, future in batch if not future.done()]
+                registry.set("inference_queue_depth", self.queue.qsize())
+                if not batch:
+                    continue
+
+                start = time.perf_counter()
+                try:
+                    vectors = await loop.run_in_executor(self.executor, self._encode_batch, [text for text, _ in batch])
+                    registry.observe("inference_batch_seconds", time.perf_counter() - start)
+                    registry.observe("inference_batch_size", len(batch), buckets=SIZE_BUCKETS)
+                except Exception as error:
+                    logger.error(f"Inference batch of {len(batch)} failed with error: {error}", exc_info=True)
+                    for _, future in batch:
+                        if not future.done():
+                            future.set_exception(error)
+                    continue
+
+                for (_, future), vector in zip(batch, vectors):
+                    if not future.done():
+                        future.set_result(vector)
+        finally:
+            for _, future in batch:
+                if not future.done():
+                    future.cancel()
@@ -0,0 +1,396 @@
+# Author: Alec Creasy
+# File Name: inference_service.py
+# Description: Shares one copy of the sentence transformer between the bot's shard processes (see launcher.py). The
+# service process owns the model and an InferenceWorker, and each shard process sends it texts over a local socket
+# through an InferenceClient, which the FAQ cog uses in place of its own InferenceWorker. Since every process's
+# messages go through the same worker, messages from different shards are batched together as well.
+# The launcher starts the service, but it can also be run on its own with "python -m utils.inference_service".
+
+import asyncio
+import itertools
+import json
+import logging
+import os
+import signal
+import struct
+import time
+from concurrent.futures import ThreadPoolExecutor
+from configparser import ConfigParser
+import numpy as np
+from utils import metrics
+from utils.inference import InferenceWorker
+from utils.logging_setup import setup_logging
+from utils.metrics import registry
+from utils.sharding import INFERENCE_ADDRESS_VARIABLE, labelled_path
+
+logger = logging.getLogger("inference_service")
+
+# Every message starts with the sizes of its JSON header and its binary body.
+FRAME = struct.Struct(">II")
+MAX_MESSAGE_SIZE = 64 * 1024 * 1024
+
+# Helper function to parse a service address: "unix:<path>" for a Unix domain socket, or "tcp:<host>:<port>" for a
+# local TCP port where Unix sockets are not available (such as on Windows).
+def parse_address(address):
+    kind, _, target = address.partition(":")
+    if kind == "unix" and target:
+        return kind, target
+    if kind == "tcp":
+        host, _, port = target.rpartition(":")
+        if host and port.isdigit():
+            return kind, (host, int(port))
+    raise ValueError(f"Invalid inference service address: {address}")
+
+# Helper function to open a connection to the service at "address".
+async def open_connection(address):
+    kind, target = parse_address(address)
+    if kind == "unix":
+        return await asyncio.open_unix_connection(target)
+    return await asyncio.open_connection(*target)
+
+# Helper function to write one message: a JSON header and an optional binary body holding embeddings.
+def write_message(writer, header, body=b""):
+    header = json.dumps(header).encode("utf-8")
+    writer.write(FRAME.pack(len(header), len(body)) + header + body)
+
+# Helper function to read one message written by write_message. Raises asyncio.IncompleteReadError once the other
+# side closes the connection.
+async def read_message(reader):
+    header_size, body_size = FRAME.unpack(await reader.readexactly(FRAME.size))
+    if header_size + body_size > MAX_MESSAGE_SIZE:
+        raise ConnectionError(f"Message of {header_size + body_size} bytes is too large.")
+    header = json.loads(await reader.readexactly(header_size))
+    body = await reader.readexactly(body_size) if body_size else b""
+    return header, body
+
+# Helper function to turn a response back into a float32 matrix of embeddings, one row per text.
+def decode_vectors(header, body):
+    return np.frombuffer(body, dtype=np.float32).reshape(header["shape"]).copy()
+
+# Serves the worker's model at "address". Each connection can have any number of requests in flight. Every request
+# is handled in its own task and answered (matched by its "id") as soon as its embeddings are ready, so a bulk
+# request, such as an FAQ import, does not hold up the messages behind it.
+class InferenceServer:
+    def __init__(self, worker, address, model_name):
+        self.worker = worker
+        self.ADDRESS = address
+        self.model_name = model_name
+        self.dim = None
+        self.server = None
+        self.handlers = {}
+        self.requests = 0
+        self.texts = 0
+
+    # Starts listening. The model's embedding size is found by encoding a probe text, which also makes sure the model
+    # works before any shard connects.
+    async def start(self):
+        self.worker.start()
+        self.dim = int((await self.worker.encode_many(["probe"])).shape[1])
+        kind, target = parse_address(self.ADDRESS)
+        if kind == "unix":
+            # Remove a socket file left behind by a service that did not shut down cleanly, but not one that is
+            # still being served.
+            if os.path.exists(target):
+                try:
+                    _, writer = await open_connection(self.ADDRESS)
+                    writer.close()
+                    raise RuntimeError(f"An inference service is already running at {self.ADDRESS}.")
+                except OSError:
+                    os.remove(target)
+            os.makedirs(os.path.dirname(target) or ".", exist_ok=True)
+            self.server = await asyncio.start_unix_server(self._handle, target)
+        else:
+            self.server = await asyncio.start_server(self._handle, *target)
+        logger.info(f"Serving {self.model_name} at {self.ADDRESS}.")
+
+    # Stops accepting connections, closes the open ones, and shuts down the worker.
+    async def close(self):
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+        for writer in list(self.handlers.values()):
+            writer.close()
+        await asyncio.gather(*self.handlers, return_exceptions=True)
+        await self.worker.close()
+        kind, target = parse_address(self.ADDRESS)
+        if kind == "unix" and os.path.exists(target):
+            os.remove(target)
+
+    # Reads requests from one connection until it closes, answering each in its own task.
+    async def _handle(self, reader, writer):
+        self.handlers[asyncio.current_task()] = writer
+        write_lock = asyncio.Lock()
+        tasks = set()
+        try:
+            while True:
+                request, _ = await read_message(reader)
+                task = asyncio.create_task(self._respond(writer, write_lock, request))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            self.handlers.pop(asyncio.current_task(), None)
+            for task in tasks:
+                task.cancel()
+            writer.close()
+
+    # Answers one request. Single messages ("encode") go through the worker's batching queue, so they are batched
+    # with messages from every other shard, and are shed if the queue is full. Bulk requests ("encode_many") are
+    # encoded in one call.
+    async def _respond(self, writer, write_lock, request):
+        response = {"id": request.get("id")}
+        body = b""
+        try:
+            operation = request.get("op")
+            if operation == "hello":
+                response.update(model=self.model_name, dim=self.dim)
+            elif operation == "status":
+                response.update(connections=len(self.handlers), requests=self.requests, texts=self.texts,
+                                depth=self.worker.depth(), shed=self.worker.shed_count)
+            elif operation in ("encode", "encode_many"):
+                texts = request["texts"]
+                self.requests += 1
+                self.texts += len(texts)
+                if operation == "encode":
+                    vector = await self.worker.encode(texts[0])
+                    vectors = None if vector is None else np.atleast_2d(vector)
+                else:
+                    vectors = await self.worker.encode_many(texts)
+                if vectors is None:
+                    response["shed"] = True
+                else:
+                    vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+                    response["shape"] = list(vectors.shape)
+                    body = vectors.tobytes()
+            else:
+                response["error"] = f"Unknown operation: {operation}"
+        except Exception as error:
+            logger.error(f"Inference request failed with error: {error}", exc_info=True)
+            response["error"] = str(error)
+
+        async with write_lock:
+            if writer.is_closing():
+                return
+            write_message(writer, response, body)
+            try:
+                await writer.drain()
+            except ConnectionError:
+                pass
+
+# Creates a client for the inference service at "address", with the same interface as InferenceWorker: encode()
+# queues a single message and returns None if it was shed, encode_many() encodes a list of texts in one request, and
+# run_with_encoder() runs blocking work that needs to encode texts on a thread of its own. At most MAX_PENDING
+# requests are in flight at once; further messages are shed, as they would be by a full worker queue. If the
+# connection drops, requests in flight fail and the client reconnects in the background.
+class InferenceClient:
+    def __init__(self, address, max_pending=256, retry_interval=1.0):
+        self.ADDRESS = address
+        self.MAX_PENDING = max_pending
+        self.RETRY_INTERVAL = retry_interval
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="inference-client")
+        self.ids = itertools.count()
+        self.pending = {}
+        self.reader = None
+        self.writer = None
+        self.write_lock = None
+        self.read_task = None
+        self.connect_task = None
+        self.closing = False
+        self.model = None
+        self.model_name = None
+        self.dim = None
+        self.shed_count = 0
+
+    # Starts connecting to the service in the background. This must be called from within the running event loop.
+    def start(self):
+        if self.connect_task is None:
+            self.connect_task = asyncio.create_task(self._connect(), name="inference-connect")
+
+    # Waits until the client is connected, and returns the name of the model the service runs.
+    async def connect(self):
+        self.start()
+        await asyncio.shield(self.connect_task)
+        return self.model_name
+
+    # Stops reconnecting, closes the connection, and fails any requests still in flight.
+    async def close(self):
+        self.closing = True
+        for task in (self.connect_task, self.read_task):
+            if task is not None and not task.done():
+                task.cancel()
+                try:
+                    await task
+                except asyncio.CancelledError:
+                    pass
+        self._disconnect()
+        self.executor.shutdown(wait=False)
+
+    # Returns the number of requests waiting for the service.
+    def depth(self):
+        return len(self.pending)
+
+    # Sends a text to be encoded and waits for its normalized embedding. Returns None if the text was shed, either
+    # here or by the service, or if the service could not be reached.
+    async def encode(self, text):
+        if not self.connected() or len(self.pending) >= self.MAX_PENDING:
+            self._shed()
+            return None
+        try:
+            header, body = await self._request({"op": "encode", "texts": [text]})
+        except ConnectionError:
+            self._shed()
+            return None
+        if header.get("shed"):
+            self._shed()
+            return None
+        return decode_vectors(header, body)[0]
+
+    # Encodes a list of texts in one request. Raises ConnectionError if the service cannot be reached.
+    async def encode_many(self, texts):
+        header, body = await self._request({"op": "encode_many", "texts": list(texts)})
+        return decode_vectors(header, body)
+
+    # Runs function(encode) on the client's thread, where "encode" sends a list of texts to the service and blocks
+    # until their embeddings arrive.
+    async def run_with_encoder(self, function):
+        loop = asyncio.get_running_loop()
+
+        def encode(texts):
+            return asyncio.run_coroutine_threadsafe(self.encode_many(texts), loop).result()
+
+        return await loop.run_in_executor(self.executor, function, encode)
+
+    # Returns the service's counters: open connections, requests and texts served, queue depth and texts shed.
+    async def status(self):
+        header, _ = await self._request({"op": "status"})
+        return header
+
+    # Returns True if the client currently has a connection to the service.
+    def connected(self):
+        return self.writer is not None and not self.writer.is_closing()
+
+    # Helper function to count a shed message, logging a warning now and then.
+    def _shed(self):
+        self.shed_count += 1
+        registry.increment("inference_shed_total")
+        if self.shed_count % 100 == 1:
+            logger.warning(f"Inference service is unavailable or full, shedding messages ({self.shed_count} shed so far).")
+
+    # Helper function to connect to the service, retrying every RETRY_INTERVAL seconds until it is up (the service
+    # may still be loading its model), and to ask it which model it runs.
+    async def _connect(self):
+        attempts = 0
+        while True:
+            try:
+                self.reader, self.writer = await open_connection(self.ADDRESS)
+                break
+            except OSError as error:
+                if attempts % 30 == 0:
+                    logger.info(f"Waiting for the inference service at {self.ADDRESS}: {error}")
+                attempts += 1
+                await asyncio.sleep(self.RETRY_INTERVAL)
+        self.write_lock = asyncio.Lock()
+        self.read_task = asyncio.create_task(self._read(), name="inference-read")
+        hello, _ = await self._request({"op": "hello"})
+        self.model_name, self.dim = hello["model"], hello["dim"]
+        logger.info(f"Connected to the inference service at {self.ADDRESS} ({self.model_name}).")
+
+    # Helper function to send a request and wait for its response.
+    async def _request(self, request):
+        if not self.connected():
+            raise ConnectionError("Not connected to the inference service.")
+        request_id = next(self.ids)
+        future = asyncio.get_running_loop().create_future()
+        self.pending[request_id] = future
+        try:
+            async with self.write_lock:
+                write_message(self.writer, dict(request, id=request_id))
+                await self.writer.drain()
+            header, body = await future
+        finally:
+            self.pending.pop(request_id, None)
+        if "error" in header:
+            raise RuntimeError(f"Inference service error: {header['error']}")
+        return header, body
+
+    # Helper function to read responses and hand each to the request waiting for it. If the connection drops, the
+    # requests in flight fail and a new connection is started.
+    async def _read(self):
+        try:
+            while True:
+                header, body = await read_message(self.reader)
+                future = self.pending.get(header.get("id"))
+                if future is not None and not future.done():
+                    future.set_result((header, body))
+        except (asyncio.IncompleteReadError, ConnectionError):
+            logger.warning(f"Lost the connection to the inference service at {self.ADDRESS}, reconnecting.")
+        finally:
+            self._disconnect()
+            if not self.closing:
+                self.connect_task = asyncio.create_task(self._connect(), name="inference-connect")
+
+    # Helper function to close the connection and fail the requests that were waiting on it.
+    def _disconnect(self):
+        if self.writer is not None:
+            self.writer.close()
+        self.reader = self.writer = None
+        for future in self.pending.values():
+            if not future.done():
+                future.set_exception(ConnectionError("Lost the connection to the inference service."))
+
+# Loads the model named in config.ini on the worker's thread and serves it at "address" until the process is asked
+# to stop.
+async def serve(config, address):
+    model_name = config.get("FAQ", "MODEL_NAME", fallback="all-MiniLM-L6-v2")
+    batch_window_ms = int(config.get("FAQ", "BATCH_WINDOW_MS", fallback=10))
+    max_batch_size = int(config.get("FAQ", "MAX_BATCH_SIZE", fallback=32))
+    max_queue_size = int(config.get("FAQ", "MAX_QUEUE_SIZE", fallback=256))
+    metrics_file = labelled_path(config.get("Metrics", "METRICS_FILE", fallback="logs/metrics.prom"), "inference")
+    metrics_interval = float(config.get("Metrics", "METRICS_INTERVAL", fallback=60))
+
+    worker = InferenceWorker(None, batch_window=batch_window_ms / 1000, max_batch_size=max_batch_size,
+                             max_queue_size=max_queue_size)
+    loop = asyncio.get_running_loop()
+
+    def load():
+        from sentence_transformers import SentenceTransformer
+        worker.model = SentenceTransformer(model_name)
+
+    start = time.perf_counter()
+    await loop.run_in_executor(worker.executor, load)
+    logger.info(f"Inference service loaded {model_name} in {time.perf_counter() - start:.1f}s.")
+
+    server = InferenceServer(worker, address, model_name)
+    await server.start()
+    exporter = asyncio.create_task(metrics.export_periodically(metrics_file, metrics_interval))
+
+    stop = asyncio.Event()
+    for signal_number in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(signal_number, stop.set)
+        except NotImplementedError:
+            pass
+    try:
+        await stop.wait()
+    finally:
+        exporter.cancel()
+        await server.close()
+        logger.info("Inference service stopped.")
+
+# Runs the service at the address given by the launcher, or INFERENCE_ADDRESS in config.ini.
+def main():
+    config = ConfigParser()
+    config.read("./config.ini")
+    log_listener = setup_logging(config, label="inference")
+    address = os.getenv(INFERENCE_ADDRESS_VARIABLE) or config.get("Shards", "INFERENCE_ADDRESS",
+                                                                  fallback="unix:./data/inference.sock")
+    try:
+        asyncio.run(serve(config, address))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        log_listener.stop()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,60 @@
+# Author: Alec Creasy
+# File Name: job_store.py
+# Description: Stores unfinished bulk role jobs in a local SQLite database, one row per job, so every shard process
+# can save its own jobs without overwriting the others'.
+
+import asyncio
+import json
+import logging
+import os
+from utils.json_store import read_json
+from utils.sqlite_store import SqliteDatabase
+
+logger = logging.getLogger("job_store")
+
+# Creates the job store. Each job is saved as its own row (its guild, and the job itself as JSON), and every change
+# is written in its own transaction on a worker thread. If the database is new and an old jobs JSON file exists, its
+# jobs are migrated into the database on first load.
+class JobStore:
+    def __init__(self, db_file, legacy_file=None):
+        self.DB_FILE = db_file
+        self.LEGACY_FILE = legacy_file
+        self.db = SqliteDatabase(self.DB_FILE, ["CREATE TABLE IF NOT EXISTS role_jobs (id TEXT PRIMARY KEY, "
+                                                "guild_id INTEGER NOT NULL, data TEXT NOT NULL)"])
+        if self.db.execute("SELECT COUNT(*) FROM role_jobs")[0][0] == 0:
+            self._migrate()
+
+    # Helper function to import the jobs from the old jobs JSON file (a list of jobs). The file is renamed afterwards
+    # so it is not imported again. As with the token store, a process that loses the race to another shard process
+    # finds the file already renamed and treats it as migrated, and rows that already exist are left alone.
+    def _migrate(self):
+        if not self.LEGACY_FILE or not os.path.exists(self.LEGACY_FILE):
+            return
+        try:
+            jobs = read_json(self.LEGACY_FILE, default=[])
+            self.db.execute_many("INSERT OR IGNORE INTO role_jobs (id, guild_id, data) VALUES (?, ?, ?)",
+                                 [(job["id"], job["guild_id"], json.dumps(job)) for job in jobs])
+            os.replace(self.LEGACY_FILE, self.LEGACY_FILE + ".migrated")
+        except FileNotFoundError:
+            logger.info(f"{self.LEGACY_FILE} was migrated by another process.")
+        else:
+            logger.info(f"Migrated {len(jobs)} role jobs from {self.LEGACY_FILE} to {self.DB_FILE}.")
+
+    # Returns every saved job as a dictionary (see RoleJob.to_dict).
+    async def load(self):
+        rows = await asyncio.to_thread(self.db.execute, "SELECT data FROM role_jobs")
+        return [json.loads(data) for data, in rows]
+
+    # Saves a job, replacing the saved copy if there is one.
+    async def save(self, job):
+        await asyncio.to_thread(self.db.execute_many,
+                                "INSERT OR REPLACE INTO role_jobs (id, guild_id, data) VALUES (?, ?, ?)",
+                                [(job["id"], job["guild_id"], json.dumps(job))])
+
+    # Removes a finished job.
+    async def remove(self, job_id):
+        await asyncio.to_thread(self.db.execute_many, "DELETE FROM role_jobs WHERE id = ?", [(job_id,)])
+
+    # Closes the database connection.
+    def close(self):
+        self.db.close()
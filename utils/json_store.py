@@ -0,0 +1,112 @@
+# Author: Alec Creasy
+# File Name: json_store.py
+# Description: Shared JSON persistence for the cogs. Files are read and written off the event loop, bursts of changes
+# are coalesced into a single write, and every write replaces the file atomically so a crash can never truncate it.
+
+import asyncio
+import copy
+import json
+import logging
+import os
+import threading
+
+# orjson is used for reading and writing when it is installed, since it is several times faster than the standard
+# library. It is optional, and the standard json module is used otherwise.
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+logger = logging.getLogger("json_store")
+
+# Helper function to decode JSON bytes with the fastest available codec.
+def decode(raw):
+    return orjson.loads(raw) if orjson is not None else json.loads(raw)
+
+# Helper function to encode data as JSON bytes with the fastest available codec. orjson only supports an indent of
+# two spaces, so any indent is treated as "pretty print".
+def encode(data, indent=None):
+    if orjson is not None:
+        return orjson.dumps(data, option=orjson.OPT_INDENT_2 if indent else 0)
+    return json.dumps(data, indent=indent).encode("utf-8")
+
+# Reads a JSON file, returning "default" if it does not exist.
+def read_json(path, default=None):
+    if not os.path.exists(path):
+        return default
+    with open(path, "rb") as file:
+        return decode(file.read())
+
+# Writes data to a JSON file atomically: the data is written to a temporary file in the same directory, flushed to
+# disk, and then renamed over the original.
+def write_json(path, data, indent=None):
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    temp_file = path + ".tmp"
+    with open(temp_file, "wb") as file:
+        file.write(encode(data, indent=indent))
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(temp_file, path)
+
+# Creates a store for a single JSON file holding "data". Call save() after changing the data; the write happens
+# FLUSH_DELAY seconds later on a worker thread, and any other saves made in the meantime are folded into that same
+# write. The data is copied (shallowly) when the write starts, so the items inside it should be replaced rather than
+# changed in place.
+class JsonStore:
+    def __init__(self, path, default, flush_delay=0.5, indent=None):
+        self.PATH = path
+        self.FLUSH_DELAY = flush_delay
+        self.INDENT = indent
+        self.default = default
+        self.data = None
+        self.flush_task = None
+        self.dirty = False
+        self.write_lock = threading.Lock()
+
+    # Loads the data from the file, creating the file with the default data if it does not exist. This is meant for
+    # start up, before the event loop is busy.
+    def load(self):
+        self.data = read_json(self.PATH)
+        if self.data is None:
+            self.data = copy.deepcopy(self.default)
+            write_json(self.PATH, self.data, indent=self.INDENT)
+        return self.data
+
+    # Loads the data from the file without blocking the event loop.
+    async def load_async(self):
+        return await asyncio.to_thread(self.load)
+
+    # Schedules the data to be written. Returns immediately.
+    def save(self):
+        self.dirty = True
+        if self.flush_task is None or self.flush_task.done():
+            self.flush_task = asyncio.create_task(self._delayed_flush())
+
+    # Writes the data now and waits for the write to finish, including any write that was already scheduled.
+    async def flush(self):
+        if self.flush_task is not None and not self.flush_task.done():
+            self.flush_task.cancel()
+        self.dirty = False
+        await self._write()
+
+    # Helper function to wait for the flush delay so further saves can be coalesced, then write the data. If the
+    # data is saved again while the write is running, it is written once more afterwards.
+    async def _delayed_flush(self):
+        while self.dirty:
+            await asyncio.sleep(self.FLUSH_DELAY)
+            self.dirty = False
+            await self._write()
+
+    # Helper function to write a snapshot of the data on a worker thread. The lock keeps two writes of the same file
+    # from overlapping if a scheduled write is still running when flush() is called.
+    async def _write(self):
+        snapshot = copy.copy(self.data)
+
+        def write():
+            with self.write_lock:
+                write_json(self.PATH, snapshot, indent=self.INDENT)
+
+        try:
+            await asyncio.to_thread(write)
+        except OSError as error:
+            logger.error(f"Could not write {self.PATH}: {error}", exc_info=True)
@@ -0,0 +1,78 @@
+# Author: Alec Creasy
+# File Name: lexical_index.py
+# Description: An in-memory word index over the FAQ questions, used to answer /faq_search autocomplete requests on
+# every keystroke without touching the model.
+
+import heapq
+import math
+from bisect import bisect_left
+from utils.match_cache import normalize_text
+
+# Indexes each question by its words. A search matches every complete word of the query exactly and the last,
+# possibly half-typed, word as a prefix, so "how do i sub" already finds "How do I submit the lab?". Matches are
+# ranked by the inverse document frequency of the words they share with the query, with a bonus for questions that
+# start with the query as typed.
+class LexicalIndex:
+    def __init__(self, questions=()):
+        self.questions = []
+        self.postings = {}
+        self.vocabulary = []
+        for question in questions:
+            self.add(question)
+
+    def __len__(self):
+        return len(self.questions)
+
+    # Adds a question to the end of the index. Its position matches its position in the FAQ list.
+    def add(self, question):
+        index = len(self.questions)
+        text = normalize_text(question)
+        self.questions.append(text)
+        for word in set(text.split()):
+            postings = self.postings.get(word)
+            if postings is None:
+                postings = self.postings[word] = set()
+                # Keep the vocabulary sorted so prefix lookups are a binary search.
+                self.vocabulary.insert(bisect_left(self.vocabulary, word), word)
+            postings.add(index)
+
+    # Helper function that returns every indexed word starting with the prefix.
+    def words_with_prefix(self, prefix):
+        words = []
+        for position in range(bisect_left(self.vocabulary, prefix), len(self.vocabulary)):
+            word = self.vocabulary[position]
+            if not word.startswith(prefix):
+                break
+            words.append(word)
+        return words
+
+    # Helper function that returns the inverse document frequency of a word, so rare words count for more.
+    def weight(self, word):
+        return math.log(1 + len(self.questions) / len(self.postings[word]))
+
+    # Returns the positions of up to "limit" questions matching the query, best match first. An empty query returns
+    # the first questions in the list.
+    def search(self, query, limit=25):
+        text = normalize_text(query)
+        words = text.split()
+        if not words:
+            return list(range(min(limit, len(self.questions))))
+
+        # The query has to be typed as it appears for a complete word to match, but the last word may be unfinished
+        # unless the query ends with a space.
+        complete, partial = (words, None) if query.endswith(" ") else (words[:-1], words[-1])
+        scores = {}
+        for word in complete:
+            if word in self.postings:
+                for index in self.postings[word]:
+                    scores[index] = scores.get(index, 0.0) + self.weight(word)
+        if partial is not None:
+            best = {}
+            for word in self.words_with_prefix(partial):
+                for index in self.postings[word]:
+                    best[index] = max(best.get(index, 0.0), self.weight(word))
+            for index, score in best.items():
+                scores[index] = scores.get(index, 0.0) + score
+
+        # Only the best "limit" matches are needed, so avoid sorting all of them.
+        return heapq.nsmallest(limit, scores, key=lambda index: (-(scores[index] + (1.0 if self.questions[index].startswith(text) else 0.0)), index))
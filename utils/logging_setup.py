@@ -0,0 +1,101 @@
+# Author: Alec Creasy
+# File Name: logging_setup.py
+# Description: Sets up the bot's logging so that log calls never write to disk on the event loop. Records are put on a
+# queue and a background thread formats them and writes them to the console and to a rotating log file.
+
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import time
+from utils.sharding import labelled_path
+
+FORMAT = "[{asctime}] - [{levelname}] {name}: {message}"
+DATE_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+# Formats each record as a single line of JSON, for log files that are read by other tools.
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {"time": time.strftime(DATE_FORMAT, time.localtime(record.created)) + f".{int(record.msecs):03d}",
+                 "level": record.levelname, "logger": record.name, "message": record.getMessage()}
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        if record.stack_info:
+            entry["stack"] = self.formatStack(record.stack_info)
+        return json.dumps(entry, ensure_ascii=False)
+
+# A queue handler that does as little as possible on the calling thread. The message is merged with its arguments
+# (since the arguments may change after the call returns), but formatting, including tracebacks, is left to the
+# listener thread. The record is not copied, since this handler sits on the root logger and so is the last to see
+# it. If the queue is full, the record is dropped and counted instead of blocking the caller.
+class NonBlockingQueueHandler(logging.handlers.QueueHandler):
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+# Helper function to create the handler that writes the log file, rotating it either when it reaches "max_bytes" or
+# on the schedule given by "when" (such as "midnight"), and keeping "backup_count" old files.
+def file_handler(path, rotate="size", max_bytes=10 * 1024 * 1024, when="midnight", backup_count=5):
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    if rotate == "time":
+        return logging.handlers.TimedRotatingFileHandler(path, when=when, backupCount=backup_count, encoding="utf-8")
+    if rotate == "size":
+        return logging.handlers.RotatingFileHandler(path, maxBytes=max_bytes, backupCount=backup_count, encoding="utf-8")
+    raise ValueError(f"Unknown log rotation: {rotate}")
+
+# Helper function to parse per-logger levels written as "name=LEVEL" pairs separated by commas, such as
+# "discord=WARNING, discord.gateway=ERROR".
+def parse_levels(text):
+    levels = {}
+    for pair in text.split(","):
+        if "=" in pair:
+            name, level = pair.split("=", 1)
+            levels[name.strip()] = level.strip().upper()
+    return levels
+
+# Configures the root logger from the [Logging] section of config.ini and starts the listener thread. Returns the
+# listener, which should be stopped when the bot exits so the last records are written. When several processes run
+# side by side (see launcher.py), each passes its own "label", which is added to the log file name so no two
+# processes write or rotate the same file.
+def setup_logging(config, label=""):
+    log_file = labelled_path(config.get("Logging", "LOG_FILE", fallback="logs/bot.log"), label)
+    level = config.get("Logging", "LEVEL", fallback="INFO").upper()
+    rotate = config.get("Logging", "ROTATE", fallback="size")
+    max_bytes = int(config.get("Logging", "MAX_BYTES", fallback=10 * 1024 * 1024))
+    when = config.get("Logging", "ROTATE_WHEN", fallback="midnight")
+    backup_count = int(config.get("Logging", "BACKUP_COUNT", fallback=5))
+    json_file = config.getboolean("Logging", "JSON", fallback=False)
+    queue_size = int(config.get("Logging", "QUEUE_SIZE", fallback=10000))
+    logger_levels = parse_levels(config.get("Logging", "LOGGER_LEVELS", fallback="discord=WARNING"))
+
+    text_formatter = logging.Formatter(FORMAT, datefmt=DATE_FORMAT, style="{")
+    console = logging.StreamHandler()
+    console.setFormatter(text_formatter)
+    log_file_handler = file_handler(log_file, rotate=rotate, max_bytes=max_bytes, when=when, backup_count=backup_count)
+    log_file_handler.setFormatter(JsonFormatter() if json_file else text_formatter)
+
+    log_queue = queue.Queue(maxsize=queue_size)
+    queue_handler = NonBlockingQueueHandler(log_queue)
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(queue_handler)
+    root.setLevel(level)
+    for name, logger_level in logger_levels.items():
+        logging.getLogger(name).setLevel(logger_level)
+
+    listener = logging.handlers.QueueListener(log_queue, console, log_file_handler, respect_handler_level=True)
+    listener.start()
+    return listener
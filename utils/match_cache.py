@@ -0,0 +1,71 @@
+# Author: Alec Creasy
+# File Name: match_cache.py
+# Description: A small bounded cache that remembers the FAQ match result for recently seen messages, so repeated
+# questions do not have to go through the model again.
+
+import re
+import time
+from collections import OrderedDict
+
+URL_PATTERN = re.compile(r"https?://\S+")
+MENTION_PATTERN = re.compile(r"<(?:@[!&]?|#|a?:\w+:)\d+>")
+NON_WORD_PATTERN = re.compile(r"[^\w\s?]")
+SPACE_PATTERN = re.compile(r"\s+")
+
+# Helper function to reduce a message to the form used as a cache key: links, mentions, custom emoji and punctuation
+# are removed, whitespace is collapsed, and the text is lowercased. "How do I join the lab??" and
+# "how do i join the lab ?" map to the same key.
+def normalize_text(text):
+    text = URL_PATTERN.sub(" ", text)
+    text = MENTION_PATTERN.sub(" ", text)
+    text = NON_WORD_PATTERN.sub(" ", text.lower())
+    text = SPACE_PATTERN.sub(" ", text).strip()
+    return text.rstrip("? ").strip()
+
+# Creates a least-recently-used cache holding at most MAX_SIZE entries, each of which expires TTL seconds after it
+# was stored. The hit and miss counters are kept so the cache size and TTL can be tuned. The generation counts how
+# many times the cache has been cleared, so a result computed before the FAQ changed is not stored after it.
+class MatchCache:
+    def __init__(self, max_size=1024, ttl=3600):
+        self.MAX_SIZE = max_size
+        self.TTL = ttl
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.generation = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    # Returns the cached value for the key, or None if it is missing or has expired.
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is None or entry[0] < time.monotonic():
+            if entry is not None:
+                del self.entries[key]
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    # Stores a value for the key, evicting the least recently used entry if the cache is full. If "generation" is given
+    # (the cache's generation when the value started being computed) and the cache has been cleared since, the value
+    # is out of date and is not stored.
+    def put(self, key, value, generation=None):
+        if generation is not None and generation != self.generation:
+            return
+        self.entries[key] = (time.monotonic() + self.TTL, value)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.MAX_SIZE:
+            self.entries.popitem(last=False)
+
+    # Removes every entry. Called whenever the FAQ set changes, since cached results may no longer be correct.
+    def clear(self):
+        self.entries.clear()
+        self.generation += 1
+
+    # Returns the fraction of lookups that were served from the cache.
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
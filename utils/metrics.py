@@ -0,0 +1,169 @@
+# Author: Alec Creasy
+# File Name: metrics.py
+# Description: Lightweight runtime metrics for the bot. Cogs record timings, counters and gauges in the shared
+# "registry", which can be summarized by the /stats command and written out in the Prometheus text format.
+
+import asyncio
+import math
+import os
+import time
+from collections import deque
+from contextlib import contextmanager
+
+# Upper bounds, in seconds, of the histogram buckets. They cover everything from a cache hit to a slow Discord call.
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, math.inf)
+
+# Bucket bounds for histograms that count things rather than time them, such as batch sizes.
+SIZE_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128, 256, math.inf)
+
+# A cumulative histogram in the Prometheus style. The most recent observations are also kept so accurate percentiles
+# can be shown in /stats.
+class Histogram:
+    def __init__(self, buckets=BUCKETS, recent=1024):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+        self.recent = deque(maxlen=recent)
+
+    def observe(self, value):
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[index] += 1
+                break
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+        self.recent.append(value)
+
+    # Returns the q-th percentile (0 to 100) of the recent observations.
+    def percentile(self, q):
+        if not self.recent:
+            return 0.0
+        ordered = sorted(self.recent)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * q / 100))]
+
+# Holds every metric, keyed by name and a sorted tuple of label pairs.
+class Registry:
+    def __init__(self):
+        self.histograms = {}
+        self.counters = {}
+        self.gauges = {}
+        self.descriptions = {}
+
+    # Records a short description of a metric, used as its HELP line when exported.
+    def describe(self, name, text):
+        self.descriptions[name] = text
+
+    # Adds a value to a histogram. Values are in seconds unless the histogram was given other buckets.
+    def observe(self, name, value, buckets=BUCKETS, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            histogram = self.histograms[key] = Histogram(buckets)
+        histogram.observe(value)
+
+    # Adds to a counter.
+    def increment(self, name, amount=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        self.counters[key] = self.counters.get(key, 0) + amount
+
+    # Sets a gauge to a value.
+    def set(self, name, value, **labels):
+        self.gauges[(name, tuple(sorted(labels.items())))] = value
+
+    # Times the body of a "with" block and adds the duration to a histogram. Works around "await" as well.
+    @contextmanager
+    def time(self, name, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    # Returns every histogram with the given name, keyed by its labels as a dictionary.
+    def histograms_named(self, name):
+        return [(dict(labels), histogram) for (metric, labels), histogram in self.histograms.items() if metric == name]
+
+    # Returns the value of a counter or gauge, or 0 if it has not been recorded.
+    def value(self, name, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        return self.counters.get(key, self.gauges.get(key, 0))
+
+    # Renders every metric in the Prometheus text exposition format.
+    def render(self, prefix="sainjubot_"):
+        lines = []
+        seen = set()
+
+        def label_text(labels, extra=()):
+            pairs = list(labels) + list(extra)
+            if not pairs:
+                return ""
+            return "{" + ",".join(f'{key}="{str(value)}"' for key, value in pairs) + "}"
+
+        def header(name, kind):
+            if name in seen:
+                return
+            seen.add(name)
+            if name in self.descriptions:
+                lines.append(f"# HELP {prefix}{name} {self.descriptions[name]}")
+            lines.append(f"# TYPE {prefix}{name} {kind}")
+
+        for (name, labels), value in sorted(self.counters.items()):
+            header(name, "counter")
+            lines.append(f"{prefix}{name}{label_text(labels)} {value}")
+        for (name, labels), value in sorted(self.gauges.items()):
+            header(name, "gauge")
+            lines.append(f"{prefix}{name}{label_text(labels)} {value}")
+        for (name, labels), histogram in sorted(self.histograms.items(), key=lambda item: item[0]):
+            header(name, "histogram")
+            cumulative = 0
+            for bound, count in zip(histogram.buckets, histogram.counts):
+                cumulative += count
+                bound_text = "+Inf" if bound == math.inf else repr(bound)
+                lines.append(f"{prefix}{name}_bucket{label_text(labels, [('le', bound_text)])} {cumulative}")
+            lines.append(f"{prefix}{name}_sum{label_text(labels)} {histogram.sum}")
+            lines.append(f"{prefix}{name}_count{label_text(labels)} {histogram.count}")
+        return "\n".join(lines) + "\n"
+
+# Writes rendered metrics to a file. The file is replaced atomically so a scraper (such as the node exporter's
+# textfile collector) never reads a half written file.
+def write_export(path, text):
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    temp_file = path + ".tmp"
+    with open(temp_file, "w") as file:
+        file.write(text)
+    os.replace(temp_file, path)
+
+# The registry shared by the whole bot.
+registry = Registry()
+registry.describe("command_seconds", "Time taken to handle each application command.")
+registry.describe("event_loop_lag_seconds", "How late the event loop woke up from a short sleep.")
+registry.describe("faq_match_seconds", "Time from handing a message to the inference worker to having its FAQ matches.")
+registry.describe("faq_autocomplete_seconds", "Time taken to build the suggestions for /faq_search.")
+registry.describe("faq_suppressed_total", "FAQ auto-replies held back by user throttling or the per-channel reply limit.")
+registry.describe("inference_batch_seconds", "Time taken to encode one batch of messages.")
+registry.describe("inference_batch_size", "Number of messages encoded per batch.")
+registry.describe("inference_queue_depth", "Messages waiting to be encoded.")
+registry.describe("faq_coalescer_dropped_total", "Messages dropped because their channel's coalescing window was full.")
+registry.describe("inference_shed_total", "Messages dropped because the inference queue was full.")
+registry.describe("token_store_seconds", "Time taken by token store operations.")
+registry.describe("startup_seconds", "Seconds from the process starting to the bot first becoming ready.")
+registry.describe("gateway_events_total", "Gateway connects, disconnects and resumes.")
+
+# Measures event loop lag: every "interval" seconds, records how much later than requested the loop woke up. A loop
+# blocked by synchronous work shows up here as large lag.
+async def monitor_loop_lag(interval=0.5):
+    loop = asyncio.get_running_loop()
+    while True:
+        start = loop.time()
+        await asyncio.sleep(interval)
+        registry.observe("event_loop_lag_seconds", max(0.0, loop.time() - start - interval))
+
+# Writes the metrics to "path" in the Prometheus text format every "interval" seconds. The metrics are rendered on
+# the event loop, where they are updated, and the file is written on a worker thread.
+async def export_periodically(path, interval=60):
+    while True:
+        await asyncio.sleep(interval)
+        await asyncio.to_thread(write_export, path, registry.render())
@@ -0,0 +1,194 @@
+# Author: Alec Creasy
+# File Name: role_jobs.py
+# Description: Runs bulk role changes (such as moving every member of a course role to the visitor role at the end of
+# a semester) as resumable background jobs.
+
+import asyncio
+import logging
+import time
+import uuid
+import discord
+from utils.job_store import JobStore
+from utils.sharding import handles_guild
+
+logger = logging.getLogger("role_jobs")
+
+# Returns every member of the guild who has the role. If the guild's members are cached (the bot chunked it at start
+# up), the cached role members are used. Otherwise the member list is streamed from Discord a page (1000 members) at
+# a time, and only the members with the role are kept, so the full member list is never held in memory.
+async def members_with_role(guild, role):
+    if guild.chunked:
+        return list(role.members)
+    return [member async for member in guild.fetch_members(limit=None) if role in member.roles]
+
+# Creates a role job. A job removes "role_id" from every member in "pending" and gives them "replacement_id" (if any)
+# with a single member edit each. The job records which members are still pending so it can be saved and picked up
+# again if the bot restarts partway through. If the job stops on an unexpected error, the error is recorded so it can
+# be reported, and the job is dropped rather than resumed.
+class RoleJob:
+    def __init__(self, guild_id, role_id, replacement_id, pending, total=None, done=0, failed=0, job_id=None):
+        self.id = job_id or uuid.uuid4().hex
+        self.guild_id = guild_id
+        self.role_id = role_id
+        self.replacement_id = replacement_id
+        self.pending = set(pending)
+        self.total = total if total is not None else len(self.pending)
+        self.done = done
+        self.failed = failed
+        self.error = None
+        # Member objects already known for some of the pending IDs, so they do not have to be fetched again. These
+        # are not saved; a resumed job looks its members up by ID.
+        self.members = {}
+
+    def to_dict(self):
+        return {"id": self.id, "guild_id": self.guild_id, "role_id": self.role_id,
+                "replacement_id": self.replacement_id, "pending": sorted(self.pending),
+                "total": self.total, "done": self.done, "failed": self.failed}
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data["guild_id"], data["role_id"], data["replacement_id"], data["pending"], total=data["total"],
+                   done=data["done"], failed=data["failed"], job_id=data["id"])
+
+# Creates the engine that runs role jobs. Each job is worked on by CONCURRENCY workers at once. discord.py already
+# waits out the rate limit bucket for the member edit route, so the worker count only has to be small enough that
+# the job does not hog the bucket other commands also need. Every PROGRESS_INTERVAL seconds the job is saved to the
+# JOBS_DB database (shared by every shard process) and the progress callback (if any) is called with the job. Jobs
+# saved in the old JOBS_FILE are migrated into the database.
+class RoleJobEngine:
+    def __init__(self, bot, jobs_db, concurrency=4, progress_interval=5, legacy_file=None):
+        self.bot = bot
+        self.JOBS_DB = jobs_db
+        self.CONCURRENCY = concurrency
+        self.PROGRESS_INTERVAL = progress_interval
+        self.store = JobStore(self.JOBS_DB, legacy_file=legacy_file)
+        self.jobs = {}
+        self.tasks = {}
+
+    # Helper function to read the unfinished jobs saved in the database.
+    async def _read_jobs(self):
+        return {data["id"]: RoleJob.from_dict(data) for data in await self.store.load()}
+
+    # Saves a job's progress without blocking the event loop.
+    async def save(self, job):
+        await self.store.save(job.to_dict())
+
+    # Helper function to forget a job that finished or can no longer run.
+    async def _finish(self, job):
+        self.jobs.pop(job.id, None)
+        await self.store.remove(job.id)
+
+    # Closes the job database.
+    def close(self):
+        self.store.close()
+
+    # Starts a job that moves every given member from one role to the replacement role and returns it. The job runs
+    # in the background, and its task can be found in "tasks" until it finishes.
+    async def start(self, guild, role, replacement, members, on_progress=None):
+        job = RoleJob(guild.id, role.id, replacement.id if replacement else None, [member.id for member in members])
+        job.members = {member.id: member for member in members}
+        self.jobs[job.id] = job
+        await self.save(job)
+        self._launch(job, on_progress)
+        return job
+
+    # Resumes any jobs that were saved before the bot last stopped. Jobs that are already running are left alone, so
+    # this is safe to call every time the bot becomes ready. When the bot runs as several shard processes, each only
+    # resumes the jobs for the servers whose events it receives.
+    async def resume_all(self):
+        saved = await self._read_jobs()
+        for job_id, job in saved.items():
+            if job_id in self.tasks or not handles_guild(self.bot, job.guild_id):
+                continue
+            self.jobs[job_id] = job
+            logger.info(f"Resuming role job {job_id} with {len(job.pending)} of {job.total} members remaining.")
+            self._launch(job, None)
+
+    # Helper function to start the task running a job and forget the job once the task finishes.
+    def _launch(self, job, on_progress):
+        task = asyncio.create_task(self._run(job, on_progress), name=f"role-job-{job.id}")
+        self.tasks[job.id] = task
+        task.add_done_callback(lambda _: self.tasks.pop(job.id, None))
+        return task
+
+    # Edits a single member's roles, removing the job's role and adding the replacement in one request. The member is
+    # only fetched if it was not passed in and is not in the member cache.
+    async def _migrate_member(self, guild, role, replacement, member_id, member=None):
+        if member is None:
+            member = guild.get_member(member_id)
+        if member is None:
+            try:
+                member = await guild.fetch_member(member_id)
+            except discord.NotFound:
+                return
+        if role not in member.roles:
+            return
+
+        roles = [existing for existing in member.roles[1:] if existing != role]
+        if replacement is not None and replacement not in roles:
+            roles.append(replacement)
+        await member.edit(roles=roles, reason=f"Bulk removal of {role.name}")
+
+    # Helper function to call the progress callback (if any), logging rather than raising if it fails, so a message
+    # that could not be edited does not stop the job.
+    async def _report(self, job, on_progress):
+        if on_progress is None:
+            return
+        try:
+            await on_progress(job)
+        except Exception as error:
+            logger.warning(f"Could not report the progress of role job {job.id}: {error}")
+
+    # Runs a job to completion. Workers pull member IDs from a shared queue, and a separate loop saves the job and
+    # reports its progress every PROGRESS_INTERVAL seconds. If anything other than a failed member edit goes wrong,
+    # the error is reported and the job is removed from the database, so it is neither left looking like it is still
+    # running nor retried.
+    async def _run(self, job, on_progress):
+        guild = self.bot.get_guild(job.guild_id)
+        role = guild.get_role(job.role_id) if guild else None
+        replacement = guild.get_role(job.replacement_id) if guild and job.replacement_id else None
+        if role is None:
+            logger.warning(f"Dropping role job {job.id}: its guild or role no longer exists.")
+            await self._finish(job)
+            return job
+
+        queue = asyncio.Queue()
+        for member_id in job.pending:
+            queue.put_nowait(member_id)
+
+        async def worker():
+            while not queue.empty():
+                member_id = queue.get_nowait()
+                try:
+                    await self._migrate_member(guild, role, replacement, member_id, job.members.pop(member_id, None))
+                    job.done += 1
+                except discord.HTTPException as error:
+                    job.failed += 1
+                    logger.warning(f"Role job {job.id} could not update member {member_id}: {error}")
+                job.pending.discard(member_id)
+
+        async def report():
+            while True:
+                await asyncio.sleep(self.PROGRESS_INTERVAL)
+                await self.save(job)
+                await self._report(job, on_progress)
+
+        start = time.perf_counter()
+        reporter = asyncio.create_task(report())
+        try:
+            await asyncio.gather(*(worker() for _ in range(self.CONCURRENCY)))
+        except Exception as error:
+            job.error = f"{type(error).__name__}: {error}"
+            logger.error(f"Role job {job.id} stopped after {job.done + job.failed} of {job.total} members: {job.error}",
+                         exc_info=True)
+            await self._report(job, on_progress)
+            await self._finish(job)
+            return job
+        finally:
+            reporter.cancel()
+
+        await self._finish(job)
+        logger.info(f"Role job {job.id} finished in {time.perf_counter() - start:.1f}s: "
+                    f"{job.done} updated, {job.failed} failed.")
+        await self._report(job, on_progress)
+        return job
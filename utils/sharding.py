@@ -0,0 +1,70 @@
+# Author: Alec Creasy
+# File Name: sharding.py
+# Description: Helpers for running the bot as several processes that each connect a range of its gateway shards (see
+# launcher.py). The launcher tells each process which shards it owns, and where the shared inference service is,
+# through environment variables.
+
+import os
+
+SHARD_IDS_VARIABLE = "SAINJUBOT_SHARD_IDS"
+SHARD_COUNT_VARIABLE = "SAINJUBOT_SHARD_COUNT"
+INFERENCE_ADDRESS_VARIABLE = "SAINJUBOT_INFERENCE_ADDRESS"
+
+# Returns the shard that receives a guild's events, using Discord's formula.
+def shard_for(guild_id, shard_count):
+    return (guild_id >> 22) % shard_count
+
+# Splits shards 0 to shard_count - 1 into "processes" ranges of consecutive shards, as evenly as possible.
+def shard_ranges(shard_count, processes):
+    processes = max(1, min(processes, shard_count))
+    size, extra = divmod(shard_count, processes)
+    ranges = []
+    start = 0
+    for index in range(processes):
+        end = start + size + (1 if index < extra else 0)
+        ranges.append(list(range(start, end)))
+        start = end
+    return ranges
+
+# Reads the shards this process should connect from the environment variables set by the launcher, as
+# (shard_ids, shard_count). Returns (None, None) when the bot was started on its own.
+def shards_from_environment():
+    shard_ids = os.getenv(SHARD_IDS_VARIABLE)
+    shard_count = os.getenv(SHARD_COUNT_VARIABLE)
+    if not shard_ids or not shard_count:
+        return None, None
+    return [int(shard_id) for shard_id in shard_ids.split(",")], int(shard_count)
+
+# Returns True if this process is one of several started by the launcher, so state it keeps in memory may be changed
+# by another process.
+def is_multiprocess():
+    return shards_from_environment()[0] is not None
+
+# Helper function that returns a label for a process's shards, such as "shards-0-3", used to keep each process's log
+# and metrics files apart. Returns an empty string if the process connects every shard.
+def process_label(shard_ids):
+    if not shard_ids:
+        return ""
+    return f"shards-{min(shard_ids)}-{max(shard_ids)}"
+
+# Helper function to add a process label to a file name, so "logs/bot.log" becomes "logs/bot.shards-0-3.log".
+def labelled_path(path, label):
+    if not label:
+        return path
+    root, extension = os.path.splitext(path)
+    return f"{root}.{label}{extension}"
+
+# Returns True if the bot's process handles shard 0, which receives direct messages. It is the one process that syncs
+# the application commands and writes the shared FAQ file.
+def is_primary(bot):
+    shard_ids = getattr(bot, "shard_ids", None)
+    return not shard_ids or 0 in shard_ids
+
+# Returns True if the guild's events are received by the bot's process. Always True when one process connects every
+# shard.
+def handles_guild(bot, guild_id):
+    shard_ids = getattr(bot, "shard_ids", None)
+    shard_count = getattr(bot, "shard_count", None)
+    if not shard_ids or not shard_count:
+        return True
+    return shard_for(guild_id, shard_count) in shard_ids
@@ -0,0 +1,56 @@
+# Author: Alec Creasy
+# File Name: sqlite_store.py
+# Description: The SQLite database connection shared by the token and role job stores. Every shard process opens the
+# same database file, so it runs in write-ahead logging mode, where readers never wait for a writer.
+
+import os
+import sqlite3
+import threading
+
+# Opens (creating if needed) the database at "db_file" and runs each statement in "schema" to create its tables. The
+# connection may be used from any thread, but only by one at a time, so the stores can run their queries on worker
+# threads with asyncio.to_thread and keep them off the event loop. Other processes' writes are waited on for up to
+# TIMEOUT seconds.
+class SqliteDatabase:
+    TIMEOUT = 30
+
+    def __init__(self, db_file, schema=()):
+        self.DB_FILE = db_file
+        os.makedirs(os.path.dirname(self.DB_FILE) or ".", exist_ok=True)
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(self.DB_FILE, check_same_thread=False, isolation_level=None,
+                                          timeout=self.TIMEOUT)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        for statement in schema:
+            self.connection.execute(statement)
+
+    # Runs a single statement and returns every row it produces.
+    def execute(self, statement, parameters=()):
+        with self.lock:
+            return self.connection.execute(statement, parameters).fetchall()
+
+    # Runs a statement for each row inside a single transaction, and returns the number of rows it changed.
+    def execute_many(self, statement, rows):
+        with self.lock:
+            self.connection.execute("BEGIN IMMEDIATE")
+            try:
+                changed = self.connection.executemany(statement, rows).rowcount
+            except BaseException:
+                self.connection.execute("ROLLBACK")
+                raise
+            self.connection.execute("COMMIT")
+            return changed
+
+    # Folds the write-ahead log back into the database file and, if requested, rebuilds the file to reclaim the
+    # space left behind by deleted rows.
+    def compact(self, vacuum=False):
+        with self.lock:
+            self.connection.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+            if vacuum:
+                self.connection.execute("VACUUM")
+
+    # Closes the database connection.
+    def close(self):
+        with self.lock:
+            self.connection.close()
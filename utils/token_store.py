@@ -0,0 +1,167 @@
+# Author: Alec Creasy
+# File Name: token_store.py
+# Description: Stores role tokens in a local SQLite database, with an in-memory index from each token to its role so
+# that redeeming a token is a single dictionary lookup.
+
+import asyncio
+import logging
+import os
+from utils.json_store import read_json
+from utils.metrics import registry
+from utils.sqlite_store import SqliteDatabase
+
+logger = logging.getLogger("token_store")
+
+# Creates the token store. Every token is kept in the "index" dictionary (single-use tokens are also kept in the
+# "single_use" set), and every change is written through to SQLite in its own transaction, so only the tokens that
+# changed are written and a crash can never leave a half written file behind. Writes run on a worker thread so they do
+# not block the event loop. If the database is new and an old tokens JSON file exists, its tokens are migrated into
+# the database on first load. With "shared" set, other processes (the bot's other shards) use the same database, so
+# the index is reloaded whenever one of them has changed it (see refresh).
+class TokenStore:
+    def __init__(self, db_file, legacy_file=None, shared=False):
+        self.DB_FILE = db_file
+        self.LEGACY_FILE = legacy_file
+        self.SHARED = shared
+        self.db = SqliteDatabase(self.DB_FILE, ["CREATE TABLE IF NOT EXISTS tokens (token TEXT PRIMARY KEY, "
+                                                "role TEXT NOT NULL, single_use INTEGER NOT NULL DEFAULT 0)"])
+        self.index = {}
+        self.single_use = set()
+        self.data_version = None
+        self.writing = 0
+        self.writes = 0
+        self._load()
+        if not self.index:
+            self._migrate()
+
+    def __len__(self):
+        return len(self.index)
+
+    def __contains__(self, token):
+        return token in self.index
+
+    # Helper function to read every token from the database. Returns the database's data version as of the read, the
+    # index, and the set of single-use tokens.
+    def _read(self):
+        data_version = self.db.execute("PRAGMA data_version")[0][0]
+        rows = self.db.execute("SELECT token, role, single_use FROM tokens")
+        index = {token: role for token, role, _ in rows}
+        return data_version, index, {token for token, _, single_use in rows if single_use}
+
+    # Helper function to read every token into the index.
+    def _load(self):
+        self.data_version, self.index, self.single_use = self._read()
+
+    # Helper function that reads every token like _read, or returns None if no other process has changed the database
+    # since it was last read.
+    def _read_if_changed(self):
+        if self.db.execute("PRAGMA data_version")[0][0] == self.data_version:
+            return None
+        return self._read()
+
+    # Reloads the index if another process has changed the database since it was last read. SQLite only changes the
+    # data version when another connection commits, so while no other process writes, this is one small query, and
+    # tokens only change when an administrator generates or deletes them or a single-use token is redeemed. The check
+    # and the reload run on a worker thread. If this process writes a change while the reload is running, the reload
+    # may not include it, so it is thrown away and the next refresh reads the database again.
+    async def refresh(self):
+        if not self.SHARED:
+            return
+        writing, writes = self.writing, self.writes
+        tokens = await asyncio.to_thread(self._read_if_changed)
+        if tokens is not None and not writing and not self.writing and self.writes == writes:
+            self.data_version, self.index, self.single_use = tokens
+
+    # Helper function to write a change on a worker thread, timed as "operation". Returns the number of rows changed.
+    async def _write(self, operation, statement, rows):
+        self.writing += 1
+        try:
+            with registry.time("token_store_seconds", operation=operation):
+                return await asyncio.to_thread(self.db.execute_many, statement, rows)
+        finally:
+            self.writing -= 1
+            self.writes += 1
+
+    # Helper function to import the tokens from the old tokens JSON file ({role: [tokens]}). The file is renamed
+    # afterwards so it is not imported again. Every shard process starts at once and may try this together, so the
+    # tokens are inserted with INSERT OR IGNORE, and a process that finds the file already renamed by another one
+    # treats it as migrated.
+    def _migrate(self):
+        if not self.LEGACY_FILE or not os.path.exists(self.LEGACY_FILE):
+            return
+        try:
+            legacy = read_json(self.LEGACY_FILE, default={})
+            rows = [(token, role) for role, token_list in legacy.items() for token in token_list]
+            self.db.execute_many("INSERT OR IGNORE INTO tokens (token, role) VALUES (?, ?)", rows)
+            os.replace(self.LEGACY_FILE, self.LEGACY_FILE + ".migrated")
+        except FileNotFoundError:
+            logger.info(f"{self.LEGACY_FILE} was migrated by another process.")
+        else:
+            logger.info(f"Migrated {len(rows)} tokens from {self.LEGACY_FILE} to {self.DB_FILE}.")
+        self._load()
+
+    # Returns the name of the role a token can be redeemed for, or None if the token does not exist.
+    async def role_for(self, token):
+        await self.refresh()
+        return self.index.get(token)
+
+    # Returns the number of tokens for each role.
+    async def counts(self):
+        await self.refresh()
+        counts = {}
+        for role in self.index.values():
+            counts[role] = counts.get(role, 0) + 1
+        return counts
+
+    # Adds the tokens for a role in a single transaction, however many there are.
+    async def add(self, role, tokens, single_use=False):
+        rows = [(token, role, int(single_use)) for token in tokens]
+        for token in tokens:
+            self.index[token] = role
+            if single_use:
+                self.single_use.add(token)
+            else:
+                self.single_use.discard(token)
+        await self._write("add", "INSERT OR REPLACE INTO tokens (token, role, single_use) VALUES (?, ?, ?)", rows)
+
+    # Removes a single token.
+    async def remove(self, token):
+        self.index.pop(token, None)
+        self.single_use.discard(token)
+        await self._write("remove", "DELETE FROM tokens WHERE token = ?", [(token,)])
+
+    # Claims a token for redemption and returns True if the caller may use it. Reusable tokens can always be claimed.
+    # A single-use token is removed from the index before the delete is awaited, so when two redemptions race only
+    # the first one sees it, and the database delete must actually remove the row, so the same holds across processes
+    # sharing the database. If the redemption fails afterwards, restore() puts the token back.
+    async def claim(self, token):
+        await self.refresh()
+        if token not in self.index:
+            return False
+        if token not in self.single_use:
+            return True
+        self.index.pop(token)
+        self.single_use.discard(token)
+        deleted = await self._write("claim", "DELETE FROM tokens WHERE token = ?", [(token,)])
+        return deleted == 1
+
+    # Puts back a single-use token that was claimed but could not be redeemed.
+    async def restore(self, token, role):
+        await self.add(role, [token], single_use=True)
+
+    # Removes every token.
+    async def clear(self):
+        self.index.clear()
+        self.single_use.clear()
+        await self._write("clear", "DELETE FROM tokens", [()])
+        await self.compact(vacuum=True)
+
+    # Folds the write-ahead log back into the database file and, if requested, rebuilds the file to reclaim the
+    # space left behind by deleted tokens.
+    async def compact(self, vacuum=False):
+        with registry.time("token_store_seconds", operation="compact"):
+            await asyncio.to_thread(self.db.compact, vacuum)
+
+    # Closes the database connection.
+    def close(self):
+        self.db.close()
@@ -0,0 +1,228 @@
+# Author: Alec Creasy
+# File Name: vector_index.py
+# Description: Index backends used to find the FAQ questions most similar to a message. Both backends expose the
+# same add(), search() and rebuild() methods so the FAQ cog does not need to know which one it is using.
+
+import copy
+import numpy as np
+
+# Helper function to scale each row of a matrix (or a single vector) to unit length, so the cosine similarity of two
+# vectors becomes their dot product.
+def normalize(vectors):
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    norms[norms == 0] = 1
+    return vectors / norms
+
+# Helper function that returns the (index, score) pairs for the k highest scores above the threshold, best
+# first. Uses a partial sort so only the top k scores are ever fully sorted.
+def top_k(scores, k, threshold, ids=None):
+    if len(scores) == 0 or k <= 0:
+        return []
+    k = min(k, len(scores))
+    candidates = np.argpartition(-scores, k - 1)[:k]
+    candidates = candidates[np.argsort(-scores[candidates])]
+    ids = candidates if ids is None else ids[candidates]
+    return [(int(index), float(scores[candidate])) for index, candidate in zip(ids, candidates)
+            if scores[candidate] > threshold]
+
+# Helper function to quantize normalized rows to int8. Each row gets its own scale factor (its largest absolute value
+# divided by 127), so a row is approximately its int8 values times its scale.
+def quantize(rows):
+    scales = np.abs(rows).max(axis=1) / 127 if len(rows) else np.zeros(0, dtype=np.float32)
+    scales[scales == 0] = 1
+    return np.round(rows / scales[:, None]).astype(np.int8), scales.astype(np.float32)
+
+# Exact search over a pre-normalized matrix. Scoring a message is a single matrix-vector product. The matrix can be
+# stored as float16 to halve its memory, or as int8 with a scale factor per row to quarter it, at a small cost in
+# precision. The embeddings are converted CHUNK_ROWS rows at a time, so when they are the memory-mapped cache only the
+# converted matrix is ever held in memory in full.
+class ExactIndex:
+    CHUNK_ROWS = 4096
+
+    def __init__(self, embeddings, dtype="float32"):
+        self.dtype = np.dtype(dtype)
+        self.matrix = None
+        self.scales = None
+        if len(embeddings):
+            self.matrix, self.scales = self._convert_all(embeddings)
+
+    def __len__(self):
+        return 0 if self.matrix is None else len(self.matrix)
+
+    # Helper function to normalize and convert a whole matrix of embeddings one chunk at a time.
+    def _convert_all(self, embeddings):
+        embeddings = np.asarray(embeddings)
+        matrix = np.empty(embeddings.shape, dtype=self.dtype)
+        scales = np.empty(len(embeddings), dtype=np.float32) if self.dtype == np.int8 else None
+        for start in range(0, len(embeddings), self.CHUNK_ROWS):
+            chunk = slice(start, min(start + self.CHUNK_ROWS, len(embeddings)))
+            matrix[chunk], chunk_scales = self._convert(normalize(embeddings[chunk]))
+            if scales is not None:
+                scales[chunk] = chunk_scales
+        return matrix, scales
+
+    # Helper function to convert normalized float32 rows to the storage type, returning the rows and, for int8, their
+    # scale factors.
+    def _convert(self, rows):
+        if self.dtype == np.int8:
+            return quantize(rows)
+        return rows.astype(self.dtype), None
+
+    # Returns the number of bytes used by the stored rows.
+    def nbytes(self):
+        if self.matrix is None:
+            return 0
+        return self.matrix.nbytes + (self.scales.nbytes if self.scales is not None else 0)
+
+    # Adds one embedding, or a matrix of them, to the end of the index.
+    def add(self, vector):
+        row, scale = self._convert(normalize(np.atleast_2d(vector)))
+        if self.matrix is None:
+            self.matrix, self.scales = row, scale
+            return
+        self.matrix = np.vstack([self.matrix, row])
+        if scale is not None:
+            self.scales = np.concatenate([self.scales, scale])
+
+    # Returns a stored row as a float32 vector.
+    def vector(self, index):
+        row = self.matrix[index].astype(np.float32)
+        return row * self.scales[index] if self.scales is not None else row
+
+    # An exact index never needs rebuilding, so this always returns None (see ClusterIndex.rebuild).
+    def rebuild(self):
+        return None
+
+    # Helper function to score a block of stored rows (given by a slice or an array of positions) against a
+    # normalized query.
+    def _score_rows(self, rows, query):
+        scores = self.matrix[rows].astype(np.float32) @ query
+        return scores * self.scales[rows] if self.scales is not None else scores
+
+    # Returns the cosine similarity of the query to each of the given rows, for reranking a known set of candidates.
+    def score(self, query, ids):
+        if self.matrix is None or len(ids) == 0:
+            return np.zeros(0, dtype=np.float32)
+        return self._score_rows(np.asarray(ids), normalize(query))
+
+    # Returns the (index, score) pairs of the k most similar rows whose score is above the threshold.
+    def search(self, query, k=1, threshold=0.0):
+        if self.matrix is None:
+            return []
+        query = normalize(query)
+        if self.dtype == np.float32:
+            return top_k(self.matrix @ query, k, threshold)
+
+        # NumPy has no fast half precision or int8 matrix product, so score the rows in float32 one chunk at a time.
+        scores = np.empty(len(self.matrix), dtype=np.float32)
+        for start in range(0, len(self.matrix), self.CHUNK_ROWS):
+            chunk = slice(start, min(start + self.CHUNK_ROWS, len(self.matrix)))
+            scores[chunk] = self._score_rows(chunk, query)
+        return top_k(scores, k, threshold)
+
+# Approximate search for large FAQ sets. The rows are grouped into clusters with spherical k-means, and a search only
+# scores the rows in the clusters whose centroids are closest to the message: PROBE_FRACTION of the clusters, but
+# never fewer than N_PROBE. With the default of 4 * sqrt(N) clusters and a probe fraction of 5%, each search scores
+# about 5% of the rows. Rows added later join the closest existing cluster, and once the index has grown by
+# RETRAIN_RATIO since the clusters were last placed, rebuild() places them again so the centroids keep up with the
+# data. The rows are kept as float32, so the index uses slightly more memory than exact float32 search.
+class ClusterIndex:
+    RETRAIN_RATIO = 1.5
+    CLUSTERS_PER_ROOT = 4
+
+    def __init__(self, embeddings, n_clusters=0, n_probe=4, probe_fraction=0.05, iterations=20, seed=0):
+        self.matrix = normalize(embeddings) if len(embeddings) else None
+        self.N_CLUSTERS = n_clusters
+        self.N_PROBE = n_probe
+        self.PROBE_FRACTION = probe_fraction
+        self.ITERATIONS = iterations
+        self.rng = np.random.default_rng(seed)
+        self.centroids = None
+        self.members = []
+        self.trained_rows = 0
+        if self.matrix is not None:
+            self._train()
+
+    def __len__(self):
+        return 0 if self.matrix is None else len(self.matrix)
+
+    # Returns the number of bytes used by the stored rows and centroids.
+    def nbytes(self):
+        if self.matrix is None:
+            return 0
+        return self.matrix.nbytes + self.centroids.nbytes
+
+    # Returns a stored row as a float32 vector.
+    def vector(self, index):
+        return self.matrix[index]
+
+    # Runs spherical k-means over the rows to place the centroids, then records which rows belong to each cluster.
+    def _train(self):
+        n_clusters = min(self.N_CLUSTERS or max(1, int(self.CLUSTERS_PER_ROOT * np.sqrt(len(self.matrix)))),
+                         len(self.matrix))
+        self.centroids = self.matrix[self.rng.choice(len(self.matrix), n_clusters, replace=False)]
+        for _ in range(self.ITERATIONS):
+            assignments = np.argmax(self.matrix @ self.centroids.T, axis=1)
+            sums = np.zeros_like(self.centroids)
+            np.add.at(sums, assignments, self.matrix)
+            # Keep the old centroid for any cluster that ended up empty.
+            empty = ~sums.any(axis=1)
+            sums[empty] = self.centroids[empty]
+            self.centroids = normalize(sums)
+
+        assignments = np.argmax(self.matrix @ self.centroids.T, axis=1)
+        self.members = [np.flatnonzero(assignments == cluster) for cluster in range(n_clusters)]
+        self.trained_rows = len(self.matrix)
+
+    # Adds one embedding, or a matrix of them, to the end of the index, placing each in the cluster with the closest
+    # centroid. The clusters are only placed here if the index was empty.
+    def add(self, vector):
+        rows = normalize(np.atleast_2d(vector))
+        if len(rows) == 0:
+            return
+        if self.matrix is None:
+            self.matrix = rows
+            self._train()
+            return
+        clusters = np.argmax(rows @ self.centroids.T, axis=1)
+        positions = len(self.matrix) + np.arange(len(rows))
+        for cluster in np.unique(clusters):
+            self.members[cluster] = np.concatenate([self.members[cluster], positions[clusters == cluster]])
+        self.matrix = np.vstack([self.matrix, rows])
+
+    # Returns a copy of the index with every cluster placed again if it has grown by RETRAIN_RATIO since the clusters
+    # were last placed, or None if it has not. The index itself is left untouched, so k-means can run on a worker
+    # thread while the index keeps answering searches, and the caller swaps the copy in afterwards.
+    def rebuild(self):
+        if self.matrix is None or len(self.matrix) < self.trained_rows * self.RETRAIN_RATIO:
+            return None
+        index = copy.copy(self)
+        index._train()
+        return index
+
+    # Returns the cosine similarity of the query to each of the given rows, for reranking a known set of candidates.
+    def score(self, query, ids):
+        if self.matrix is None or len(ids) == 0:
+            return np.zeros(0, dtype=np.float32)
+        return self.matrix[np.asarray(ids)] @ normalize(query)
+
+    # Returns the (index, score) pairs of the k most similar rows whose score is above the threshold, searching
+    # only the clusters closest to the query.
+    def search(self, query, k=1, threshold=0.0):
+        if self.matrix is None:
+            return []
+        query = normalize(query)
+        n_probe = min(max(self.N_PROBE, int(np.ceil(self.PROBE_FRACTION * len(self.centroids)))), len(self.centroids))
+        clusters = np.argpartition(-(self.centroids @ query), n_probe - 1)[:n_probe]
+        candidates = np.concatenate([self.members[cluster] for cluster in clusters])
+        return top_k(self.matrix[candidates] @ query, k, threshold, ids=candidates)
+
+# Creates the index backend named in config.ini ("exact" or "cluster") over the given embeddings. The storage type
+# ("float32", "float16" or "int8") only applies to the exact backend.
+def build_index(embeddings, backend="exact", dtype="float32", n_clusters=0, n_probe=4, probe_fraction=0.05):
+    if backend == "exact":
+        return ExactIndex(embeddings, dtype=dtype)
+    if backend == "cluster":
+        return ClusterIndex(embeddings, n_clusters=n_clusters, n_probe=n_probe, probe_fraction=probe_fraction)
+    raise ValueError(f"Unknown index backend: {backend}")